@@ -1,50 +1,199 @@
 import asyncio
-import json
+import base64
+import binascii
 import time
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, List, Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Header, Path, Query, Request
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from pydantic import ValidationError
-from settings import settings
+import orjson
+from redis.asyncio import Redis
 
-from app.dependencies.security import get_api_key, require_admin
+from app.api.streaming import RequestStreamingResponse, iter_json_array, iter_ndjson
+from app.core.breaker import CircuitBreaker, get_breaker
+from app.core.config import settings
+from app.core.metrics import CONTENT_TYPE, REGISTRY
+from app.core.redis import get_redis, record_pool_metrics
+from app.dependencies.security import get_api_key, get_api_key_store, require_admin
+from app.model.api_keys import (
+    ApiKeysResponse,
+    CreateApiKeyRequest,
+    CreatedApiKeyResponse,
+)
 from app.model.users import (
     CreateUserRequest,
     CreateUserResponse,
     DeletedCountResponse,
     TagsParam,
+    TagCountsResponse,
+    TaggedUsernamesResponse,
     UsernameParam,
     UserResponse,
+    UserSearchResponse,
+    UsersPageResponse,
 )
+from app.repositories.api_key_store import RedisApiKeyStore, key_id
 from app.repositories.interface import UserRepository
-from app.repositories.user_repo import RedisUserRepository
+from app.repositories.replicas import same_replicas
+
+IDEMPOTENCY_TTL = 300  # 5 minutes
+ADD_TAG_ATTEMPTS = 5  # reads of a user whose tags keep changing meanwhile
 
 health_router = APIRouter()
 router = APIRouter(dependencies=[Depends(get_api_key)])
 
-REDIS_URL = settings.redis_url
-repo = RedisUserRepository(redis_url=REDIS_URL)
 
-
-def get_user_repo() -> UserRepository:
-    return repo
+def get_user_repo(request: Request) -> UserRepository:
+    # created by the app lifespan on top of the shared connection pool
+    return request.app.state.user_repo
 
 
 def get_request_context():
     return time.monotonic()
 
 
+def _encode_cursor(cursor: int) -> str | None:
+    # opaque to clients; None marks the last page
+    if cursor == 0:
+        return None
+    return base64.urlsafe_b64encode(str(cursor).encode()).decode()
+
+
+def _decode_cursor(cursor: str | None) -> int:
+    if not cursor:
+        return 0
+    try:
+        decoded = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        decoded = -1
+    if decoded < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return decoded
+
+
+def _encode_name_cursor(cursor: str | None) -> str | None:
+    # cursors of username ordered pages: the last username returned
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_name_cursor(cursor: str | None) -> str | None:
+    if not cursor:
+        return None
+    try:
+        decoded = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        decoded = ""
+    if not decoded:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return decoded
+
+
+def _etag(version: int) -> str:
+    # weak: equal versions may still differ in last_active and timings
+    return f'W/"{version}"'
+
+
+def _known_versions(if_none_match: str | None) -> set[int]:
+    versions = set()
+    for tag in (if_none_match or "").split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag.isdigit():
+            versions.add(int(tag))
+    return versions
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+async def _ndjson_users(repo: UserRepository, batch_size: int):
+    lines = []
+    async for user in repo.iter_users(batch_size):
+        lines.append(orjson.dumps(user) + b"\n")
+        if len(lines) >= batch_size:
+            yield b"".join(lines)
+            lines.clear()
+    if lines:
+        yield b"".join(lines)
+
+
+async def _bulk_import(repo: UserRepository, records, batch_size: int):
+    # yields NDJSON result lines, one pipelined insert per batch of valid users
+    lines: list[bytes] = []
+    batch: list[tuple[int, dict]] = []
+
+    async def insert_batch():
+        created = await repo.bulk_create_users([user for _, user in batch])
+        for (index, user), ok in zip(batch, created):
+            status = "created" if ok else "conflict"
+            lines.append(
+                orjson.dumps(
+                    {"index": index, "username": user["username"], "status": status}
+                )
+                + b"\n"
+            )
+        batch.clear()
+
+    index = 0
+    async for record, error in records:
+        if error is None:
+            try:
+                payload = CreateUserRequest.model_validate(record)
+            except ValidationError as e:
+                error = e.errors()[0]["msg"]
+        if error is None:
+            user = {
+                "username": payload.username,
+                "tags": payload.tags,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            }
+            batch.append((index, user))
+        else:
+            result = {"index": index, "status": "invalid", "detail": error}
+            lines.append(orjson.dumps(result) + b"\n")
+        index += 1
+
+        if len(batch) >= batch_size:
+            await insert_batch()
+        if len(lines) >= batch_size:
+            yield b"".join(lines)
+            lines.clear()
+
+    if batch:
+        await insert_batch()
+    if lines:
+        yield b"".join(lines)
+
+
 @health_router.get("/health")
-async def health(request: Request):
-    redis = request.app.state.redis
-    await redis.ping()
-    return {"status": "ok"}
+async def health(
+    redis: Redis = Depends(get_redis),
+    breaker: CircuitBreaker = Depends(get_breaker),
+):
+    # fails fast with 503 while the circuit is open; a ping after the
+    # reset timeout is the trial call that may close it
+    async with breaker.guard("health"):
+        await redis.ping()
+    return {"status": "ok", "circuit": breaker.state}
+
 
+@health_router.get("/metrics", include_in_schema=False)
+async def metrics(redis: Redis = Depends(get_redis)):
+    # Prometheus text format; unauthenticated like /health
+    record_pool_metrics(redis.connection_pool)
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
 
-@router.post("/users", response_model=CreateUserResponse)
+
+@router.post("/users", response_model=CreateUserResponse, status_code=201)
 async def create_user(
     payload: CreateUserRequest,
     request: Request,
@@ -58,59 +207,136 @@ async def create_user(
     if not idemp_key:
         raise HTTPException(400, "Idempotency-Key required")
 
-    redis = request.app.state.redis
-    cache_key = f"idemp:{api_key}:{idempotency_key}:POST:/users"
-    print(cache_key)
-    # check for Idempotency FIRST
-    cached = await redis.get(cache_key)
-    print(cached)
-    if cached:
-        cached_data = json.loads(cached)
-        return JSONResponse(
-            status_code=cached_data["status"],
-            content=cached_data["body"],
-        )
-
-    user = await repo.get_user(payload.username)
-    if user:
-        raise HTTPException(409, "User already exists")
+    # by key id: Redis key names must not reveal usable API keys
+    cache_key = f"idemp:{key_id(api_key)}:{idempotency_key}:POST:/users"
     user = {
-       "username": payload.username,
+        "username": payload.username,
         "tags": payload.tags,
         "created_at": datetime.now(timezone.utc).isoformat(),
     }
-    await repo.create_user(user)
-    response ={"user": user, "processing_time": time.monotonic() - start_time}
-    # cache only valid responses
+    response = {"user": user, "processing_time": time.monotonic() - start_time}
     validated_response = CreateUserResponse(**response)
-    encoded = jsonable_encoder(validated_response)
-    await redis.setex(
-        cache_key,
-        300,  # 5 minutes
-        json.dumps({"status": 201, "body": encoded}),
-    )
+    # idempotency check, existence check, insert and response caching run as
+    # one atomic step, so concurrent duplicates replay the first result
+    try:
+        cached = await repo.create_user_idempotent(
+            user,
+            cache_key,
+            {"status": 201, "body": validated_response.model_dump(mode="json")},
+            IDEMPOTENCY_TTL,
+        )
+    except ValueError:
+        raise HTTPException(409, "User already exists")
+    if cached:
+        return JSONResponse(status_code=cached["status"], content=cached["body"])
     return validated_response
 
 
-@router.get("/users")
-async def list_users(repo: UserRepository = Depends(get_user_repo)):
-    return {"users": await repo.list_users()}
+@router.get(
+    "/users",
+    response_model=UsersPageResponse | TaggedUsernamesResponse | TagCountsResponse,
+)
+async def list_users(
+    response: Response,
+    cursor: str | None = Query(None, description="Cursor from the previous page"),
+    limit: int = Query(100, ge=1, le=1000, description="Approximate page size"),
+    stream: bool = Query(False, description="Stream all users as NDJSON"),
+    tag: List[str] | None = Query(None, description="Only usernames with these tags"),
+    match: Literal["all", "any"] = Query("all", description="Match all or any tag"),
+    counts: bool = Query(False, description="Users per tag instead of users"),
+    if_none_match: str | None = Header(None),
+    repo: UserRepository = Depends(get_user_repo),
+):
+    if stream:
+        return StreamingResponse(
+            _ndjson_users(repo, limit), media_type="application/x-ndjson"
+        )
+    # the version is read before the page, and from the same replicas, so a
+    # change made meanwhile is never hidden
+    with same_replicas():
+        version = await repo.collection_version()
+        etag = _etag(version)
+        if version in _known_versions(if_none_match):
+            return _not_modified(etag)
+        response.headers["ETag"] = etag
+
+        # tag queries are answered from the tag index, no user is read
+        if counts:
+            try:
+                tag_counts, next_offset = await repo.tag_counts(
+                    tag, _decode_cursor(cursor), limit
+                )
+            except ValueError:  # out of range
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            return {
+                "counts": tag_counts,
+                "next_cursor": _encode_cursor(next_offset),
+            }
+        if tag:
+            usernames, last = await repo.list_usernames_by_tags(
+                tag, match, _decode_name_cursor(cursor), limit
+            )
+            return {
+                "usernames": usernames,
+                "next_cursor": _encode_name_cursor(last),
+            }
+        try:
+            users, next_cursor = await repo.list_users_page(
+                _decode_cursor(cursor), limit
+            )
+        except ValueError:  # out of range
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        return {"users": users, "next_cursor": _encode_cursor(next_cursor)}
+
+
+# declared before /users/{username}, which would otherwise match "search"
+@router.get("/users/search", response_model=UserSearchResponse)
+async def search_users(
+    response: Response,
+    prefix: str = Query(
+        ..., min_length=1, max_length=15, description="Username prefix"
+    ),
+    limit: int = Query(20, ge=1, le=1000, description="Maximum number of results"),
+    hydrate: bool = Query(False, description="Also return the matching users"),
+    if_none_match: str | None = Header(None),
+    repo: UserRepository = Depends(get_user_repo),
+):
+    with same_replicas():  # as in list_users
+        version = await repo.collection_version()
+        etag = _etag(version)
+        if version in _known_versions(if_none_match):
+            return _not_modified(etag)
+        response.headers["ETag"] = etag
+
+        usernames = await repo.search_usernames(prefix.lower(), limit)
+        if not hydrate:
+            return {"usernames": usernames}
+        users = await repo.get_users(usernames)
+    # a user deleted between the two reads is dropped from both
+    return {"usernames": list(users), "users": users}
 
 
 @router.get("/users/{username}", response_model=CreateUserResponse)
 async def get_user(
     username: Annotated[str, Path(min_length=3, max_length=15)],
+    response: Response,
+    if_none_match: str | None = Header(None),
     repo: UserRepository = Depends(get_user_repo),
     start_time=Depends(get_request_context)
 ):
     data = UsernameParam(username=username)
-    user = await repo.get_user(data.username)
-    if not user:
+    # versions only grow, so only the newest one the client holds can match
+    known_version = max(_known_versions(if_none_match), default=None)
+    version, user = await repo.get_user_versioned(data.username, known_version)
+    if not user and version is None:
         raise HTTPException(status_code=404, detail="Not found")
     await repo.touch_user(data.username)
+    if not user:
+        return _not_modified(_etag(version))
+    if version is not None:
+        response.headers["ETag"] = _etag(version)
     await asyncio.sleep(0.1)
-    response ={"user": user, "processing_time": time.monotonic() - start_time}
-    return response
+    return {"user": user, "processing_time": time.monotonic() - start_time}
 
 
 @router.post("/users/{username}/tags", response_model=UserResponse)
@@ -118,18 +344,31 @@ async def add_tag(
     username: str, payload: TagsParam, repo: UserRepository = Depends(get_user_repo)
 ):
     data = UsernameParam(username=username)
-    user = await repo.get_user(data.username)
-    if user is None:
-        raise HTTPException(status_code=404, detail="Not found")
+    # read-modify-write: the tags are stored only if the user did not change
+    # since it was read (from the primary: a lagging replica would drop
+    # recent tags), otherwise it is read again
+    for _ in range(ADD_TAG_ATTEMPTS):
+        version, user = await repo.get_user_versioned(data.username, primary=True)
+        if user is None:
+            raise HTTPException(status_code=404, detail="Not found")
 
-    candidate_tags = user["tags"] + payload.tags
-    try:
-        validated = TagsParam(tags=candidate_tags)
-    except ValidationError as e:
-        raise HTTPException(status_code=422, detail=e.errors()[0]["msg"])
-    await repo.add_tag(data.username, validated.tags)
+        candidate_tags = user["tags"] + payload.tags
+        try:
+            validated = TagsParam(tags=candidate_tags)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors()[0]["msg"])
+        try:
+            updated = await repo.add_tag(
+                data.username, validated.tags, if_version=version or 0
+            )
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Not found")
+        if updated is not None:
+            break
+    else:
+        raise HTTPException(status_code=409, detail="Concurrent update, retry")
     await repo.touch_user(data.username)
-    user = await repo.get_user(data.username)
+    user = await repo.get_user(data.username, primary=True)
     return user
 
 
@@ -147,6 +386,77 @@ async def delete_all_users(repo: UserRepository = Depends(get_user_repo)):
     await repo.delete_all()
 
 
+@router.post("/admin/users/bulk", dependencies=[Depends(require_admin)])
+async def bulk_create_users(
+    request: Request,
+    batch_size: int = Query(
+        settings.BULK_IMPORT_BATCH_SIZE, ge=1, le=10_000, description="Users per insert"
+    ),
+    repo: UserRepository = Depends(get_user_repo),
+):
+    """Create users from a JSON array or an NDJSON body (Content-Type:
+    application/x-ndjson). The body is parsed as it arrives and the result of
+    every record (created, conflict or invalid) is streamed back as NDJSON.
+    """
+    content_type = request.headers.get("content-type", "")
+    parse = iter_ndjson if "ndjson" in content_type else iter_json_array
+    return RequestStreamingResponse(
+        _bulk_import(repo, parse(request.stream()), batch_size),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.get("/admin/stats", dependencies=[Depends(require_admin)])
+async def repository_stats(
+    repo: UserRepository = Depends(get_user_repo),
+    store: RedisApiKeyStore = Depends(get_api_key_store),
+    redis: Redis = Depends(get_redis),
+    breaker: CircuitBreaker = Depends(get_breaker),
+):
+    # only the app's own instrumented pool keeps utilisation numbers
+    pool_stats = getattr(redis.connection_pool, "stats", None)
+    return {
+        **repo.stats(),
+        "api_keys": store.stats(),
+        "pool": pool_stats() if pool_stats is not None else None,
+        "breaker": breaker.stats(),
+    }
+
+
+@router.post(
+    "/admin/api-keys",
+    dependencies=[Depends(require_admin)],
+    response_model=CreatedApiKeyResponse,
+    status_code=201,
+)
+async def create_api_key(
+    payload: CreateApiKeyRequest,
+    store: RedisApiKeyStore = Depends(get_api_key_store),
+):
+    api_key, key_id = await store.create_key(payload.role)
+    return {"api_key": api_key, "key_id": key_id, "role": payload.role}
+
+
+@router.get(
+    "/admin/api-keys",
+    dependencies=[Depends(require_admin)],
+    response_model=ApiKeysResponse,
+)
+async def list_api_keys(store: RedisApiKeyStore = Depends(get_api_key_store)):
+    return {"keys": await store.list_keys()}
+
+
+@router.delete(
+    "/admin/api-keys/{key_id}", dependencies=[Depends(require_admin)], status_code=204
+)
+async def revoke_api_key(
+    key_id: str, store: RedisApiKeyStore = Depends(get_api_key_store)
+):
+    # every worker drops the key from its cache as soon as this returns
+    if not await store.revoke(key_id):
+        raise HTTPException(status_code=404, detail="Not found")
+
+
 @router.delete(
     "/admin/users/inactive",
     dependencies=[Depends(require_admin)],
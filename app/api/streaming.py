@@ -0,0 +1,111 @@
+import codecs
+import json
+from typing import Any, AsyncIterator, Optional, Tuple
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# (record, None) for each parsed record, (None, error message) otherwise
+Parsed = Tuple[Optional[Any], Optional[str]]
+
+MAX_RECORD_BYTES = 64 * 1024
+_WHITESPACE = " \t\r\n"
+
+
+def _parse_line(line: bytes) -> Parsed:
+    try:
+        return json.loads(line), None
+    except ValueError as e:
+        return None, f"Invalid JSON: {e}"
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Parsed]:
+    """Parse a newline-delimited JSON body one line at a time."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+        if len(buffer) > MAX_RECORD_BYTES:
+            yield None, "Record too large"
+            return
+    if buffer.strip():
+        yield _parse_line(buffer)
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Parsed]:
+    """Parse a JSON array body element by element, without holding the
+    whole array in memory. A syntax error ends the stream.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    opened = False
+    done = False
+
+    async def more() -> bool:
+        nonlocal buffer, pos
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            return False
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = 0
+        return True
+
+    def skip_whitespace() -> None:
+        nonlocal pos
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+
+    while not done:
+        skip_whitespace()
+        if pos == len(buffer):
+            if await more():
+                continue
+            if opened:
+                yield None, "Unexpected end of JSON array"
+            return
+
+        if not opened:
+            if buffer[pos] != "[":
+                yield None, "Expected a JSON array"
+                return
+            opened = True
+            pos += 1
+            continue
+
+        if buffer[pos] == "]":
+            done = True
+            continue
+        if buffer[pos] == ",":
+            pos += 1
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except ValueError as e:
+            # the element may just be split across chunks
+            if len(buffer) - pos <= MAX_RECORD_BYTES and await more():
+                continue
+            yield None, f"Invalid JSON: {e}"
+            return
+        if end == len(buffer) and await more():
+            continue  # a number may continue in the next chunk
+        pos = end
+        yield record, None
+
+
+class RequestStreamingResponse(StreamingResponse):
+    """A StreamingResponse whose body is produced while the request body is
+    still being read. StreamingResponse normally listens for a disconnect on
+    ``receive`` concurrently, which would steal the request body chunks;
+    here the body iterator is the only consumer of ``receive``.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,162 @@
+"""
+Circuit breaker and per-operation timeouts for calls that need Redis.
+- one breaker per worker, shared by the rate limiter, the user repository
+  and /health, so a slow or unreachable Redis is noticed by all of them
+- every guarded call runs under the timeout of its operation ("read",
+  "write", "bulk", "rate_limit", "health"); None means no timeout
+- `failure_threshold` consecutive failures (connection errors and
+  timeouts) open the circuit; while it is open, calls fail at once
+- `reset_timeout` seconds later one trial call is let through: success
+  closes the circuit, failure opens it again
+"""
+
+import asyncio
+import functools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import Request
+from redis.exceptions import ConnectionError, TimeoutError
+
+from app.core.metrics import CIRCUIT_REJECTED, CIRCUIT_STATE, CIRCUIT_TRANSITIONS
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+# errors that mean Redis is unwell; any other outcome means it answered
+FAILURES = (ConnectionError, TimeoutError, asyncio.TimeoutError)
+
+DEFAULT_TIMEOUTS: Dict[str, Optional[float]] = {
+    "read": 0.5,
+    "write": 1.0,
+    "bulk": 60.0,
+    "rate_limit": 0.1,
+    "health": 0.5,
+}
+
+
+class RedisUnavailableError(Exception):
+    def __init__(self, operation: str, retry_after: float = 0):
+        super().__init__(f"Redis unavailable for {operation}")
+        self.operation = operation
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RedisUnavailableError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = 5,
+        reset_timeout: float = 5.0,
+        timeouts: Optional[Dict[str, Optional[float]]] = None,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self._opened_at = 0.0
+        self._trial = False  # a half-open trial call is in flight
+        self.rejected = 0
+        self.opened_total = 0
+        CIRCUIT_STATE.set(1, CLOSED)
+
+    def _transition(self, state: str) -> None:
+        CIRCUIT_TRANSITIONS.inc(self.state, state)
+        CIRCUIT_STATE.set(0, self.state)
+        CIRCUIT_STATE.set(1, state)
+        self.state = state
+
+    def allow(self) -> bool:
+        """Whether a call may go to Redis now."""
+        if self.state == OPEN:
+            if time.monotonic() < self._opened_at + self.reset_timeout:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trial:
+                return False
+            self._trial = True
+        return True
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self._trial = False
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def failed(self) -> None:
+        self.failures += 1
+        self._trial = False
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= self.failure_threshold
+        ):
+            self._opened_at = time.monotonic()
+            self.opened_total += 1
+            self._transition(OPEN)
+
+    @asynccontextmanager
+    async def guard(self, operation: str) -> AsyncIterator[None]:
+        """Run the enclosed Redis calls as `operation`.
+        Raises CircuitOpenError without running them while the circuit is
+        open, and RedisUnavailableError when they fail or time out.
+        """
+        if not self.allow():
+            self.rejected += 1
+            CIRCUIT_REJECTED.inc(operation)
+            raise CircuitOpenError(operation, self.retry_after())
+        try:
+            async with asyncio.timeout(self.timeouts.get(operation)):
+                yield
+        except FAILURES as e:
+            self.failed()
+            raise RedisUnavailableError(operation, self.retry_after()) from e
+        except Exception:
+            self.succeeded()  # Redis answered, the caller did not like it
+            raise
+        except BaseException:
+            self._trial = False  # cancelled: no verdict
+            raise
+        else:
+            self.succeeded()
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened_total": self.opened_total,
+            "rejected": self.rejected,
+        }
+
+
+def guarded(operation: str):
+    """Run an async method of an object with a `_breaker` (which may be
+    None) under the breaker as `operation`. Guarded methods must not call
+    each other: a half-open circuit lets only one call through.
+    """
+
+    def decorate(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self._breaker is None:
+                return await method(self, *args, **kwargs)
+            async with self._breaker.guard(operation):
+                return await method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def get_breaker(request: Request) -> CircuitBreaker:
+    # created by the app lifespan, shared with the rate limiter and the repo
+    return request.app.state.breaker
@@ -12,4 +12,10 @@ celery_app.autodiscover_tasks(["app.users"])
 celery_app.conf.update(
     task_serializer="json",
     accept_content=["json"],
+    beat_schedule={
+        "cleanup-inactive-users": {
+            "task": "app.users.tasks.cleanup_inactive_users",
+            "schedule": settings.CLEANUP_INTERVAL,
+        },
+    },
 )
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Any, Dict, List, Literal
 
 from pydantic_settings import BaseSettings
 
@@ -6,6 +6,83 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     REDIS_URL: str
     VALID_API_KEYS: Dict[str, str]
+    # shared connection pool
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5.0  # seconds to wait for a free connection
+    REDIS_SOCKET_TIMEOUT: float | None = 5.0
+    REDIS_SOCKET_CONNECT_TIMEOUT: float | None = 5.0
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    # users spread over these nodes on a hash ring; REDIS_URL keeps the rest
+    REDIS_SHARD_URLS: List[str] = []
+    # or over hash-tag namespaces of a Redis Cluster
+    REDIS_CLUSTER_URL: str | None = None
+    REDIS_CLUSTER_SHARDS: int = 16
+    # replicas for reads: of REDIS_URL, and per REDIS_SHARD_URLS entry
+    REDIS_REPLICA_URLS: List[str] = []
+    REDIS_SHARD_REPLICA_URLS: Dict[str, List[str]] = {}
+    REDIS_REPLICA_EJECT_SECONDS: float = 10.0  # how long a failed replica rests
+    # seconds a caller's reads stay on the primary after it wrote; 0 disables
+    READ_YOUR_WRITES_WINDOW: float = 0
+    # circuit breaker shared by the rate limiter, the repository and /health
+    CIRCUIT_FAILURE_THRESHOLD: int = 5  # consecutive failures that open it
+    CIRCUIT_RESET_TIMEOUT: float = 5.0  # seconds open before a trial call
+    # seconds per operation: read, write, bulk, rate_limit, health; null = none
+    REDIS_OPERATION_TIMEOUTS: Dict[str, float | None] = {}
+    USER_STORAGE: Literal["json", "hash"] = "json"
+    # encoding of string-stored users and cached responses; reads detect it
+    USER_CODEC: Literal["json", "msgpack"] = "json"
+    # seconds between write-behind flushes of last_active; 0 writes inline
+    LAST_ACTIVE_FLUSH_INTERVAL: float = 1.0
+    LAST_ACTIVE_FLUSH_MAX_PENDING: int = 1000
+    # local get_user cache per worker; 0 disables it
+    USER_CACHE_MAX_ENTRIES: int = 0
+    USER_CACHE_TTL: float = 30.0
+    RATE_LIMIT_ALGORITHM: Literal["sliding_log", "gcra", "sliding_window"] = (
+        "sliding_log"
+    )
+    # calls reserved per limiter round trip (gcra/sliding_window only)
+    RATE_LIMIT_LEASE_SIZE: int = 0
+    RATE_LIMIT_LEASE_TTL: float = 1.0
+    # while Redis is unavailable: limit in-process, allow all, or refuse all
+    RATE_LIMIT_FAILURE_MODE: Literal["local", "open", "closed"] = "local"
+    # first match wins: path pattern ("{x}" = one segment, trailing "*" =
+    # any rest), optional methods and API key roles, and limits that must
+    # all have room; each policy has its own budget
+    RATE_LIMIT_POLICIES: List[Dict[str, Any]] = [
+        {
+            "name": "admin-bulk",
+            "path": "/admin/users/bulk",
+            "methods": ["POST"],
+            "roles": ["admin"],
+            "limits": [
+                {"max_calls": 2, "window_seconds": 10},
+                {"max_calls": 10, "window_seconds": 3600},
+            ],
+        },
+        {
+            "name": "admin-cleanup",
+            "path": "/admin/users*",
+            "methods": ["DELETE"],
+            "roles": ["admin"],
+            "limits": [
+                {"max_calls": 1, "window_seconds": 10},
+                {"max_calls": 20, "window_seconds": 3600},
+            ],
+        },
+        {"name": "default", "limits": [{"max_calls": 5, "window_seconds": 10}]},
+    ]
+    BODY_CAPTURE_MAX_BYTES: int = 64 * 1024
+    # users per pipelined insert in POST /admin/users/bulk
+    BULK_IMPORT_BATCH_SIZE: int = 500
+    # periodic Celery cleanup of inactive users
+    CLEANUP_INACTIVE_DAYS: float = 1
+    CLEANUP_INTERVAL: float = 3600  # seconds between beat runs
+    CLEANUP_PARTITIONS: int = 8  # parallel subtasks per run
+    CLEANUP_LOCK_TTL: int = 900  # seconds; frees the lock if a run dies
+    # per-worker cache of API key lookups; VALID_API_KEYS seeds an empty store
+    API_KEY_CACHE_TTL: float = 30.0
+    API_KEY_NEGATIVE_CACHE_TTL: float = 5.0
+    API_KEY_CACHE_MAX_ENTRIES: int = 10_000
 
     class Config:
         env_file = ".env"
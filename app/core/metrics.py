@@ -0,0 +1,228 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format.
+- recording is a dict lookup and an add, cheap enough for every request
+  and every Redis command
+- each worker process keeps and serves its own numbers; Prometheus tells
+  the workers apart by their scrape target
+"""
+
+import bisect
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+    @abstractmethod
+    def render(self) -> List[str]: ...
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(
+                f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+            )
+        return lines
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._values.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                label_str = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_number(total)}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(
+    Counter(
+        "http_requests_total",
+        "HTTP responses by route template and status code.",
+        ("method", "route", "status"),
+    )
+)
+HTTP_REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time from receiving a request to sending the last response byte.",
+        ("method", "route"),
+    )
+)
+REDIS_COMMAND_DURATION = REGISTRY.register(
+    Histogram(
+        "redis_command_duration_seconds",
+        "Redis round trip time by command; pipelines count as one round trip.",
+        ("command",),
+    )
+)
+REDIS_COMMAND_ERRORS = REGISTRY.register(
+    Counter(
+        "redis_command_errors_total",
+        "Redis commands that raised, by command.",
+        ("command",),
+    )
+)
+REDIS_POOL_WAIT = REGISTRY.register(
+    Histogram(
+        "redis_pool_wait_seconds",
+        "Time spent waiting for a connection from the shared pool.",
+    )
+)
+REDIS_POOL_CONNECTIONS = REGISTRY.register(
+    Gauge(
+        "redis_pool_connections",
+        "Connections of the shared pool by state, and callers waiting for one.",
+        ("state",),
+    )
+)
+RATE_LIMIT_DECISIONS = REGISTRY.register(
+    Counter(
+        "rate_limit_decisions_total",
+        "Rate limiter outcomes by kind of client identifier.",
+        ("key_class", "decision"),
+    )
+)
+SINGLE_FLIGHT_CALLS = REGISTRY.register(
+    Counter(
+        "user_repo_single_flight_calls_total",
+        "Repository calls by operation; shared ones joined an identical call"
+        " already in flight.",
+        ("operation", "result"),
+    )
+)
+CIRCUIT_STATE = REGISTRY.register(
+    Gauge(
+        "redis_circuit_breaker_state",
+        "1 for the current state of the Redis circuit breaker, 0 for the others.",
+        ("state",),
+    )
+)
+CIRCUIT_TRANSITIONS = REGISTRY.register(
+    Counter(
+        "redis_circuit_breaker_transitions_total",
+        "State changes of the Redis circuit breaker.",
+        ("from_state", "to_state"),
+    )
+)
+CIRCUIT_REJECTED = REGISTRY.register(
+    Counter(
+        "redis_circuit_breaker_rejected_total",
+        "Calls failed fast, without Redis, while the circuit was open.",
+        ("operation",),
+    )
+)
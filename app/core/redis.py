@@ -0,0 +1,159 @@
+import time
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from redis.asyncio import BlockingConnectionPool, Redis, RedisCluster
+from redis.asyncio.client import Pipeline
+
+from app.core.metrics import (
+    REDIS_COMMAND_DURATION,
+    REDIS_COMMAND_ERRORS,
+    REDIS_POOL_CONNECTIONS,
+    REDIS_POOL_WAIT,
+)
+from app.repositories.sharding import Shard, cluster_shards, node_shards
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """
+    BlockingConnectionPool that keeps utilisation numbers:
+    - how many callers are waiting for a free connection right now
+    - how long, in total, callers have waited
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self.acquired_total = 0
+        self.wait_seconds_total = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            return await super().get_connection(*args, **kwargs)
+        finally:
+            waited = time.perf_counter() - started
+            self.waiting -= 1
+            self.acquired_total += 1
+            self.wait_seconds_total += waited
+            REDIS_POOL_WAIT.observe(waited)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "max_connections": self.max_connections,
+            "in_use": len(self._in_use_connections),
+            "idle": len(self._available_connections),
+            "waiting": self.waiting,
+            "acquired_total": self.acquired_total,
+            "wait_seconds_total": self.wait_seconds_total,
+        }
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        command = "MULTI" if self.is_transaction else "PIPELINE"
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            REDIS_COMMAND_ERRORS.inc(command)
+            raise
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - started, command)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client that records the latency and errors of every command, so
+    the repository and the rate limiter are measured without changes.
+    - pipelines are timed once per execute, as PIPELINE or MULTI
+    """
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            REDIS_COMMAND_ERRORS.inc(command)
+            raise
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - started, command)
+
+    def pipeline(
+        self, transaction: bool = True, shard_hint: str | None = None
+    ) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+def record_pool_metrics(pool) -> None:
+    """Copy the pool's current utilisation into the metrics gauges."""
+    if not isinstance(pool, InstrumentedConnectionPool):
+        return
+    stats = pool.stats()
+    for state in ("in_use", "idle", "waiting"):
+        REDIS_POOL_CONNECTIONS.set(stats[state], state)
+
+
+def create_redis_pool(settings, url: str | None = None) -> InstrumentedConnectionPool:
+    return InstrumentedConnectionPool.from_url(
+        url or settings.REDIS_URL,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
+
+def create_client(settings, url: str) -> InstrumentedRedis:
+    return InstrumentedRedis(connection_pool=create_redis_pool(settings, url))
+
+
+def create_user_shards(settings, primary: Redis | None = None) -> Optional[List[Shard]]:
+    """The shards users are spread over, or None to keep them on REDIS_URL.
+    With replicas of REDIS_URL configured, `primary` is REDIS_URL's client.
+    """
+    if settings.REDIS_CLUSTER_URL:
+        cluster = RedisCluster.from_url(
+            settings.REDIS_CLUSTER_URL, decode_responses=True
+        )
+        return cluster_shards(cluster, settings.REDIS_CLUSTER_SHARDS)
+    if settings.REDIS_SHARD_URLS:
+        clients = {
+            url: create_client(settings, url) for url in settings.REDIS_SHARD_URLS
+        }
+        replicas = {
+            url: [create_client(settings, replica) for replica in replica_urls]
+            for url, replica_urls in settings.REDIS_SHARD_REPLICA_URLS.items()
+        }
+        return node_shards(clients, replicas)
+    if settings.REDIS_REPLICA_URLS and primary is not None:
+        replicas = [create_client(settings, url) for url in settings.REDIS_REPLICA_URLS]
+        return [Shard("default", primary, replicas=tuple(replicas))]
+    return None
+
+
+async def close_user_shards(
+    shards: Optional[List[Shard]], primary: Redis | None = None
+) -> None:
+    """Close the shards' clients, except `primary`, which the caller owns."""
+    clients = {}
+    for shard in shards or []:
+        # cluster shards share one client
+        for client in (shard.redis, *shard.replicas):
+            clients[id(client)] = client
+    clients.pop(id(primary), None)
+    for client in clients.values():
+        await client.aclose()
+        if not isinstance(client, RedisCluster):
+            await client.connection_pool.disconnect()
+
+
+def get_redis(request: Request) -> Redis:
+    """The lifespan-managed client; every caller shares its pool."""
+    return request.app.state.redis
@@ -1,22 +1,32 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import APIKeyHeader
-from settings import settings
 
-VALID_KEYS = settings.VALID_API_KEYS
+from app.repositories.api_key_store import RedisApiKeyStore
+from app.repositories.replicas import read_session
 
 api_key_scheme = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 
-async def get_api_key(api_key: str = Depends(api_key_scheme)):
+def get_api_key_store(request: Request) -> RedisApiKeyStore:
+    # created by the app lifespan, seeded from settings.VALID_API_KEYS
+    return request.app.state.api_keys
+
+
+async def get_api_key(
+    api_key: str = Depends(api_key_scheme),
+    store: RedisApiKeyStore = Depends(get_api_key_store),
+):
     if not api_key:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing API Key"
         )
-    role = VALID_KEYS.get(api_key)
+    role = await store.get_role(api_key)
     if role is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Invalid API Key"
         )
+    # the session whose writes the request's reads may have to see
+    read_session.set(api_key)
     return role
 
 
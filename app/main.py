@@ -1,41 +1,112 @@
+import math
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
 from fastapi import FastAPI, Request
-from redis.asyncio import Redis
+from fastapi.responses import JSONResponse
 
 from app.api.routes import health_router
 from app.api.routes import router as user_router
+from app.core.breaker import CircuitBreaker, RedisUnavailableError
 from app.core.config import settings
+from app.core.redis import (
+    InstrumentedRedis,
+    close_user_shards,
+    create_redis_pool,
+    create_user_shards,
+)
+from app.middleware.body_capture import RequestBodyCaptureMiddleware
+from app.middleware.metrics import MetricsMiddleware
 from app.middleware.rate_limit import RedisRateLimitMiddleware
+from app.middleware.rate_limit_policies import RateLimitPolicy, load_policies
+from app.repositories.api_key_store import RedisApiKeyStore
+from app.repositories.user_repo import RedisUserRepository
 
-app = FastAPI()
-app.include_router(user_router)  # HAS AUTH
-app.include_router(health_router)  # NO AUTH
 
+# One connection pool per worker, shared by the rate limiter, the repository
+# and the health check. Created on startup so --reload and multiple workers
+# each get their own.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pool = create_redis_pool(settings)
+    app.state.redis = InstrumentedRedis(connection_pool=pool)
+    app.state.breaker = CircuitBreaker(
+        failure_threshold=settings.CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=settings.CIRCUIT_RESET_TIMEOUT,
+        timeouts=settings.REDIS_OPERATION_TIMEOUTS,
+    )
+    shards = create_user_shards(settings, primary=app.state.redis)
+    app.state.user_repo = RedisUserRepository(
+        redis_client=app.state.redis,
+        shards=shards,
+        storage=settings.USER_STORAGE,
+        codec=settings.USER_CODEC,
+        last_active_flush_interval=settings.LAST_ACTIVE_FLUSH_INTERVAL,
+        last_active_flush_max_pending=settings.LAST_ACTIVE_FLUSH_MAX_PENDING,
+        cache_max_entries=settings.USER_CACHE_MAX_ENTRIES,
+        cache_ttl=settings.USER_CACHE_TTL,
+        replica_eject_seconds=settings.REDIS_REPLICA_EJECT_SECONDS,
+        read_your_writes_window=settings.READ_YOUR_WRITES_WINDOW,
+        breaker=app.state.breaker,
+    )
+    app.state.api_keys = RedisApiKeyStore(
+        redis_client=app.state.redis,
+        cache_ttl=settings.API_KEY_CACHE_TTL,
+        negative_cache_ttl=settings.API_KEY_NEGATIVE_CACHE_TTL,
+        cache_max_entries=settings.API_KEY_CACHE_MAX_ENTRIES,
+        breaker=app.state.breaker,
+    )
+    await app.state.api_keys.bootstrap(settings.VALID_API_KEYS)
+    yield
+    # flush buffered last_active writes before the connections go away
+    await app.state.user_repo.close()
+    await app.state.api_keys.close()
+    await close_user_shards(shards, primary=app.state.redis)
+    await app.state.redis.aclose()
+    await pool.disconnect()
 
-REDIS_URL = settings.REDIS_URL
 
-# create redis client at module level (safe for single-process dev)
-redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+async def redis_unavailable(request: Request, exc: RedisUnavailableError):
+    # slow, unreachable, or the circuit is open and the call failed fast
+    retry_after = max(1, math.ceil(exc.retry_after))
+    return JSONResponse(
+        {"detail": "Service Unavailable", "retry_after": retry_after},
+        status_code=503,
+        headers={"Retry-After": str(retry_after)},
+    )
 
 
-# If running with --reload or multiple workers, initialize Redis client on an app startup/close event
-@app.on_event("startup")
-async def startup_event():
-    app.state.redis = Redis.from_url(REDIS_URL, decode_responses=True)
+def create_app(
+    lifespan=lifespan, rate_limit_policies: Optional[List[RateLimitPolicy]] = None
+) -> FastAPI:
+    """The app with its routes, error handlers and middleware stack.
+    The endpoint benchmarks build theirs here too (without the lifespan,
+    with their own rate limit), so the two cannot drift apart.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.add_exception_handler(RedisUnavailableError, redis_unavailable)
 
+    app.include_router(user_router)  # HAS AUTH
+    app.include_router(health_router)  # NO AUTH
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    redis_client = getattr(app.state, "redis", None)
-    if redis_client:
-        await redis_client.close()
+    app.add_middleware(
+        RedisRateLimitMiddleware,
+        policies=rate_limit_policies or load_policies(settings.RATE_LIMIT_POLICIES),
+        algorithm=settings.RATE_LIMIT_ALGORITHM,
+        lease_size=settings.RATE_LIMIT_LEASE_SIZE,
+        lease_ttl=settings.RATE_LIMIT_LEASE_TTL,
+        failure_mode=settings.RATE_LIMIT_FAILURE_MODE,
+    )
 
+    app.add_middleware(
+        RequestBodyCaptureMiddleware,
+        routes=[("POST", "/users"), ("POST", "/users/{username}/tags")],
+        max_bytes=settings.BODY_CAPTURE_MAX_BYTES,
+    )
 
-app.add_middleware(
-    RedisRateLimitMiddleware, redis_client=redis_client, max_calls=5, window_seconds=10
-)
+    # outermost, so rate-limited and failed requests are measured too
+    app.add_middleware(MetricsMiddleware)
+    return app
 
 
-@app.middleware("http")
-async def capture_request_body(request: Request, call_next):
-    request.scope["_body"] = await request.body()
-    return await call_next(request)
+app = create_app()
@@ -0,0 +1,54 @@
+# middleware/body_capture.py
+import re
+import typing as t
+
+from starlette.routing import compile_path
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class RequestBodyCaptureMiddleware:
+    """
+    Copies the request body into scope["_body"] as the app reads it.
+    - only for the opted-in (method, path template) routes
+    - the copy stops at max_bytes; scope["_body_truncated"] is then set
+    - the body is never read ahead of the app and the response is untouched
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        routes: t.Iterable[tuple[str, str]] = (),
+        max_bytes: int = 64 * 1024,
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self._routes: list[tuple[str, re.Pattern]] = [
+            (method.upper(), compile_path(path)[0]) for method, path in routes
+        ]
+
+    def _captures(self, scope: Scope) -> bool:
+        method, path = scope["method"], scope["path"]
+        return any(m == method and p.match(path) for m, p in self._routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self._captures(scope):
+            await self.app(scope, receive, send)
+            return
+
+        body = bytearray()
+        scope["_body"] = b""
+
+        async def capture() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                room = self.max_bytes - len(body)
+                if len(chunk) > room:
+                    scope["_body_truncated"] = True
+                body.extend(chunk[: max(0, room)])
+                if not message.get("more_body", False):
+                    scope["_body"] = bytes(body)
+            return message
+
+        await self.app(scope, capture, send)
@@ -4,9 +4,14 @@ import time
 import typing as t
 
 from redis.asyncio import Redis
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from redis.exceptions import NoScriptError, RedisError
 from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.core.breaker import CLOSED, CircuitBreaker, RedisUnavailableError
+from app.core.metrics import RATE_LIMIT_DECISIONS
+from app.middleware.rate_limit_policies import Limit, PolicyMatcher, RateLimitPolicy
+from app.repositories.api_key_store import key_id
 
 # Lua script: atomically prune old timestamps, add current, return (count, oldest_score_or_nil)
 # ARGV[1] = now (float)
@@ -36,107 +41,524 @@ end
 return {tostring(count), tostring(oldest or "nil")}
 """
 
+# Lua script: generic cell rate algorithm. State is one theoretical arrival
+# time (TAT) per key; `limit` calls may burst within `window`.
+# ARGV[1] = now (float)
+# ARGV[2] = window (seconds)
+# ARGV[3] = limit (int)
+# ARGV[4] = requested calls (int)
+# Return: table [granted, retry_after_seconds]
+GCRA_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local interval = window / limit
+local tat = tonumber(redis.call("GET", key)) or now
+if tat < now then
+  tat = now
+end
+local granted = math.min(requested, math.floor((now + window - tat) / interval + 1e-9))
+if granted <= 0 then
+  -- next slot opens once tat has moved back inside the window
+  return {0, tostring(tat - window + interval - now)}
+end
+tat = tat + granted * interval
+redis.call("SET", key, tostring(tat), "PX", math.ceil((tat - now) * 1000))
+return {granted, "0"}
+"""
+
+# Lua script: approximate sliding window built from the current and previous
+# fixed-window counters, weighted by how far into the current window we are.
+# State is one hash {w = window index, c = current count, p = previous count}.
+# Same ARGV and return value as GCRA_SCRIPT. Rejected calls are not counted.
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local index = math.floor(now / window)
+local into = now - index * window
+local state = redis.call("HMGET", key, "w", "c", "p")
+local w = tonumber(state[1])
+local cur = tonumber(state[2]) or 0
+local prev = tonumber(state[3]) or 0
+if w ~= index then
+  if w == index - 1 then
+    prev = cur
+  else
+    prev = 0
+  end
+  cur = 0
+end
+local estimate = prev * (1 - into / window) + cur
+local granted = math.min(requested, math.floor(limit - estimate))
+if granted <= 0 then
+  local retry = window - into
+  if cur < limit and prev > 0 then
+    -- previous window decays until the estimate drops to limit - 1
+    retry = math.max(0, (1 - (limit - 1 - cur) / prev) * window - into)
+  end
+  return {0, tostring(retry)}
+end
+redis.call("HSET", key, "w", index, "c", cur + granted, "p", prev)
+redis.call("PEXPIRE", key, math.ceil(window * 2000))
+return {granted, "0"}
+"""
+
+# Multi-limit variants: one call is checked against several limits (e.g. a
+# burst and a sustained one) in one round trip, and counted only if every
+# limit has room.
+# KEYS[i] = state of limit i
+# ARGV[1] = now (float), ARGV[2] = requested calls (int),
+# then ARGV[1 + 2i] = window of limit i, ARGV[2 + 2i] = its limit
+# Return: table [granted, retry_after_seconds]
+MULTI_GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local granted = tonumber(ARGV[2])
+local retry = 0
+local tats = {}
+for i, key in ipairs(KEYS) do
+  local window = tonumber(ARGV[1 + 2 * i])
+  local interval = window / tonumber(ARGV[2 + 2 * i])
+  local tat = math.max(tonumber(redis.call("GET", key)) or now, now)
+  local free = math.floor((now + window - tat) / interval + 1e-9)
+  if free <= 0 then
+    retry = math.max(retry, tat - window + interval - now)
+  end
+  granted = math.min(granted, free)
+  tats[i] = tat
+end
+if granted <= 0 then
+  return {0, tostring(retry)}
+end
+for i, key in ipairs(KEYS) do
+  local interval = tonumber(ARGV[1 + 2 * i]) / tonumber(ARGV[2 + 2 * i])
+  local tat = tats[i] + granted * interval
+  redis.call("SET", key, tostring(tat), "PX", math.ceil((tat - now) * 1000))
+end
+return {granted, "0"}
+"""
 
-class RedisRateLimitMiddleware(BaseHTTPMiddleware):
+MULTI_SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local granted = tonumber(ARGV[2])
+local retry = 0
+local states = {}
+for i, key in ipairs(KEYS) do
+  local window = tonumber(ARGV[1 + 2 * i])
+  local limit = tonumber(ARGV[2 + 2 * i])
+  local index = math.floor(now / window)
+  local into = now - index * window
+  local state = redis.call("HMGET", key, "w", "c", "p")
+  local w = tonumber(state[1])
+  local cur = tonumber(state[2]) or 0
+  local prev = tonumber(state[3]) or 0
+  if w ~= index then
+    if w == index - 1 then
+      prev = cur
+    else
+      prev = 0
+    end
+    cur = 0
+  end
+  local free = math.floor(limit - (prev * (1 - into / window) + cur))
+  if free <= 0 then
+    local wait = window - into
+    if cur < limit and prev > 0 then
+      wait = math.max(0, (1 - (limit - 1 - cur) / prev) * window - into)
+    end
+    retry = math.max(retry, wait)
+  end
+  granted = math.min(granted, free)
+  states[i] = {index, cur, prev, window}
+end
+if granted <= 0 then
+  return {0, tostring(retry)}
+end
+for i, key in ipairs(KEYS) do
+  local state = states[i]
+  redis.call("HSET", key, "w", state[1], "c", state[2] + granted, "p", state[3])
+  redis.call("PEXPIRE", key, math.ceil(state[4] * 2000))
+end
+return {granted, "0"}
+"""
+
+# Unlike LUA_SCRIPT, a rejected call is not logged, so it cannot keep a
+# limit that has room from recovering. ARGV[2] is ignored (always 1).
+MULTI_SLIDING_LOG_SCRIPT = """
+local now = tonumber(ARGV[1])
+local denied = false
+local retry = 0
+for i, key in ipairs(KEYS) do
+  local window = tonumber(ARGV[1 + 2 * i])
+  local limit = tonumber(ARGV[2 + 2 * i])
+  redis.call("ZREMRANGEBYSCORE", key, "-inf", now - window)
+  local count = redis.call("ZCARD", key)
+  if count >= limit then
+    -- room once enough of the oldest calls have left the window
+    local entry = redis.call("ZRANGE", key, count - limit, count - limit, "WITHSCORES")
+    denied = true
+    retry = math.max(retry, tonumber(entry[2]) + window - now)
+  end
+end
+if denied then
+  return {0, tostring(retry)}
+end
+local member = tostring(now) .. "-" .. tostring(math.random())
+for i, key in ipairs(KEYS) do
+  redis.call("ZADD", key, now, member)
+  redis.call("EXPIRE", key, math.ceil(tonumber(ARGV[1 + 2 * i])) + 2)
+end
+return {1, "0"}
+"""
+
+# Skip rate limiting for docs and openapi paths
+# whitelist all swagger/redoc resources
+PUBLIC_PATHS = frozenset(
+    {
+        "/docs",
+        "/openapi.json",
+        "/redoc",
+        "/favicon.ico",
+        "/metrics",
+        "/swagger-ui-bundle.js",
+        "/swagger-ui-init.js",
+        "/swagger-ui.css",
+    }
+)
+
+ALGORITHMS = {
+    "sliding_log": LUA_SCRIPT,
+    "gcra": GCRA_SCRIPT,
+    "sliding_window": SLIDING_WINDOW_SCRIPT,
+}
+
+MULTI_ALGORITHMS = {
+    "sliding_log": MULTI_SLIDING_LOG_SCRIPT,
+    "gcra": MULTI_GCRA_SCRIPT,
+    "sliding_window": MULTI_SLIDING_WINDOW_SCRIPT,
+}
+
+# what to do while Redis cannot decide: limit in-process ("local"), let
+# every call through ("open") or refuse every call with 503 ("closed")
+FAILURE_MODES = ("local", "open", "closed")
+
+
+class LocalRateLimiter:
+    """
+    In-process fixed-window limiter used while Redis is unavailable.
+    - approximate: windows are aligned, not sliding, and every worker
+      counts on its own, so a client may get up to one limit per worker
     """
-    Redis-backed sliding-window rate limiter.
+
+    def __init__(self, max_keys: int = 10_000):
+        self.max_keys = max_keys
+        # key of one limit -> [end of its current window, calls in it]; the
+        # limits' windows differ in length, so only their ends compare
+        self._windows: dict[str, list] = {}
+
+    def _counter(self, key: str, window: float, now: float) -> list:
+        counter = self._windows.get(key)
+        if counter is None or counter[0] <= now:
+            if len(self._windows) >= self.max_keys:
+                self._windows = {k: v for k, v in self._windows.items() if v[0] > now}
+                if len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+            end = (now // window + 1) * window
+            counter = self._windows[key] = [end, 0]
+        return counter
+
+    def hit(self, keys: list[str], limits: tuple, now: float) -> int | None:
+        """Seconds to wait, or None if the call is allowed (and counted by
+        every limit).
+        """
+        counters = []
+        retry_after = None
+        for key, limit in zip(keys, limits):
+            counter = self._counter(key, limit.window_seconds, now)
+            if counter[1] >= limit.max_calls:
+                wait = max(1, math.ceil(counter[0] - now))
+                retry_after = max(retry_after or 0, wait)
+            counters.append(counter)
+        if retry_after is not None:
+            return retry_after
+        for counter in counters:
+            counter[1] += 1
+        return None
+
+
+class TokenLeases:
+    """
+    Allowance leased from Redis in batches and spent locally by one worker.
+    - a lease is dropped once spent or after `ttl` seconds; unspent calls
+      are lost, so bigger leases trade accuracy for fewer round trips
+    - a key Redis rejected stays blocked locally until its retry time
+    """
+
+    def __init__(self, ttl: float, max_keys: int = 10_000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # key -> [tokens left, expires_at]; 0 tokens means blocked
+        self._leases: dict[str, list] = {}
+
+    def take(self, key: str, now: float) -> float | None:
+        """Seconds to wait (0 = allowed), or None if Redis has to decide."""
+        lease = self._leases.get(key)
+        if lease is None:
+            return None
+        if now >= lease[1]:
+            del self._leases[key]
+            return None
+        if lease[0] == 0:
+            return lease[1] - now
+        lease[0] -= 1
+        if lease[0] == 0:
+            del self._leases[key]
+        return 0.0
+
+    def grant(self, key: str, granted: int, now: float) -> None:
+        # the call that asked for the lease spends the first token
+        if granted > 1:
+            self._store(key, [granted - 1, now + self.ttl], now)
+
+    def block(self, key: str, retry_after: float, now: float) -> None:
+        if retry_after > 0:
+            self._store(key, [0, now + retry_after], now)
+
+    def _store(self, key: str, lease: list, now: float) -> None:
+        if len(self._leases) >= self.max_keys:
+            self._leases = {k: v for k, v in self._leases.items() if v[1] > now}
+            if len(self._leases) >= self.max_keys:
+                self._leases.clear()
+        self._leases[key] = lease
+
+
+class RedisRateLimitMiddleware:
+    """
+    Redis-backed sliding-window rate limiter, as a plain ASGI middleware
+    (allowed requests go straight to the app, the response is not wrapped).
     - key: based on identifier (ip or header)
     - window_seconds: sliding window
     - max_calls: max calls allowed in window
+    - policies: route-, method- and role-aware limits (see
+      app.middleware.rate_limit_policies); the first matching policy
+      applies. Defaults to a single policy of max_calls per window_seconds
+      for every route
+    - algorithm: "sliding_log" (exact, one sorted-set member per call),
+      "gcra" or "sliding_window" (approximate); the last two keep a
+      constant-size state per identifier and limit
+    - lease_size: with gcra/sliding_window, reserve this many calls per Redis
+      round trip and spend them locally for up to lease_ttl seconds
+    - breaker: the app's CircuitBreaker (defaults to app.state.breaker); its
+      "rate_limit" timeout bounds each check
+    - failure_mode: see FAILURE_MODES; applies while the circuit is open
+      and when a check fails
     """
 
     def __init__(
         self,
-        app,
-        redis_client: Redis,
+        app: ASGIApp,
+        redis_client: Redis | None = None,  # defaults to app.state.redis
         *,
         max_calls: int = 100,
         window_seconds: int = 60,
+        policies: t.Sequence[RateLimitPolicy] | None = None,
         key_prefix: str = "rl:",
         identifier_header: str | None = None,  # if set, use this header as identifier
+        algorithm: str = "sliding_log",
+        lease_size: int = 0,
+        lease_ttl: float = 1.0,
+        breaker: CircuitBreaker | None = None,
+        failure_mode: str = "local",
     ):
-        super().__init__(app)
+        self.app = app
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        if failure_mode not in FAILURE_MODES:
+            raise ValueError(f"Unknown rate limit failure mode: {failure_mode}")
+        if lease_size > 1 and algorithm == "sliding_log":
+            raise ValueError("Token leasing requires gcra or sliding_window")
+        if policies is None:
+            limit = Limit(int(max_calls), int(window_seconds))
+            policies = [RateLimitPolicy("default", (limit,))]
+        self.matcher = PolicyMatcher(policies)
+        self.lease_size = max(1, int(lease_size))
+        self.leases = TokenLeases(lease_ttl) if lease_size > 1 else None
+        self.algorithm = algorithm
+        self.script = ALGORITHMS[algorithm]
+        self.multi_script = MULTI_ALGORITHMS[algorithm]
         self.redis = redis_client
-        self.max_calls = int(max_calls)
-        self.window = int(window_seconds)
         self.prefix = key_prefix
         self.header = identifier_header
-        # we'll load the script once
-        self._sha: str | None = None
-
-    async def _ensure_script(self):
-        if self._sha is None:
-            self._sha = await self.redis.script_load(LUA_SCRIPT)
-
-    async def dispatch(self, request: Request, call_next):
-        # Skip rate limiting for docs and openapi paths
-        # whitelist all swagger/redoc resources
-        PUBLIC_PATHS = {
-            "/docs",
-            "/openapi.json",
-            "/redoc",
-            "/favicon.ico",
-            "/swagger-ui-bundle.js",
-            "/swagger-ui-init.js",
-            "/swagger-ui.css",
-        }
-        if request.url.path in PUBLIC_PATHS:
-            return await call_next(request)
-
-        redis = request.app.state.redis
-        if not hasattr(self, "_sha") or self._sha is None:
-            self._sha = await redis.script_load(LUA_SCRIPT)
-        identifier = request.client.host if request.client else "unknown"
-        api_key = request.headers.get("X-API-KEY")
-        print("API Key:", api_key)
-        key = f"rl:{api_key}" if api_key else f"rl:{identifier}"
-        print("Key:", key)
+        self.breaker = breaker
+        self.failure_mode = failure_mode
+        self.local = LocalRateLimiter()
+        # we'll load each script once
+        self._shas: dict[str, str] = {}
+
+    async def _eval(
+        self, redis: Redis, keys: list[str], policy: RateLimitPolicy, now: float
+    ):
+        script = self.script if len(keys) == 1 else self.multi_script
+        sha = self._shas.get(script)
+        if sha is None:
+            sha = self._shas[script] = await redis.script_load(script)
+        args = self._args(policy, now)
+        try:
+            return await redis.evalsha(sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # flushed or failed over: EVAL runs and caches the script again
+            return await redis.eval(script, len(keys), *keys, *args)
+
+    def _degraded(
+        self, keys: list[str], policy: RateLimitPolicy, now: float
+    ) -> Response | None:
+        """Decide without Redis, as failure_mode says."""
+        if self.failure_mode == "open":
+            return None
+        if self.failure_mode == "closed":
+            return JSONResponse({"detail": "rate limiter unavailable"}, status_code=503)
+        retry_after = self.local.hit(keys, policy.limits, now)
+        if retry_after is not None:
+            return self._too_many_requests(retry_after)
+        return None
+
+    def _args(self, policy: RateLimitPolicy, now: float) -> list[str]:
+        if len(policy.limits) > 1:
+            args = [str(now), str(self.lease_size)]
+            for limit in policy.limits:
+                args.extend((str(limit.window_seconds), str(limit.max_calls)))
+            return args
+        limit = policy.limits[0]
+        args = [str(now), str(limit.window_seconds), str(limit.max_calls)]
+        if self.algorithm != "sliding_log":
+            args.append(str(self.lease_size))  # calls requested
+        return args
+
+    @staticmethod
+    def _too_many_requests(retry_after: int) -> Response:
+        headers = {"Retry-After": str(retry_after)}
+        return JSONResponse(
+            {"detail": "Too Many Requests", "retry_after": retry_after},
+            status_code=429,
+            headers=headers,
+        )
+
+    def _retry_after(self, policy: RateLimitPolicy, result, now: float) -> int | None:
+        """Seconds to wait, or None if the call is allowed."""
+        if self.algorithm != "sliding_log" or len(policy.limits) > 1:
+            # result is [granted, retry_after]
+            if int(result[0]) > 0:
+                return None
+            return max(0, math.ceil(float(result[1])))
+
+        # result is [count_str, oldest_str_or_nil]
+        limit = policy.limits[0]
+        count = int(result[0])
+        oldest = None if result[1] == "nil" else float(result[1])
+        if count <= limit.max_calls:
+            return None
+        # compute retry_after: time until oldest + window - now
+        retry_after = 0
+        if oldest is not None:
+            remaining = (oldest + limit.window_seconds) - now
+            retry_after = max(0, math.ceil(remaining))
+        return retry_after
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in PUBLIC_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        key_class, identity, api_key = self._identify(scope)
+        role = None
+        if api_key is not None and self.matcher.uses_roles:
+            role = await self._role(scope, api_key)
+        policy = self.matcher.match(scope.get("method", ""), scope["path"], role)
+        if policy is None:  # no policy covers the route
+            await self.app(scope, receive, send)
+            return
+
+        response = await self._check(scope, self._keys(policy, identity), policy)
+        if response is None:  # allowed
+            RATE_LIMIT_DECISIONS.inc(key_class, "allowed")
+            await self.app(scope, receive, send)
+        else:
+            decision = "denied" if response.status_code == 429 else "unavailable"
+            RATE_LIMIT_DECISIONS.inc(key_class, decision)
+            await response(scope, receive, send)
+
+    def _identify(self, scope: Scope) -> tuple[str, str, str | None]:
+        """Return the kind of identifier ("api_key" or "ip"), the identifier
+        and the api key, if any. API keys are identified by their key id, so
+        the counters' key names do not reveal them.
+        """
+        for name, value in scope["headers"]:
+            if name == b"x-api-key" and value:
+                api_key = value.decode("latin-1")
+                return "api_key", key_id(api_key), api_key
+        client = scope.get("client")
+        return "ip", client[0] if client else "unknown", None
+
+    async def _role(self, scope: Scope, api_key: str) -> str | None:
+        """The role of the key, for role-specific policies. Unknown keys and
+        failed lookups get the policies of anonymous callers.
+        """
+        state = scope["app"].state
+        api_keys = getattr(state, "api_keys", None)
+        breaker = getattr(state, "breaker", None) or self.breaker
+        if api_keys is None or (breaker is not None and breaker.state != CLOSED):
+            return None
+        try:
+            return await api_keys.get_role(api_key)
+        except (RedisError, RedisUnavailableError):
+            return None
+
+    def _keys(self, policy: RateLimitPolicy, identity: str) -> list[str]:
+        # every policy counts on its own keys, so each has its own budget
+        key = f"{self.prefix}{policy.name}:{identity}"
+        if len(policy.limits) == 1:
+            return [key]
+        return [f"{key}:{i}" for i in range(len(policy.limits))]
+
+    async def _check(
+        self, scope: Scope, keys: list[str], policy: RateLimitPolicy
+    ) -> Response | None:
+        """Return the rejection response, or None if the call is allowed."""
+        if self.leases is not None:
+            wait = self.leases.take(keys[0], time.monotonic())
+            if wait == 0:
+                return None
+            if wait is not None:
+                return self._too_many_requests(math.ceil(wait))
+
+        # the lifespan-managed client shares the app's connection pool
+        state = scope["app"].state
+        redis = getattr(state, "redis", None) or self.redis
+        breaker = getattr(state, "breaker", None) or self.breaker
 
         now = (
             time.time()
         )  # use wall-clock seconds for keys (monotonic can be used but Redis needs comparable values)
-        # Call Lua script atomically. ARGV: now, window, limit
+        # Call Lua script atomically. ARGV: now, then the policy's limits
         try:
-            print("Redis key:", key)
-            print("now:", now, type(now))
-            print("window:", self.window, type(self.window))
-            print("max_calls:", self.max_calls, type(self.max_calls))
-            print("Connected Redis:", redis)
-            result = await redis.evalsha(
-                self._sha,
-                keys=[key],
-                args=[str(now), str(self.window), str(self.max_calls)],
-            )
-            # result is [count_str, oldest_str_or_nil]
-            count = int(result[0])
-            oldest = None if result[1] == "nil" else float(result[1])
-        except Exception as e:
-            # If script missing for some reason, try eval as fallback
-            try:
-                result = result = await redis.eval(
-                    LUA_SCRIPT, 1, key, now, self.window, self.max_calls
-                )
-                count = int(result[0])
-                oldest = None if result[1] == "nil" else float(result[1])
-            except Exception as ee:
-                # Redis failure -> fail-open (or fail-closed depending on policy)
-                return JSONResponse(
-                    {"detail": "rate limiter unavailable"}, status_code=503
-                )
-
-        if count > self.max_calls:
-            # compute retry_after: time until oldest + window - now
-            retry_after = 0
-            if oldest is not None:
-                remaining = (oldest + self.window) - now
-                retry_after = max(0, math.ceil(remaining))
-            headers = {"Retry-After": str(retry_after)}
-            return JSONResponse(
-                {"detail": "Too Many Requests", "retry_after": retry_after},
-                status_code=429,
-                headers=headers,
-            )
-
-        # allowed
-        response = await call_next(request)
-        return response
+            if breaker is None:
+                result = await self._eval(redis, keys, policy, now)
+            else:
+                async with breaker.guard("rate_limit"):
+                    result = await self._eval(redis, keys, policy, now)
+        except (RedisError, RedisUnavailableError):
+            return self._degraded(keys, policy, now)
+
+        retry_after = self._retry_after(policy, result, now)
+        if self.leases is not None:
+            if retry_after is None:
+                self.leases.grant(keys[0], int(result[0]), time.monotonic())
+            else:
+                self.leases.block(keys[0], float(result[1]), time.monotonic())
+        if retry_after is not None:
+            return self._too_many_requests(retry_after)
+        return None
@@ -0,0 +1,121 @@
+"""
+Declarative rate-limit policies and the matcher that picks one per request.
+- a policy applies to a route pattern, and optionally to some HTTP methods
+  and some API key roles; the first matching policy in declaration order
+  wins, and a request no policy matches is not limited
+- route patterns are matched against the raw path: "{name}" matches one
+  path segment, a trailing "*" matches the rest of the path
+- a policy holds one or more limits (e.g. a burst and a sustained one);
+  a call is allowed only if every limit has room
+- each policy has its own budget: its counters are keyed by its name
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Pattern, Sequence, Tuple
+
+ANY = "*"
+
+
+@dataclass(frozen=True)
+class Limit:
+    max_calls: int
+    window_seconds: float
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    name: str
+    limits: Tuple[Limit, ...]
+    path: str = ANY
+    methods: FrozenSet[str] = frozenset()  # empty: any method
+    roles: FrozenSet[str] = frozenset()  # empty: any caller, even anonymous
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, Any]) -> "RateLimitPolicy":
+        limits = tuple(
+            Limit(int(limit["max_calls"]), float(limit["window_seconds"]))
+            for limit in raw["limits"]
+        )
+        if not limits or any(l.max_calls < 1 or l.window_seconds <= 0 for l in limits):
+            raise ValueError(f"Policy {raw['name']} needs positive limits")
+        return cls(
+            name=raw["name"],
+            limits=limits,
+            path=raw.get("path", ANY),
+            methods=frozenset(m.upper() for m in raw.get("methods", ())),
+            roles=frozenset(raw.get("roles", ())),
+        )
+
+
+def load_policies(raw: Sequence[Dict[str, Any]]) -> List[RateLimitPolicy]:
+    """Build policies from settings, e.g. RATE_LIMIT_POLICIES."""
+    policies = [RateLimitPolicy.from_dict(entry) for entry in raw]
+    names = [policy.name for policy in policies]
+    if len(set(names)) != len(names):
+        raise ValueError("Rate limit policy names must be unique")
+    return policies
+
+
+def _path_regex(path: str) -> str:
+    rest = ""
+    if path.endswith(ANY):
+        path, rest = path[:-1], ".*"
+    parts = re.split(r"(\{[^}/]+\})", path)
+    return "".join("[^/]+" if p.startswith("{") else re.escape(p) for p in parts) + rest
+
+
+class PolicyMatcher:
+    """
+    Policies compiled for matching.
+    - every (method, role) combination the policies tell apart gets one
+      regex: an alternation of the applicable policies' path patterns, in
+      order, so a match is a single regex search
+    - methods and roles no policy names share the ANY / None entry, so the
+      compiled set is fixed at startup
+    """
+
+    def __init__(self, policies: Sequence[RateLimitPolicy]):
+        self.policies = list(policies)
+        self._methods = frozenset().union(*(p.methods for p in self.policies))
+        self._roles = frozenset().union(*(p.roles for p in self.policies))
+        # whether the caller's role has to be looked up at all
+        self.uses_roles = bool(self._roles)
+        self._compiled: Dict[
+            Tuple[str, Optional[str]], Tuple[Optional[Pattern], List[RateLimitPolicy]]
+        ] = {}
+        for method in (*self._methods, ANY):
+            for role in (*self._roles, None):
+                self._compiled[method, role] = self._compile(method, role)
+
+    def _compile(
+        self, method: str, role: Optional[str]
+    ) -> Tuple[Optional[Pattern], List[RateLimitPolicy]]:
+        applicable = [
+            policy
+            for policy in self.policies
+            if (not policy.methods or method in policy.methods)
+            and (not policy.roles or role in policy.roles)
+        ]
+        if not applicable:
+            return None, []
+        alternation = "|".join(
+            f"(?P<p{i}>{_path_regex(policy.path)})"
+            for i, policy in enumerate(applicable)
+        )
+        return re.compile(f"(?:{alternation})\\Z"), applicable
+
+    def match(
+        self, method: str, path: str, role: Optional[str] = None
+    ) -> Optional[RateLimitPolicy]:
+        if method not in self._methods:
+            method = ANY
+        if role not in self._roles:
+            role = None
+        pattern, applicable = self._compiled[method, role]
+        if pattern is None:
+            return None
+        found = pattern.match(path)
+        if found is None:
+            return None
+        return applicable[int(found.lastgroup[1:])]
@@ -0,0 +1,17 @@
+from typing import Dict
+
+from pydantic import BaseModel, Field
+
+
+class CreateApiKeyRequest(BaseModel):
+    role: str = Field(..., min_length=1, max_length=32, description="Role of the key")
+
+
+class CreatedApiKeyResponse(BaseModel):
+    api_key: str = Field(..., description="Shown once; only its id is stored")
+    key_id: str
+    role: str
+
+
+class ApiKeysResponse(BaseModel):
+    keys: Dict[str, str] = Field(..., description="Key id -> role")
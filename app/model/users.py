@@ -1,7 +1,7 @@
 import re
 import time
 from datetime import datetime
-from typing import List
+from typing import Dict, List
 
 from pydantic import BaseModel, Field, field_validator
 
@@ -59,6 +59,26 @@ class CreateUserResponse(BaseModel):
     processing_time: float
 
 
+class UsersPageResponse(BaseModel):
+    users: Dict[str, UserResponse]
+    next_cursor: str | None = None
+
+
+class TaggedUsernamesResponse(BaseModel):
+    usernames: List[str]
+    next_cursor: str | None = None
+
+
+class UserSearchResponse(BaseModel):
+    usernames: List[str]
+    users: Dict[str, UserResponse] | None = None
+
+
+class TagCountsResponse(BaseModel):
+    counts: Dict[str, int]
+    next_cursor: str | None = None
+
+
 class UsernameParam(BaseModel):
     username: str
 
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from app.core.breaker import CircuitBreaker, guarded
+
+logger = logging.getLogger(__name__)
+
+# Hash of key id -> role. Keys are stored as their SHA-256 (the key id), so
+# reading Redis or the admin listing never reveals a usable key.
+API_KEYS_KEY = "api_keys"
+
+# Pub/sub channel carrying {"key_ids": [...] | null} whenever keys change, so
+# every worker can drop them from its local cache.
+API_KEY_INVALIDATION_CHANNEL = "api_keys:invalidate"
+
+# Lua script: store the given keys, but only into an empty store, so a key
+# revoked at runtime is not brought back by the next worker that starts.
+# KEYS[1] = api keys hash
+# ARGV = key id/role pairs
+# Return: number of keys stored
+BOOTSTRAP_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+  return 0
+end
+redis.call("HSET", KEYS[1], unpack(ARGV))
+return #ARGV / 2
+"""
+
+
+def key_id(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class RedisApiKeyStore:
+    """
+    API keys and their roles, stored in Redis and cached in-process.
+    - a known key is cached for `cache_ttl` seconds and an unknown one for
+      `negative_cache_ttl`, so repeated lookups need no round trip
+    - adding or revoking a key is published on API_KEY_INVALIDATION_CHANNEL
+      and every worker drops it at once; the TTLs bound staleness if a
+      message is missed
+    - lookups run under the app's circuit breaker as "read", so an outage
+      fails fast with RedisUnavailableError; cached keys keep working, and
+      the cache is kept while the invalidation listener is disconnected
+    """
+
+    def __init__(
+        self,
+        *,
+        redis_client: redis.Redis,
+        cache_ttl: float = 30.0,
+        negative_cache_ttl: float = 5.0,
+        cache_max_entries: int = 10_000,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self._redis = redis_client
+        self._breaker = breaker
+        self._bootstrap_script = self._redis.register_script(BOOTSTRAP_SCRIPT)
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.cache_max_entries = cache_max_entries
+        # key id -> (expires at, role or None for an unknown key)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+        # moves on every invalidation, so a lookup that raced with one does
+        # not cache what it read
+        self._generation = 0
+        self._listener: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get_role(self, api_key: str) -> Optional[str]:
+        """Return the role of the key, or None if the key is not valid.
+        Raises RedisUnavailableError if an uncached key cannot be looked up.
+        """
+        if self._listener is None:
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        kid = key_id(api_key)
+        entry = self._entries.get(kid)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._entries.move_to_end(kid)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        generation = self._generation
+        role = await self._lookup(kid)
+        if generation == self._generation:
+            ttl = self.cache_ttl if role is not None else self.negative_cache_ttl
+            self._entries[kid] = (time.monotonic() + ttl, role)
+            self._entries.move_to_end(kid)
+            while len(self._entries) > self.cache_max_entries:
+                self._entries.popitem(last=False)
+        return role
+
+    @guarded("read")
+    async def _lookup(self, kid: str) -> Optional[str]:
+        return await self._redis.hget(API_KEYS_KEY, kid)
+
+    async def bootstrap(self, keys: Dict[str, str]) -> int:
+        """Seed an empty store with api key -> role pairs.
+        Returns the number of keys stored (0 if the store had keys).
+        """
+        if not keys:
+            return 0
+        args: List[str] = []
+        for api_key, role in keys.items():
+            args.extend((key_id(api_key), role))
+        return await self._bootstrap_script(keys=[API_KEYS_KEY], args=args)
+
+    @guarded("write")
+    async def create_key(self, role: str) -> Tuple[str, str]:
+        """Create a random key with the role. Returns (api key, key id);
+        the api key itself is not stored and cannot be read back.
+        """
+        api_key = secrets.token_urlsafe(32)
+        kid = key_id(api_key)
+        await self._redis.hset(API_KEYS_KEY, kid, role)
+        await self._invalidate([kid])
+        return api_key, kid
+
+    @guarded("write")
+    async def revoke(self, kid: str) -> bool:
+        """Revoke a key by its id. Returns False if there was no such key."""
+        removed = await self._redis.hdel(API_KEYS_KEY, kid)
+        await self._invalidate([kid])
+        return bool(removed)
+
+    @guarded("read")
+    async def list_keys(self) -> Dict[str, str]:
+        """Return key id -> role of every key."""
+        return await self._redis.hgetall(API_KEYS_KEY)
+
+    async def _invalidate(self, key_ids: Optional[List[str]]) -> None:
+        self._drop(key_ids)
+        message = {"key_ids": key_ids}
+        await self._redis.publish(API_KEY_INVALIDATION_CHANNEL, json.dumps(message))
+
+    def _drop(self, key_ids: Optional[List[str]]) -> None:
+        self._generation += 1
+        if key_ids is None:
+            self._entries.clear()
+            return
+        for kid in key_ids:
+            self._entries.pop(kid, None)
+
+    async def _listen(self) -> None:
+        disconnected = False
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(API_KEY_INVALIDATION_CHANNEL)
+                    if disconnected:
+                        # invalidations sent while unsubscribed are lost
+                        self._drop(None)
+                        disconnected = False
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._drop(json.loads(message["data"])["key_ids"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("api key invalidation listener failed")
+                # keep serving the cache while Redis is away; it is dropped
+                # once the listener is subscribed again
+                disconnected = True
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            # bounded: on Python 3.11 a cancel that races with an incoming
+            # message can be swallowed by the pub/sub read
+            await asyncio.wait([self._listener], timeout=1.0)
+            self._listener = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.cache_max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class UserCache:
+    """
+    Bounded in-process LRU cache for user records.
+    - entries expire after `ttl` seconds even without an invalidation
+    - `generation` moves on every invalidation, so a read that raced with
+      one can detect it and skip caching a stale value
+    - each entry keeps the record's version, if it has one, next to it
+    """
+
+    def __init__(self, *, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict, Optional[int]]]" = (
+            OrderedDict()
+        )
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, username: str) -> Optional[Dict]:
+        entry = self.get_versioned(username)
+        return None if entry is None else entry[0]
+
+    def get_versioned(self, username: str) -> Optional[Tuple[Dict, Optional[int]]]:
+        entry = self._entries.get(username)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return dict(entry[1]), entry[2]
+
+    def put(
+        self,
+        username: str,
+        user: Dict,
+        generation: int,
+        version: Optional[int] = None,
+    ) -> None:
+        if generation != self.generation:
+            return  # invalidated while the value was being fetched
+        self._entries[username] = (time.monotonic() + self.ttl, dict(user), version)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, usernames: Iterable[str]) -> None:
+        self.generation += 1
+        for username in usernames:
+            if self._entries.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
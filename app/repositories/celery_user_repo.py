@@ -1,45 +1,164 @@
 import json
-from datetime import datetime
+import uuid
+from typing import List, Optional, Tuple
 
 import redis
 
+from app.core.config import settings
+from app.repositories.sharding import Shard, cluster_shards, node_shards
+from app.repositories.user_repo import (
+    ACTIVITY_INDEX_KEY,
+    DELETE_BATCH_SIZE,
+    DELETE_INACTIVE_SCRIPT,
+    INVALIDATION_CHANNEL,
+    USER_KEY_PREFIX,
+)
+
+# Lua script: delete a lock key only if it still holds our token, so a run
+# whose lock expired cannot release the lock of the run that took over.
+# KEYS[1] = lock key, ARGV[1] = token
+# Return: 1 if released, 0 otherwise
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+  return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# (lowest, highest) last_active: lowest is inclusive, highest exclusive
+ScoreRange = Tuple[str, str]
+
+
+def _connect(url: str) -> redis.Redis:
+    return redis.Redis.from_url(
+        url,
+        decode_responses=False,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
 
 class RedisUserRepositorySync:
     def __init__(self):
-        self.redis = redis.Redis(host="localhost", port=6379, decode_responses=False)
+        # locks and invalidations stay on REDIS_URL; users live on the shards
+        # the API workers use (see app.repositories.sharding)
+        self.redis = _connect(settings.REDIS_URL)
+        if settings.REDIS_CLUSTER_URL:
+            cluster = redis.RedisCluster.from_url(
+                settings.REDIS_CLUSTER_URL, decode_responses=False
+            )
+            self.shards = cluster_shards(cluster, settings.REDIS_CLUSTER_SHARDS)
+        elif settings.REDIS_SHARD_URLS:
+            self.shards = node_shards(
+                {url: _connect(url) for url in settings.REDIS_SHARD_URLS}
+            )
+        else:
+            self.shards = [Shard("default", self.redis)]
+        self._shards_by_name = {shard.name: shard for shard in self.shards}
+        self._delete_inactive_script = self.redis.register_script(
+            DELETE_INACTIVE_SCRIPT
+        )
+        self._release_lock_script = self.redis.register_script(RELEASE_LOCK_SCRIPT)
 
-    def delete_inactive_users(self, inactive_since: float) -> int:
+    def _shard(self, name: Optional[str]) -> Shard:
+        return self.shards[0] if name is None else self._shards_by_name[name]
+
+    def inactive_partitions(
+        self, inactive_since: float, partitions: int, shard: Optional[str] = None
+    ) -> List[ScoreRange]:
         """
-        Delete users whose last_active timestamp is older than inactive_since.
-        inactive_since: Unix timestamp (float)
+        Split the users of a shard (default: the first) inactive since
+        inactive_since into up to `partitions` disjoint last_active ranges of
+        about the same size.
+        - boundaries are scores, not ranks, so they stay disjoint while other
+          partitions delete concurrently
+        - the ranges cover everything below the cutoff, users that go
+          inactive after planning included
         """
-        deleted_count = 0
-        cursor = 0
+        shard = self._shard(shard)
+        index_key = shard.key(ACTIVITY_INDEX_KEY)
+        cutoff = f"({inactive_since}"
+        total = shard.redis.zcount(index_key, "-inf", cutoff)
+        if total == 0:
+            return []
+        partitions = max(1, min(partitions, total))
 
-        while True:
-            cursor, keys = self.redis.scan(cursor=cursor, match="user:*", count=100)
+        # the lowest score, then the score at every partition boundary
+        with shard.redis.pipeline(transaction=False) as pipe:
+            for i in range(partitions):
+                pipe.zrangebyscore(
+                    index_key,
+                    "-inf",
+                    cutoff,
+                    start=total * i // partitions,
+                    num=1,
+                    withscores=True,
+                )
+            found = [entries[0][1] for entries in pipe.execute() if entries]
+        if not found:
+            return []
+        lowest = found[0]
+        bounds = ["-inf"]
+        bounds.extend(repr(score) for score in found[1:])
+        bounds.append(repr(float(inactive_since)))
+        # tied scores give empty ranges; the first one kept starts at -inf
+        ranges = [
+            (low, high)
+            for low, high in zip(bounds, bounds[1:])
+            if low != high and float(high) > lowest
+        ]
+        ranges[0] = ("-inf", ranges[0][1])
+        return ranges
 
-            for key in keys:
-                value = self.redis.get(key)
-                if not value:
-                    continue
+    def delete_inactive_range(
+        self, lowest: str, highest: str | float, shard: Optional[str] = None
+    ) -> int:
+        """Delete users of a shard (default: the first) whose last_active is
+        in [lowest, highest), in batches inside Redis.
+        Returns the number of users deleted.
+        """
+        shard = self._shard(shard)
+        deleted_count = 0
 
-                user = json.loads(value.decode("utf-8"))
-                raw = user.get("last_active")
+        while True:
+            removed, deleted = self._delete_inactive_script(
+                keys=[shard.key(ACTIVITY_INDEX_KEY)],
+                args=[highest, DELETE_BATCH_SIZE, shard.key(USER_KEY_PREFIX), lowest],
+                client=shard.redis,
+            )
+            deleted_count += deleted
+            if removed < DELETE_BATCH_SIZE:
+                break
+        return deleted_count
 
-                if raw is None:
-                    last_active = 0.0
-                elif isinstance(raw, (int, float)):
-                    last_active = float(raw)
-                else:
-                    # ISO string → timestamp
-                    last_active = datetime.fromisoformat(raw).timestamp()
+    def delete_inactive_users(self, inactive_since: float) -> int:
+        """
+        Delete users whose last_active timestamp is older than inactive_since.
+        inactive_since: Unix timestamp (float)
+        """
+        deleted_count = sum(
+            self.delete_inactive_range("-inf", inactive_since, shard.name)
+            for shard in self.shards
+        )
+        if deleted_count:
+            self.invalidate_all()
+        return deleted_count
 
-                if last_active < inactive_since:
-                    self.redis.delete(key)
-                    deleted_count += 1
+    def invalidate_all(self) -> None:
+        # drop every API worker's cached users
+        message = {"origin": "celery", "usernames": None}
+        self.redis.publish(INVALIDATION_CHANNEL, json.dumps(message))
 
-            if cursor == 0:
-                break
+    def acquire_lock(self, key: str, ttl: int) -> Optional[str]:
+        """Take a lock that expires after ttl seconds.
+        Returns the token that releases it, or None if it is held.
+        """
+        token = uuid.uuid4().hex
+        if self.redis.set(key, token, nx=True, ex=ttl):
+            return token
+        return None
 
-        return deleted_count
+    def release_lock(self, key: str, token: str) -> bool:
+        return bool(self._release_lock_script(keys=[key], args=[token]))
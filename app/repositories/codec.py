@@ -0,0 +1,72 @@
+"""
+Codecs for values the repository stores as one Redis string (user records,
+cached idempotent responses).
+- "json": JSON through orjson, readable by anything that read the old
+  json.dumps records
+- "msgpack": MessagePack behind a two-byte marker; 0xc1 is never used by
+  MessagePack or JSON, the second byte is the format version
+decode() detects the format from the data, so switching codecs needs no
+migration: old records stay readable and take the new format on their
+next write.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Type
+
+import orjson
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed by the msgpack codec
+    msgpack = None
+
+MSGPACK_MARKER = b"\xc1\x01"
+
+
+def _require_msgpack() -> None:
+    if msgpack is None:
+        raise RuntimeError("The msgpack codec requires the msgpack package")
+
+
+def decode(data: bytes | str) -> Any:
+    """Decode a value written by any codec."""
+    if isinstance(data, bytes) and data.startswith(MSGPACK_MARKER):
+        _require_msgpack()
+        return msgpack.unpackb(data[len(MSGPACK_MARKER) :])
+    return orjson.loads(data)
+
+
+class Codec(ABC):
+    name = ""
+
+    @abstractmethod
+    def encode(self, value: Any) -> bytes: ...
+
+    def decode(self, data: bytes | str) -> Any:
+        return decode(data)
+
+
+class JSONCodec(Codec):
+    name = "json"
+
+    def encode(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def __init__(self):
+        _require_msgpack()
+
+    def encode(self, value: Any) -> bytes:
+        return MSGPACK_MARKER + msgpack.packb(value)
+
+
+CODECS: Dict[str, Type[Codec]] = {"json": JSONCodec, "msgpack": MsgpackCodec}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec: {name}")
+    return CODECS[name]()
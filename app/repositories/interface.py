@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 
 class UserRepository(ABC):
@@ -13,14 +13,65 @@ class UserRepository(ABC):
     async def create_user(self, user: Dict) -> None: ...
 
     @abstractmethod
-    async def get_user(self, username: str) -> Optional[Dict]: ...
+    async def create_user_idempotent(
+        self, user: Dict, idempotency_key: str, response: Dict, ttl: int
+    ) -> Optional[Dict]: ...
 
     @abstractmethod
-    async def add_tag(self, username: str, tag: str) -> Dict: ...
+    async def bulk_create_users(self, users: List[Dict]) -> List[bool]: ...
+
+    @abstractmethod
+    async def get_user(
+        self, username: str, primary: bool = False
+    ) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def get_user_versioned(
+        self,
+        username: str,
+        known_version: Optional[int] = None,
+        primary: bool = False,
+    ) -> Tuple[Optional[int], Optional[Dict]]: ...
+
+    @abstractmethod
+    async def collection_version(self) -> int: ...
+
+    @abstractmethod
+    async def get_users(self, usernames: List[str]) -> Dict[str, Dict]: ...
+
+    @abstractmethod
+    async def add_tag(
+        self, username: str, tags: List[str], if_version: Optional[int] = None
+    ) -> Optional[Dict]: ...
 
     @abstractmethod
     async def list_users(self) -> Dict[str, Dict]: ...
 
+    @abstractmethod
+    async def list_users_page(
+        self, cursor: int = 0, count: int = 100
+    ) -> Tuple[Dict[str, Dict], int]: ...
+
+    @abstractmethod
+    def iter_users(self, batch_size: int = 100) -> AsyncIterator[Dict]: ...
+
+    @abstractmethod
+    async def search_usernames(self, prefix: str, count: int = 20) -> List[str]: ...
+
+    @abstractmethod
+    async def list_usernames_by_tags(
+        self,
+        tags: List[str],
+        match: str = "all",
+        cursor: Optional[str] = None,
+        count: int = 100,
+    ) -> Tuple[List[str], Optional[str]]: ...
+
+    @abstractmethod
+    async def tag_counts(
+        self, tags: Optional[List[str]] = None, cursor: int = 0, count: int = 100
+    ) -> Tuple[Dict[str, int], int]: ...
+
     @abstractmethod
     async def delete_user(self, username: str) -> None: ...
 
@@ -32,3 +83,9 @@ class UserRepository(ABC):
 
     @abstractmethod
     async def touch_user(self, username: str) -> None: ...
+
+    @abstractmethod
+    async def close(self) -> None: ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Dict]: ...
@@ -0,0 +1,153 @@
+"""
+Routing of read-only repository operations to Redis replicas.
+- every shard may have replicas; reads rotate over the healthy ones and
+  writes always go to the shard's primary
+- a replica that fails with a connection error or a timeout is ejected
+  for `eject_seconds` and the read is retried on the primary
+- read-your-writes is opt-in: after a mutation, the reads of the same
+  session (the caller's API key) go to the primary for `window` seconds.
+  The window is kept per worker, so it holds for a session served by one
+  worker, and replication lag beyond it is not hidden
+- within same_replicas(), the reads of a shard all go to one replica, so
+  that what a request reads (say a version and a page) is one state
+"""
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+# errors that eject a replica; anything else is a real error and is raised
+REPLICA_ERRORS = (ConnectionError, TimeoutError)
+
+# who the current request reads for; set by the API key dependency
+read_session: ContextVar[Optional[str]] = ContextVar("read_session", default=None)
+
+# the replica each replica set serves the current block from; see same_replicas
+_chosen: ContextVar[Optional[Dict["ReplicaSet", Any]]] = ContextVar(
+    "chosen_replicas", default=None
+)
+
+
+class ReplicaSet:
+    """The replicas of one primary, picked round robin among the healthy."""
+
+    def __init__(self, replicas: Sequence[Any], eject_seconds: float = 10.0):
+        self.replicas = list(replicas)
+        self.eject_seconds = eject_seconds
+        self._ejected_until = [0.0] * len(self.replicas)
+        self._next = 0
+        self.reads = 0
+        self.ejections = 0
+
+    def pick(self) -> Optional[Any]:
+        """Return the next healthy replica, or None to read from the primary."""
+        chosen = _chosen.get()
+        if chosen is not None and self in chosen:
+            return self._reuse(chosen[self])
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+            if self._ejected_until[index] <= now:
+                return self._choose(index)
+        return None
+
+    def get(self, index: int) -> Optional[Any]:
+        """Return replica `index` if it is healthy; used to resume a scan."""
+        chosen = _chosen.get()
+        if chosen is not None and self in chosen:
+            return self._reuse(chosen[self])
+        if (
+            index < len(self.replicas)
+            and self._ejected_until[index] <= time.monotonic()
+        ):
+            return self._choose(index)
+        return None
+
+    def _choose(self, index: int) -> Any:
+        self.reads += 1
+        chosen = _chosen.get()
+        if chosen is not None:
+            chosen[self] = self.replicas[index]
+        return self.replicas[index]
+
+    def _reuse(self, replica: Any) -> Optional[Any]:
+        # once ejected, the primary serves the rest: it is never behind
+        if self._ejected_until[self.index(replica)] > time.monotonic():
+            return None
+        self.reads += 1
+        return replica
+
+    def index(self, replica: Any) -> int:
+        return self.replicas.index(replica)
+
+    def eject(self, replica: Any) -> None:
+        self._ejected_until[self.index(replica)] = time.monotonic() + self.eject_seconds
+        self.ejections += 1
+
+    def healthy(self) -> int:
+        now = time.monotonic()
+        return sum(until <= now for until in self._ejected_until)
+
+
+class ReadYourWrites:
+    """Remembers, per session, until when its reads must see its writes."""
+
+    def __init__(self, window: float, max_sessions: int = 10_000):
+        self.window = window
+        self.max_sessions = max_sessions
+        self._pinned: "OrderedDict[str, float]" = OrderedDict()
+
+    def wrote(self) -> None:
+        session = read_session.get()
+        if self.window <= 0 or session is None:
+            return
+        self._pinned[session] = time.monotonic() + self.window
+        self._pinned.move_to_end(session)
+        while len(self._pinned) > self.max_sessions:
+            self._pinned.popitem(last=False)
+
+    def pinned(self) -> bool:
+        session = read_session.get()
+        if session is None:
+            return False
+        until = self._pinned.get(session)
+        if until is None:
+            return False
+        if until > time.monotonic():
+            return True
+        del self._pinned[session]
+        return False
+
+
+@contextmanager
+def session(name: Optional[str]) -> Iterator[None]:
+    """Run the enclosed reads and writes as session `name`."""
+    token = read_session.set(name)
+    try:
+        yield
+    finally:
+        read_session.reset(token)
+
+
+@contextmanager
+def same_replicas() -> Iterator[None]:
+    """Serve the enclosed reads of each shard from a single replica."""
+    token = _chosen.set({})
+    try:
+        yield
+    finally:
+        _chosen.reset(token)
+
+
+def replica_stats(replica_sets: List[ReplicaSet]) -> Dict[str, int]:
+    return {
+        "replicas": sum(len(r.replicas) for r in replica_sets),
+        "healthy": sum(r.healthy() for r in replica_sets),
+        "reads": sum(r.reads for r in replica_sets),
+        "ejections": sum(r.ejections for r in replica_sets),
+    }
@@ -0,0 +1,79 @@
+"""
+Placement of users on Redis shards.
+- a shard is a client plus a key namespace; a user's record and its index
+  entries always live on the user's shard, so every script stays on one
+  node (and, on Redis Cluster, one slot)
+- independent nodes (REDIS_SHARD_URLS) are one shard each and keep the
+  plain key names
+- on Redis Cluster the shards are hash-tag namespaces ("{users-3}:") of
+  one cluster client
+- users are placed on a consistent hash ring, so adding a node moves only
+  about 1/N of them
+- a shard may list replicas of its node for reads (see
+  app.repositories.replicas)
+"""
+
+import bisect
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+RING_REPLICAS = 128  # points per shard on the ring
+
+
+@dataclass(frozen=True)
+class Shard:
+    name: str
+    redis: Any  # redis.Redis, redis.asyncio.Redis or a cluster client
+    namespace: str = ""
+    replicas: Tuple[Any, ...] = ()
+
+    def key(self, name: str) -> str:
+        return self.namespace + name
+
+    def strip(self, key: str, prefix: str) -> str:
+        """Return what follows namespace + prefix in key."""
+        return key[len(self.namespace) + len(prefix) :]
+
+
+def _point(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, names: Sequence[str], replicas: int = RING_REPLICAS):
+        if not names:
+            raise ValueError("A hash ring needs at least one shard")
+        points = sorted(
+            (_point(f"{name}#{replica}"), index)
+            for index, name in enumerate(names)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [owner for _, owner in points]
+        self._single = len(names) == 1
+
+    def index(self, key: str) -> int:
+        """Return the index of the shard that owns key."""
+        if self._single:
+            return 0
+        position = bisect.bisect(self._points, _point(key)) % len(self._points)
+        return self._owners[position]
+
+
+def node_shards(
+    clients: Dict[str, Any], replicas: Optional[Dict[str, Sequence[Any]]] = None
+) -> List[Shard]:
+    """One shard per independent node, keyed by a stable name (its URL), so
+    the placement survives restarts and reordering of the node list.
+    """
+    replicas = replicas or {}
+    return [
+        Shard(name, client, replicas=tuple(replicas.get(name, ())))
+        for name, client in clients.items()
+    ]
+
+
+def cluster_shards(client: Any, count: int) -> List[Shard]:
+    """`count` hash-tag namespaces of one Redis Cluster client."""
+    return [Shard(f"users-{i}", client, f"{{users-{i}}}:") for i in range(count)]
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable
+
+from app.core.metrics import SINGLE_FLIGHT_CALLS
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls within one worker.
+    - the first caller for a key starts the call; callers arriving while it
+      is in flight await the same result (or exception) instead of
+      starting their own
+    - the call runs in its own task, so a cancelled caller does not cancel
+      it for the others
+    - forget() detaches keys from their call, so callers arriving after a
+      write do not join a read that started before it
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            SINGLE_FLIGHT_CALLS.inc(self.operation, "called")
+            task = asyncio.get_running_loop().create_task(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.shared += 1
+            SINGLE_FLIGHT_CALLS.inc(self.operation, "shared")
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if every caller went away
+
+    def forget(self, keys: Iterable[Hashable]) -> None:
+        for key in keys:
+            self._calls.pop(key, None)
+
+    def forget_all(self) -> None:
+        self._calls.clear()
+
+    def in_flight(self) -> Iterable[Hashable]:
+        return list(self._calls)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._calls),
+        }
@@ -1,131 +1,1431 @@
+import asyncio
+import hashlib
+import heapq
 import json
+import logging
+import uuid
+from dataclasses import replace
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional
+from itertools import islice
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+import orjson
 import redis.asyncio as redis
+from redis.asyncio.client import NEVER_DECODE
+from redis.commands.core import AsyncScript
+from redis.exceptions import NoScriptError
 
+from app.core.breaker import CircuitBreaker, guarded
+from app.repositories.cache import UserCache
+from app.repositories.codec import decode, get_codec
 from app.repositories.interface import UserRepository
+from app.repositories.replicas import (
+    REPLICA_ERRORS,
+    ReadYourWrites,
+    ReplicaSet,
+    replica_stats,
+)
+from app.repositories.sharding import HashRing, Shard
+from app.repositories.single_flight import SingleFlight
+from app.repositories.write_behind import LastActiveBuffer
+
+logger = logging.getLogger(__name__)
+
+USER_KEY_PREFIX = "user:"
+
+# Pub/sub channel carrying {"origin": ..., "usernames": [...] | null} whenever
+# users change, so every worker can drop them from its local cache.
+INVALIDATION_CHANNEL = "users:invalidate"
+
+# Sorted set of username -> last_active (unix seconds). Users that were never
+# touched score 0, matching the semantics of the old full-keyspace scan.
+ACTIVITY_INDEX_KEY = "users:last_active"
+
+# Sorted set of every username, all scored 0 so it is ordered by username:
+# a prefix is one contiguous ZRANGE BYLEX range.
+USERNAME_INDEX_KEY = "users:names"
+
+# Lua prelude of the scripts that use index keys they are not passed. The
+# shard namespace ("{hash tag}:" on Redis Cluster, "" otherwise) is read
+# from KEYS[1], so those keys stay in the slot of the user's own keys.
+NAMESPACE_LUA = """
+local NS = string.match(KEYS[1], "^{[^}]*}:") or ""
+"""
+
+# Lua helpers prepended to the scripts that create or delete users.
+USERNAME_INDEX_LUA = f"""
+local function index_name(name)
+  redis.call("ZADD", NS .. "{USERNAME_INDEX_KEY}", 0, name)
+end
+
+local function unindex_names(names)
+  redis.call("ZREM", NS .. "{USERNAME_INDEX_KEY}", unpack(names))
+end
+"""
+
+# Versions for conditional reads. Every change to the users increments
+# COLLECTION_VERSION_KEY, and a changed user takes the new value as its
+# version in the USER_VERSIONS_KEY hash. Versions are never reused, not even
+# after delete_all or when a deleted username is created again.
+# last_active is not versioned: reads touch the user, so versioning it would
+# change the version on every read.
+USER_VERSIONS_KEY = "users:versions"
+COLLECTION_VERSION_KEY = "users:version"
+
+# Lua helpers prepended to the scripts that change users.
+VERSION_LUA = f"""
+local function bump_version(name)
+  local version = redis.call("INCR", NS .. "{COLLECTION_VERSION_KEY}")
+  redis.call("HSET", NS .. "{USER_VERSIONS_KEY}", name, version)
+end
+
+local function drop_versions(names)
+  redis.call("HDEL", NS .. "{USER_VERSIONS_KEY}", unpack(names))
+  redis.call("INCR", NS .. "{COLLECTION_VERSION_KEY}")
+end
+"""
+
+# Tag reverse index, kept in step with the users by the scripts below:
+# - TAG_KEY_PREFIX + tag: sorted set of the tag's usernames, all scored 0 so
+#   they page in username order
+# - TAG_COUNTS_KEY: sorted set of tag -> number of users
+# - USER_TAGS_KEY: hash of username -> JSON list of its indexed tags, so a
+#   user can be unindexed without reading (or decoding) its record
+TAG_KEY_PREFIX = "users:tag:"
+TAG_COUNTS_KEY = "users:tag_counts"
+USER_TAGS_KEY = "users:tags"
+
+# Multi-tag queries are stored under TAG_QUERY_KEY_PREFIX for TAG_QUERY_TTL
+# seconds, so later pages read the same snapshot as the first one.
+TAG_QUERY_KEY_PREFIX = "users:tag_query:"
+TAG_QUERY_TTL = 60
+TAG_MATCHES = ("all", "any")
+
+# Lua helpers prepended to the scripts that change a user's tags.
+TAG_INDEX_LUA = f"""
+local function untag_user(name)
+  local indexed = redis.call("HGET", NS .. "{USER_TAGS_KEY}", name)
+  if not indexed then
+    return
+  end
+  for _, tag in ipairs(cjson.decode(indexed)) do
+    if redis.call("ZREM", NS .. "{TAG_KEY_PREFIX}" .. tag, name) == 1 then
+      local left = redis.call("ZINCRBY", NS .. "{TAG_COUNTS_KEY}", -1, tag)
+      if tonumber(left) <= 0 then
+        redis.call("ZREM", NS .. "{TAG_COUNTS_KEY}", tag)
+      end
+    end
+  end
+  redis.call("HDEL", NS .. "{USER_TAGS_KEY}", name)
+end
+
+local function tag_user(name, encoded_tags)
+  untag_user(name)
+  local tags = cjson.decode(encoded_tags)
+  if #tags == 0 then
+    return
+  end
+  for _, tag in ipairs(tags) do
+    if redis.call("ZADD", NS .. "{TAG_KEY_PREFIX}" .. tag, 0, name) == 1 then
+      redis.call("ZINCRBY", NS .. "{TAG_COUNTS_KEY}", 1, tag)
+    end
+  end
+  redis.call("HSET", NS .. "{USER_TAGS_KEY}", name, encoded_tags)
+end
+"""
+
+# Lua script: create a user only if it does not exist, index it and, when an
+# idempotency key is given, cache the response under it, all atomically.
+# A request replayed with the same idempotency key gets the cached response.
+# KEYS[1] = user key, KEYS[2] = activity index, KEYS[3] = idempotency key (optional)
+# ARGV[1] = username, ARGV[2] = last_active score, ARGV[3] = storage layout
+# ARGV[4] = idempotency ttl, ARGV[5] = encoded response to cache
+# ARGV[6] = JSON list of tags
+# ARGV[7..] = encoded user ("json") or field/value pairs for HSET ("hash")
+# Return: {1} if created, {0} if the user already exists, {2, cached} on replay
+CREATE_USER_SCRIPT = (
+    NAMESPACE_LUA + VERSION_LUA + USERNAME_INDEX_LUA + TAG_INDEX_LUA + """
+if #KEYS > 2 then
+  local cached = redis.call("GET", KEYS[3])
+  if cached then
+    return {2, cached}
+  end
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+  return {0}
+end
+if ARGV[3] == "hash" then
+  redis.call("HSET", KEYS[1], unpack(ARGV, 7))
+else
+  redis.call("SET", KEYS[1], ARGV[7])
+end
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+index_name(ARGV[1])
+tag_user(ARGV[1], ARGV[6])
+bump_version(ARGV[1])
+if #KEYS > 2 then
+  redis.call("SET", KEYS[3], ARGV[5], "EX", ARGV[4])
+end
+return {1}
+"""
+)
+
+# Lua script: store the tags of an existing user and re-index them in the
+# same step.
+# KEYS[1] = user key
+# ARGV[1] = username, ARGV[2] = JSON list of tags
+# ARGV[3] = what to store (optional): "hash" to set the tags field of a
+#           hash-stored user, or the encoded user of the string layout;
+#           without it the user is only re-indexed
+# ARGV[4] = version the caller read, 0 for none (optional): nothing is
+#           stored if the user changed since
+# Return: {0} if the user does not exist, {-1} with "hash" if the user is
+#         still stored as a JSON string, {-2} if its version changed,
+#         {1} once stored, or with "hash" {1, field, value, ...} of the
+#         updated user
+SET_USER_TAGS_SCRIPT = NAMESPACE_LUA + VERSION_LUA + TAG_INDEX_LUA + f"""
+local kind = redis.call("TYPE", KEYS[1]).ok
+if kind == "none" then
+  return {{0}}
+end
+if ARGV[4] then
+  local version = redis.call("HGET", NS .. "{USER_VERSIONS_KEY}", ARGV[1])
+  if (tonumber(version) or 0) ~= tonumber(ARGV[4]) then
+    return {{-2}}
+  end
+end
+if ARGV[3] == "hash" then
+  if kind ~= "hash" then
+    return {{-1}}
+  end
+  redis.call("HSET", KEYS[1], "tags", ARGV[2])
+elseif ARGV[3] then
+  redis.call("SET", KEYS[1], ARGV[3])
+end
+tag_user(ARGV[1], ARGV[2])
+bump_version(ARGV[1])
+if ARGV[3] == "hash" then
+  local reply = redis.call("HGETALL", KEYS[1])
+  table.insert(reply, 1, 1)
+  return reply
+end
+return {{1}}
+"""
+
+# Lua script: delete a user and drop it from every index.
+# KEYS[1] = user key, KEYS[2] = activity index
+# ARGV[1] = username
+# Return: 1 if deleted, 0 if the user did not exist
+DELETE_USER_SCRIPT = (
+    NAMESPACE_LUA + VERSION_LUA + USERNAME_INDEX_LUA + TAG_INDEX_LUA + """
+redis.call("ZREM", KEYS[2], ARGV[1])
+unindex_names({ARGV[1]})
+untag_user(ARGV[1])
+local deleted = redis.call("DEL", KEYS[1])
+if deleted == 1 then
+  drop_versions({ARGV[1]})
+end
+return deleted
+"""
+)
+
+# Lua script: delete one batch of users whose last_active is older than cutoff.
+# KEYS[1] = activity index
+# ARGV[1] = cutoff (exclusive), ARGV[2] = batch size, ARGV[3] = user key prefix
+# ARGV[4] = lowest last_active to delete (inclusive, optional, default -inf)
+# Return: {index entries removed, user keys deleted}
+DELETE_INACTIVE_SCRIPT = (
+    NAMESPACE_LUA + VERSION_LUA + USERNAME_INDEX_LUA + TAG_INDEX_LUA + """
+local names = redis.call(
+  "ZRANGEBYSCORE", KEYS[1], ARGV[4] or "-inf", "(" .. ARGV[1],
+  "LIMIT", 0, tonumber(ARGV[2])
+)
+local deleted = 0
+for _, name in ipairs(names) do
+  deleted = deleted + redis.call("UNLINK", ARGV[3] .. name)
+  untag_user(name)
+end
+if #names > 0 then
+  redis.call("ZREM", KEYS[1], unpack(names))
+  unindex_names(names)
+  drop_versions(names)
+end
+return {#names, deleted}
+"""
+)
+
+# Lua script: read a user and its version, skipping the record when the
+# caller already holds that version.
+# KEYS[1] = user key, KEYS[2] = user versions hash
+# ARGV[1] = username, ARGV[2] = version the caller holds (optional)
+# Return: {0} if the user does not exist, {1, version} if unchanged,
+#         {2, version, string} or {3, version, field, value, ...}
+#         (version is nil for users written before versioning)
+READ_USER_SCRIPT = """
+local version = redis.call("HGET", KEYS[2], ARGV[1])
+local kind = redis.call("TYPE", KEYS[1]).ok
+if kind == "none" then
+  return {0}
+end
+if version and version == ARGV[2] then
+  return {1, version}
+end
+if kind == "hash" then
+  local reply = redis.call("HGETALL", KEYS[1])
+  table.insert(reply, 1, version)
+  table.insert(reply, 1, 3)
+  return reply
+end
+return {2, version, redis.call("GET", KEYS[1])}
+"""
+
+# Lua script: set last_active of a hash-stored user and re-index it.
+# KEYS[1] = user key, KEYS[2] = activity index
+# ARGV[1] = username, ARGV[2] = last_active score, ARGV[3] = encoded last_active
+# Return: 1 if updated, 0 if the user does not exist,
+#         -1 if the user is still stored as a JSON string
+TOUCH_USER_HASH_SCRIPT = """
+local kind = redis.call("TYPE", KEYS[1]).ok
+if kind == "hash" then
+  redis.call("HSET", KEYS[1], "last_active", ARGV[3])
+  redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+  return 1
+elseif kind == "none" then
+  return 0
+end
+return -1
+"""
+
+# Lua script: store a string-stored user with a new last_active and re-index
+# it, unless the string changed since it was read.
+# KEYS[1] = user key, KEYS[2] = activity index
+# ARGV[1] = username, ARGV[2] = last_active score, ARGV[3] = string as read,
+# ARGV[4] = updated string
+# Return: 1 if written, 0 if the user is gone or no longer a string,
+#         -1 if it changed since it was read
+TOUCH_USER_JSON_SCRIPT = """
+if redis.call("TYPE", KEYS[1]).ok ~= "string" then
+  return 0
+end
+if redis.call("GET", KEYS[1]) ~= ARGV[3] then
+  return -1
+end
+redis.call("SET", KEYS[1], ARGV[4])
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+# Lua script: replace a string-stored user with its hash form, unless the
+# string changed since it was read.
+# KEYS[1] = user key
+# ARGV[1] = string as read, ARGV[2..] = field/value pairs for HSET
+# Return: 1 if migrated, 0 otherwise
+MIGRATE_USER_SCRIPT = """
+if redis.call("TYPE", KEYS[1]).ok ~= "string" then
+  return 0
+end
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call("DEL", KEYS[1])
+redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+
+DELETE_BATCH_SIZE = 500
+TOUCH_ATTEMPTS = 3  # reads of a string-stored user that keeps changing meanwhile
+
+# SCAN cursors are unsigned 64-bit integers, sorted set ranks signed ones
+MAX_SCAN_CURSOR = 2**64 - 1
+MAX_RANK = 2**63 - 1
+
+STORAGE_LAYOUTS = ("json", "hash")
+
+
+def last_active_score(user: Dict) -> float:
+    """Return the activity index score for a stored user."""
+    raw = user.get("last_active")
+
+    if raw is None:  # Works with: old ISO strings,new float timestamps,missing values
+        return 0.0
+    if isinstance(raw, (int, float)):
+        return float(raw)
+    # ISO string → timestamp
+    return datetime.fromisoformat(raw).timestamp()
+
+
+def _hash_fields(user: Dict) -> List:
+    # every field value is JSON-encoded so the hash round-trips losslessly
+    fields: List = []
+    for field, value in user.items():
+        fields.extend((field, orjson.dumps(value)))
+    return fields
+
+
+def _from_hash(fields: Dict[str, str]) -> Dict:
+    return {field: orjson.loads(value) for field, value in fields.items()}
 
 
 class RedisUserRepository(UserRepository):
     """Redis-Based Async Implementation of UserRepository Interface"""
 
-    def __init__(self, *, redis_url: str):
-        self._redis = redis.from_url(redis_url, decode_responses=True)
+    def __init__(
+        self,
+        *,
+        redis_url: Optional[str] = None,
+        redis_client: Optional[redis.Redis] = None,
+        shards: Optional[List[Shard]] = None,
+        storage: str = "json",
+        codec: str = "json",
+        last_active_flush_interval: float = 0,
+        last_active_flush_max_pending: int = 1000,
+        cache_max_entries: int = 0,
+        cache_ttl: float = 30.0,
+        replica_urls: Sequence[str] = (),
+        replica_eject_seconds: float = 10.0,
+        read_your_writes_window: float = 0,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """Pass the app's shared redis_client, or a redis_url for standalone
+        scripts.
+
+        shards spreads the users over several Redis nodes, or over hash-tag
+        namespaces of a Redis Cluster (see app.repositories.sharding).
+        Without it every user lives on redis_client, which also carries the
+        cache invalidations.
+
+        storage selects the layout new writes use: "json" keeps each user
+        as one JSON string, "hash" keeps it as a Redis hash so single fields
+        can be updated in place. Reads understand both layouts, so a store
+        can be migrated online with migrate_to_hash().
+
+        codec encodes users in the string layout and cached responses:
+        "json" or the more compact "msgpack". Reads detect the format of
+        each value, so the codec can be changed at any time.
+
+        With a positive last_active_flush_interval, touch_user only records
+        the timestamp in memory and a LastActiveBuffer writes it behind in
+        pipelined batches. Call close() on shutdown to flush what is left.
+
+        With a positive cache_max_entries, get_user reads through a local
+        UserCache. Every mutation is published on INVALIDATION_CHANNEL so
+        other workers drop their copy; cache_ttl bounds staleness if a
+        message is missed.
+
+        replica_urls are replicas of the unsharded store (shards list their
+        own). Read-only operations are spread over the healthy replicas; a
+        replica that fails is ejected for replica_eject_seconds. With a
+        positive read_your_writes_window, a session's reads go to the
+        primary for that long after it changed something.
+
+        With a breaker, reads, writes and bulk operations run under its
+        per-operation timeouts and fail fast with CircuitOpenError while
+        Redis is considered down.
+        """
+        if storage not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {storage}")
+        self._storage = storage
+        self._codec = get_codec(codec)
+        self._breaker = breaker
+        if redis_client is None:
+            if shards:
+                redis_client = shards[0].redis
+            else:
+                redis_client = redis.from_url(redis_url, decode_responses=True)
+        self._redis = redis_client
+        if not shards:
+            replicas = [
+                redis.from_url(url, decode_responses=True) for url in replica_urls
+            ]
+            shards = [Shard("default", redis_client, replicas=tuple(replicas))]
+        self._shards = shards
+        self._ring = HashRing([shard.name for shard in self._shards])
+        self._replica_sets = {
+            shard.name: ReplicaSet(shard.replicas, replica_eject_seconds)
+            for shard in self._shards
+        }
+        # scan cursors name the node they belong to: the primary or a replica
+        self._nodes = 1 + max(len(shard.replicas) for shard in self._shards)
+        self._read_your_writes = ReadYourWrites(read_your_writes_window)
+        # registered once, run on each shard's client with client=...
+        self._create_script = self._redis.register_script(CREATE_USER_SCRIPT)
+        self._touch_hash_script = self._redis.register_script(TOUCH_USER_HASH_SCRIPT)
+        self._touch_json_script = self._redis.register_script(TOUCH_USER_JSON_SCRIPT)
+        self._migrate_script = self._redis.register_script(MIGRATE_USER_SCRIPT)
+        self._read_script = self._redis.register_script(READ_USER_SCRIPT)
+        self._delete_inactive_script = self._redis.register_script(
+            DELETE_INACTIVE_SCRIPT
+        )
+        self._set_tags_script = self._redis.register_script(SET_USER_TAGS_SCRIPT)
+        self._delete_user_script = self._redis.register_script(DELETE_USER_SCRIPT)
+        self._last_active_buffer: Optional[LastActiveBuffer] = None
+        if last_active_flush_interval > 0:
+            self._last_active_buffer = LastActiveBuffer(
+                self._write_last_active,
+                interval=last_active_flush_interval,
+                max_pending=last_active_flush_max_pending,
+            )
+        self._cache: Optional[UserCache] = None
+        if cache_max_entries > 0:
+            self._cache = UserCache(max_entries=cache_max_entries, ttl=cache_ttl)
+        # concurrent get_user and touch_user calls for one user share a round trip
+        self._reads = SingleFlight("get_user")
+        self._touches = SingleFlight("touch_user")
+        self._origin = uuid.uuid4().hex
+        self._invalidation_listener: Optional[asyncio.Task] = None
+
+    def _shard(self, username: str) -> Shard:
+        return self._shards[self._ring.index(username)]
 
     def _user_key(self, username: str) -> str:
-        return f"user:{username}"
+        return self._shard(username).key(f"{USER_KEY_PREFIX}{username}")
 
-    async def create_user(self, user: Dict) -> None:
-        key = self._user_key(user["username"])
+    def _by_shard(self, usernames: List[str]) -> Dict[int, List[str]]:
+        groups: Dict[int, List[str]] = {}
+        for username in usernames:
+            groups.setdefault(self._ring.index(username), []).append(username)
+        return groups
+
+    async def _scan(self, shard: Shard, cursor: int, pattern: str, count: int):
+        if not shard.namespace:
+            return await shard.redis.scan(
+                cursor=cursor, match=shard.key(pattern), count=count
+            )
+        # cluster: scan the node that owns the namespace's slot; the reply
+        # holds a cursor per node scanned
+        node = shard.redis.get_node_from_key(shard.namespace)
+        cursors, keys = await shard.redis.scan(
+            cursor=cursor, match=shard.key(pattern), count=count, target_nodes=node
+        )
+        return cursors[node.name], keys
 
-        # SETNX → only set if not exists (atomic)
-        created = await self._redis.setnx(key, json.dumps(user))
+    async def _on_replica(
+        self, shard: Shard, read: Callable[..., Awaitable], *args, primary=False
+    ):
+        """Run read(shard, *args) on a healthy replica of the shard, or on
+        the primary if there is none, if `primary` is set or if the session
+        has to read its own writes.
+        """
+        replica = None
+        if not primary and not self._read_your_writes.pinned():
+            replica = self._replica_sets[shard.name].pick()
+        if replica is None:
+            return await read(shard, *args)
+        try:
+            return await read(replace(shard, redis=replica), *args)
+        except REPLICA_ERRORS:
+            logger.warning("replica of shard %s failed, ejected", shard.name)
+            self._replica_sets[shard.name].eject(replica)
+            return await read(shard, *args)
 
-        if not created:
+    def _scan_reader(self, shard: Shard, cursor: int, node: int) -> Tuple[Shard, int]:
+        """Return where to continue a scan of the shard, and its node number:
+        0 for the primary, n for replica n-1. A new scan picks a replica,
+        a started one stays on its node while that is healthy.
+        """
+        replicas = self._replica_sets[shard.name]
+        replica = None
+        if not self._read_your_writes.pinned():
+            if cursor == 0:
+                replica = replicas.pick()
+            elif node:
+                replica = replicas.get(node - 1)
+        if replica is None:
+            return shard, 0
+        return replace(shard, redis=replica), replicas.index(replica) + 1
+
+    async def _mutated(self, usernames: Optional[List[str]]) -> None:
+        self._read_your_writes.wrote()
+        await self._invalidate(usernames)
+
+    async def _invalidate(self, usernames: Optional[List[str]]) -> None:
+        """Drop users (None means everyone) from the local cache and publish
+        the invalidation to the other workers.
+        """
+        # reads in flight may predate the change; later ones must not join them
+        if usernames is None:
+            self._reads.forget_all()
+        else:
+            names = set(usernames)
+            self._reads.forget(
+                key for key in self._reads.in_flight() if key[0] in names
+            )
+        if self._cache is None:
+            return
+        if usernames is None:
+            self._cache.clear()
+        else:
+            self._cache.invalidate(usernames)
+        message = {"origin": self._origin, "usernames": usernames}
+        await self._redis.publish(INVALIDATION_CHANNEL, json.dumps(message))
+
+    async def _listen_for_invalidations(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        event = json.loads(message["data"])
+                        if event["origin"] == self._origin:
+                            continue
+                        if event["usernames"] is None:
+                            self._cache.clear()
+                        else:
+                            self._cache.invalidate(event["usernames"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("user cache invalidation listener failed")
+                # invalidations sent while unsubscribed are lost
+                self._cache.clear()
+                await asyncio.sleep(1)
+
+    def _create_args(
+        self, user: Dict, idempotency: Tuple[str, Dict, int] | None = None
+    ) -> Tuple[List, List]:
+        shard = self._shard(user["username"])
+        keys = [
+            shard.key(f"{USER_KEY_PREFIX}{user['username']}"),
+            shard.key(ACTIVITY_INDEX_KEY),
+        ]
+        args = [user["username"], last_active_score(user), self._storage]
+        if idempotency is None:
+            args.extend((0, ""))
+        else:
+            idempotency_key, response, ttl = idempotency
+            keys.append(shard.key(idempotency_key))
+            args.extend((ttl, self._codec.encode(response)))
+        args.append(orjson.dumps(user.get("tags", [])))
+        if self._storage == "hash":
+            args.extend(_hash_fields(user))
+        else:
+            args.append(self._codec.encode(user))
+        return keys, args
+
+    async def _eval_undecoded(
+        self, script: AsyncScript, keys: List, args: List, client=None
+    ):
+        # like script(keys=..., args=...), but bulk string replies stay bytes,
+        # since they may hold binary encoded values
+        client = self._redis if client is None else client
+        command = ("EVALSHA", script.sha, len(keys), *keys, *args)
+        try:
+            return await client.execute_command(*command, **{NEVER_DECODE: True})
+        except NoScriptError:
+            await client.script_load(script.script)
+            return await client.execute_command(*command, **{NEVER_DECODE: True})
+
+    async def _evalsha_many(
+        self, shard: Shard, script: AsyncScript, commands: List[Tuple]
+    ) -> List:
+        # each command holds the script's two keys followed by its args
+        async with shard.redis.pipeline(transaction=False) as pipe:
+            for command in commands:
+                pipe.execute_command("EVALSHA", script.sha, 2, *command)
+            return await pipe.execute()
+
+    async def _mget_undecoded(
+        self, shard: Shard, keys: List[str]
+    ) -> List[Optional[bytes]]:
+        return await shard.redis.execute_command("MGET", *keys, **{NEVER_DECODE: True})
+
+    @guarded("write")
+    async def _create(
+        self, user: Dict, idempotency: Tuple[str, Dict, int] | None = None
+    ) -> Optional[Dict]:
+        keys, args = self._create_args(user, idempotency)
+
+        # existence check, insert, index and response caching in one round trip
+        result = await self._eval_undecoded(
+            self._create_script, keys, args, self._shard(user["username"]).redis
+        )
+
+        if result[0] == 2:
+            return decode(result[1])
+        if result[0] == 0:
             raise ValueError("User already exists")
+        await self._mutated([user["username"]])
+        return None
 
-    async def get_user(self, username: str) -> Optional[Dict]:
-        key = self._user_key(username)
-        data = await self._redis.get(key)
+    async def create_user(self, user: Dict) -> None:
+        await self._create(user)
 
-        if not data:
-            return None
+    async def create_user_idempotent(
+        self, user: Dict, idempotency_key: str, response: Dict, ttl: int
+    ) -> Optional[Dict]:
+        """Create the user and store `response` under `idempotency_key`.
+        If that key already holds a response, nothing is written and the
+        cached response is returned instead; None means the user was created.
+        Raises ValueError if the user already exists.
+        """
+        return await self._create(user, (idempotency_key, response, ttl))
 
-        return json.loads(data)
+    @guarded("bulk")
+    async def bulk_create_users(self, users: List[Dict]) -> List[bool]:
+        """Create many users with one pipelined round trip per shard.
+        Returns, per user, whether it was created (False: already exists).
+        """
+        positions: Dict[int, List[int]] = {}
+        for position, user in enumerate(users):
+            index = self._ring.index(user["username"])
+            positions.setdefault(index, []).append(position)
+
+        async def insert(index: int, batch: List[int]) -> List:
+            async with self._shards[index].redis.pipeline(transaction=False) as pipe:
+                for position in batch:
+                    keys, args = self._create_args(users[position])
+                    await self._create_script(keys=keys, args=args, client=pipe)
+                return await pipe.execute()
+
+        created = [False] * len(users)
+        results = await asyncio.gather(
+            *(insert(index, batch) for index, batch in positions.items())
+        )
+        for batch, replies in zip(positions.values(), results):
+            for position, result in zip(batch, replies):
+                created[position] = result[0] == 1
+        usernames = [user["username"] for user, ok in zip(users, created) if ok]
+        if usernames:
+            await self._mutated(usernames)
+        return created
 
-    async def add_tag(self, username: str, tags: list[str]) -> Dict:
-        key = self._user_key(username)
+    async def get_user(self, username: str, primary: bool = False) -> Optional[Dict]:
+        _, user = await self.get_user_versioned(username, primary=primary)
+        return user
+
+    @guarded("read")
+    async def get_user_versioned(
+        self,
+        username: str,
+        known_version: Optional[int] = None,
+        primary: bool = False,
+    ) -> Tuple[Optional[int], Optional[Dict]]:
+        """Return (version, user) in one round trip.
+        The user is None if it does not exist, and also if it still has
+        `known_version`, in which case the record is not read at all.
+        The version is None for missing users and for users not changed
+        since versioning was introduced.
+        With `primary`, the user is read from the primary, never from a
+        replica or the local cache, as a read-modify-write needs.
+        """
+        if self._cache is None or primary:
+            return await self._read_user(username, known_version, primary)
 
-        data = await self._redis.get(key)
+        if self._invalidation_listener is None:
+            self._invalidation_listener = asyncio.get_running_loop().create_task(
+                self._listen_for_invalidations()
+            )
+        entry = self._cache.get_versioned(username)
+        if entry is not None:
+            user, version = entry
+            if version is not None and version == known_version:
+                return version, None
+            return version, user
+        generation = self._cache.generation
+        version, user = await self._read_user(username, known_version)
+        if user is not None:
+            self._cache.put(username, user, generation, version)
+        return version, user
+
+    async def _read_user(
+        self, username: str, known_version: Optional[int], primary: bool = False
+    ) -> Tuple[Optional[int], Optional[Dict]]:
+        shard = self._shard(username)
+        if primary or self._read_your_writes.pinned():
+            return await self._on_replica(
+                shard, self._read_shard_user, username, known_version, primary=primary
+            )
+        version, user = await self._reads.do(
+            (username, known_version),
+            lambda: self._on_replica(
+                shard, self._read_shard_user, username, known_version
+            ),
+        )
+        # the callers of a shared read each get their own copy
+        return version, None if user is None else dict(user)
+
+    async def _read_shard_user(
+        self, shard: Shard, username: str, known_version: Optional[int]
+    ) -> Tuple[Optional[int], Optional[Dict]]:
+        # the script reads either layout, so records of a migration in
+        # progress need no second round trip
+        reply = await self._eval_undecoded(
+            self._read_script,
+            [shard.key(f"{USER_KEY_PREFIX}{username}"), shard.key(USER_VERSIONS_KEY)],
+            [username, "" if known_version is None else known_version],
+            shard.redis,
+        )
+        if reply[0] == 0:
+            return None, None
+        version = None if reply[1] is None else int(reply[1])
+        if reply[0] == 1:
+            return version, None
+        if reply[0] == 2:
+            return version, decode(reply[2])
+        fields = reply[2:]
+        return version, {
+            field.decode(): orjson.loads(value)
+            for field, value in zip(fields[::2], fields[1::2])
+        }
+
+    @guarded("read")
+    async def collection_version(self) -> int:
+        """Return a number that changes whenever any user changes.
+        Each shard counts its own changes; their sum only ever grows.
+        """
+        versions = await asyncio.gather(
+            *(
+                self._on_replica(
+                    shard, lambda s: s.redis.get(s.key(COLLECTION_VERSION_KEY))
+                )
+                for shard in self._shards
+            )
+        )
+        return sum(int(version or 0) for version in versions)
+
+    @guarded("read")
+    async def get_users(self, usernames: List[str]) -> Dict[str, Dict]:
+        """Read many users with one batched fetch per shard, in the order
+        given. Users that do not exist are left out.
+        """
+        groups = self._by_shard(usernames)
+        fetched = await asyncio.gather(
+            *(
+                self._on_replica(
+                    self._shards[index],
+                    self._fetch_users,
+                    [self._user_key(name) for name in names],
+                )
+                for index, names in groups.items()
+            )
+        )
+        users: Dict[str, Dict] = {}
+        for found in fetched:
+            users.update(found)
+        return {name: users[name] for name in usernames if name in users}
+
+    @guarded("write")
+    async def add_tag(
+        self, username: str, tags: list[str], if_version: Optional[int] = None
+    ) -> Optional[Dict]:
+        """Replace the tags of a user and return the updated user.
+        With `if_version` (0 for a user without a version), the tags are
+        only stored if the user still has that version, and None is
+        returned otherwise, so a read-modify-write never loses a
+        concurrent change. Raises KeyError if the user does not exist.
+        """
+        shard = self._shard(username)
+        key = shard.key(f"{USER_KEY_PREFIX}{username}")
+        condition = [] if if_version is None else [if_version]
+
+        if self._storage == "hash":
+            # the field, the tag index and the version change together
+            reply = await self._set_tags_script(
+                keys=[key],
+                args=[username, orjson.dumps(tags), "hash", *condition],
+                client=shard.redis,
+            )
+            if reply[0] == 0:
+                raise KeyError("User not found")
+            if reply[0] == -2:
+                return None
+            if reply[0] == 1:
+                await self._mutated([username])
+                fields = reply[1:]
+                return _from_hash(dict(zip(fields[::2], fields[1::2])))
+
+        data = await shard.redis.execute_command("GET", key, **{NEVER_DECODE: True})
         if not data:
             raise KeyError("User not found")
 
-        user = json.loads(data)
+        user = decode(data)
         user["tags"] = tags
 
-        await self._redis.set(key, json.dumps(user))
+        encoded = self._codec.encode(user)
+        reply = await self._set_tags_script(
+            keys=[key],
+            args=[username, orjson.dumps(tags), encoded, *condition],
+            client=shard.redis,
+        )
+        if reply[0] == 0:
+            raise KeyError("User not found")
+        if reply[0] == -2:
+            return None
+        await self._mutated([username])
         return user
 
-    async def list_users(self) -> Dict[str, Dict]:
+    async def _mget_json(
+        self, shard: Shard, keys: List[str]
+    ) -> Tuple[Dict[str, Dict], List[str]]:
         users: Dict[str, Dict] = {}
-        # use SCAN to iterate over keys(does not block Redis like KEYS)
-        cursor = "0"
+        missing: List[str] = []
+        for key, value in zip(keys, await self._mget_undecoded(shard, keys)):
+            if value:
+                users[shard.strip(key, USER_KEY_PREFIX)] = decode(value)
+            else:
+                missing.append(key)  # absent, or not a string
+        return users, missing
 
-        while True:
-            cursor, keys = await self._redis.scan(
-                cursor=cursor, match="user:*", count=100
-            )
+    async def _mget_hash(
+        self, shard: Shard, keys: List[str]
+    ) -> Tuple[Dict[str, Dict], List[str]]:
+        users: Dict[str, Dict] = {}
+        missing: List[str] = []
+        async with shard.redis.pipeline(transaction=False) as pipe:
             for key in keys:
-                value = await self._redis.get(key)
-                if value:
-                    username = key.split(":", 1)[1]
-                    users[username] = json.loads(value)
+                pipe.hgetall(key)
+            results = await pipe.execute(raise_on_error=False)
+        for key, fields in zip(keys, results):
+            if isinstance(fields, Exception) or not fields:
+                missing.append(key)  # absent, or not a hash
+            else:
+                users[shard.strip(key, USER_KEY_PREFIX)] = _from_hash(fields)
+        return users, missing
+
+    async def _fetch_users(self, shard: Shard, keys: List[str]) -> Dict[str, Dict]:
+        # one MGET (or pipelined HGETALL) per SCAN page instead of one GET per key
+        if not keys:
+            return {}
+        if self._storage == "hash":
+            fetch, fallback = self._mget_hash, self._mget_json
+        else:
+            fetch, fallback = self._mget_json, self._mget_hash
 
+        users, missing = await fetch(shard, keys)
+        if missing:
+            more, _ = await fallback(shard, missing)
+            users.update(more)
+        return users
+
+    @guarded("read")
+    async def list_users_page(
+        self, cursor: int = 0, count: int = 100
+    ) -> Tuple[Dict[str, Dict], int]:
+        """Return roughly `count` users starting at a cursor.
+        The shards are scanned one after the other; the cursor holds the
+        shard's SCAN cursor, its index and the node scanned (SCAN cursors
+        are only meaningful on the node that returned them). It is 0 once
+        all were iterated. Raises ValueError for a cursor it cannot have
+        returned.
+        """
+        users: Dict[str, Dict] = {}
+        shard_count = len(self._shards)
+        cursor, node = divmod(cursor, self._nodes)
+        cursor, index = divmod(cursor, shard_count)
+        if not 0 <= cursor <= MAX_SCAN_CURSOR:
+            raise ValueError("Invalid cursor")
+
+        while True:
+            shard = self._shards[index]
+            reader, node = self._scan_reader(shard, cursor, node)
+            try:
+                next_cursor, keys = await self._scan(reader, cursor, "user:*", count)
+                users.update(await self._fetch_users(reader, keys))
+            except REPLICA_ERRORS:
+                if not node:
+                    raise
+                logger.warning("replica of shard %s failed, ejected", shard.name)
+                self._replica_sets[shard.name].eject(reader.redis)
+                node = 0  # the primary resumes the scan
+                continue
+            cursor = next_cursor
+            if cursor == 0:  # shard complete
+                index += 1
+                if index == shard_count:
+                    return users, 0
+            if len(users) >= count:
+                break
+
+        return users, (cursor * shard_count + index) * self._nodes + node
+
+    async def iter_users(self, batch_size: int = 100) -> AsyncIterator[Dict]:
+        cursor = 0
+
+        while True:
+            users, cursor = await self.list_users_page(cursor, batch_size)
+            for user in users.values():
+                yield user
             if cursor == 0:  # scan complete
                 break
 
+    async def _list_shard_users(self, shard: Shard) -> Dict[str, Dict]:
+        users: Dict[str, Dict] = {}
+        cursor = 0
+
+        while True:
+            cursor, keys = await self._scan(shard, cursor, "user:*", 100)
+            users.update(await self._fetch_users(shard, keys))
+            if cursor == 0:  # scan complete
+                return users
+
+    @guarded("read")
+    async def list_users(self) -> Dict[str, Dict]:
+        users: Dict[str, Dict] = {}
+        for found in await asyncio.gather(
+            *(self._on_replica(shard, self._list_shard_users) for shard in self._shards)
+        ):
+            users.update(found)
         return users
 
+    @guarded("write")
     async def delete_user(self, username: str) -> None:
-        key = self._user_key(username)
-        result = await self._redis.delete(key)
-        if result == "0":
+        shard = self._shard(username)
+        deleted = await self._delete_user_script(
+            keys=[
+                shard.key(f"{USER_KEY_PREFIX}{username}"),
+                shard.key(ACTIVITY_INDEX_KEY),
+            ],
+            args=[username],
+            client=shard.redis,
+        )
+        if not deleted:
             raise KeyError("User not found")
+        await self._mutated([username])
+
+    async def _delete_shard(self, shard: Shard) -> None:
+        for pattern in ("user:*", f"{TAG_KEY_PREFIX}*"):
+            cursor = 0
 
+            while True:
+                cursor, keys = await self._scan(shard, cursor, pattern, 100)
+                if keys:
+                    await shard.redis.delete(*keys)
+                # Redis returns cursor as string "0", not int 0
+                if cursor == 0:  # scan complete
+                    break
+
+        indexes = (
+            ACTIVITY_INDEX_KEY,
+            USERNAME_INDEX_KEY,
+            TAG_COUNTS_KEY,
+            USER_TAGS_KEY,
+            USER_VERSIONS_KEY,
+        )
+        await shard.redis.delete(*map(shard.key, indexes))
+        # incremented, never deleted, so no version is handed out twice
+        await shard.redis.incr(shard.key(COLLECTION_VERSION_KEY))
+
+    @guarded("bulk")
     async def delete_all(self) -> None:
-        cursor = 0
+        await asyncio.gather(*map(self._delete_shard, self._shards))
+        await self._mutated(None)
+
+    async def _delete_shard_inactive(self, shard: Shard, inactive_since: float) -> int:
+        deleted_count = 0
 
         while True:
-            cursor, keys = await self._redis.scan(
-                cursor=cursor, match="user:*", count=100
+            removed, deleted = await self._delete_inactive_script(
+                keys=[shard.key(ACTIVITY_INDEX_KEY)],
+                args=[inactive_since, DELETE_BATCH_SIZE, shard.key(USER_KEY_PREFIX)],
+                client=shard.redis,
             )
-            if keys:
-                await self._redis.delete(*keys)
-            # Redis returns cursor as string "0", not int 0
-            if cursor == 0:  # scan complete
-                break
+            deleted_count += deleted
+            if removed < DELETE_BATCH_SIZE:  # index drained below cutoff
+                return deleted_count
 
+    @guarded("bulk")
     async def delete_inactive_users(self, inactive_since: float) -> int:
         """Delete users who have not been active since the given timestamp.
         Returns the number of users deleted.
+
+        Walks the activity index of every shard, concurrently, in batches,
+        so the cost grows with the number of expired users rather than the
+        total user count.
         """
-        deleted_count = 0
+        deleted_count = sum(
+            await asyncio.gather(
+                *(
+                    self._delete_shard_inactive(shard, inactive_since)
+                    for shard in self._shards
+                )
+            )
+        )
+        if deleted_count:
+            await self._mutated(None)
+        return deleted_count
+
+    async def touch_user(self, username: str) -> None:
+        now = datetime.now(timezone.utc)
+        if self._last_active_buffer is not None:
+            self._last_active_buffer.add(username, now)
+            return
+        # a touch already in flight records practically the same time
+        await self._touches.do(
+            username, lambda: self._write_last_active({username: now})
+        )
+
+    @guarded("write")
+    async def _write_last_active(self, updates: Dict[str, datetime]) -> None:
+        """Persist last_active for many users in pipelined round trips, one
+        per shard. Users that no longer exist are skipped.
+        """
+        groups = self._by_shard(list(updates))
+        written: List[str] = []
+        for names in await asyncio.gather(
+            *(
+                self._write_shard_last_active(self._shards[index], names, updates)
+                for index, names in groups.items()
+            )
+        ):
+            written.extend(names)
+
+        if written:
+            await self._invalidate(written)
+
+    async def _write_shard_last_active(
+        self, shard: Shard, usernames: List[str], updates: Dict[str, datetime]
+    ) -> List[str]:
+        written: List[str] = []
+
+        if self._storage == "hash":
+            async with shard.redis.pipeline(transaction=False) as pipe:
+                for username in usernames:
+                    when = updates[username]
+                    await self._touch_hash_script(
+                        keys=[
+                            shard.key(f"{USER_KEY_PREFIX}{username}"),
+                            shard.key(ACTIVITY_INDEX_KEY),
+                        ],
+                        args=[
+                            username,
+                            when.timestamp(),
+                            orjson.dumps(when.isoformat()),
+                        ],
+                        client=pipe,
+                    )
+                results = await pipe.execute()
+            # users still stored as JSON strings take the read-modify-write path
+            written = [name for name, res in zip(usernames, results) if res > 0]
+            usernames = [name for name, res in zip(usernames, results) if res < 0]
+
+        # string-stored users: read-modify-write, each written only if it did
+        # not change since it was read, and read again otherwise
+        for _ in range(TOUCH_ATTEMPTS):
+            if not usernames:
+                break
+            keys = [shard.key(f"{USER_KEY_PREFIX}{name}") for name in usernames]
+            found = [
+                (username, key, data)
+                for username, key, data in zip(
+                    usernames, keys, await self._mget_undecoded(shard, keys)
+                )
+                if data
+            ]
+            if not found:
+                usernames = []
+                break
+            script = self._touch_json_script
+            commands = []
+            for username, key, data in found:
+                when = updates[username]
+                user = decode(data)
+                user["last_active"] = when.isoformat()
+                commands.append(
+                    (
+                        key,
+                        shard.key(ACTIVITY_INDEX_KEY),
+                        username,
+                        when.timestamp(),
+                        data,
+                        self._codec.encode(user),
+                    )
+                )
+            # plain EVALSHA rather than script(client=pipe), which would add a
+            # SCRIPT EXISTS to every flush; none ran if the script is missing
+            try:
+                results = await self._evalsha_many(shard, script, commands)
+            except NoScriptError:
+                await shard.redis.script_load(script.script)
+                results = await self._evalsha_many(shard, script, commands)
+            written.extend(
+                username for (username, _, _), res in zip(found, results) if res > 0
+            )
+            usernames = [
+                username for (username, _, _), res in zip(found, results) if res < 0
+            ]
+        if usernames:
+            logger.warning("last_active of %d users kept changing", len(usernames))
+
+        return written
+
+    async def close(self) -> None:
+        if self._last_active_buffer is not None:
+            await self._last_active_buffer.close()
+        if self._invalidation_listener is not None:
+            self._invalidation_listener.cancel()
+            try:
+                await self._invalidation_listener
+            except asyncio.CancelledError:
+                pass
+            self._invalidation_listener = None
+
+    def stats(self) -> Dict[str, Dict]:
+        stats: Dict[str, Dict] = {}
+        if self._last_active_buffer is not None:
+            stats["write_behind"] = self._last_active_buffer.stats()
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats()
+        stats["single_flight"] = {
+            "get_user": self._reads.stats(),
+            "touch_user": self._touches.stats(),
+        }
+        if self._nodes > 1:
+            stats["replicas"] = replica_stats(list(self._replica_sets.values()))
+        return stats
+
+    @guarded("read")
+    async def search_usernames(self, prefix: str, count: int = 20) -> List[str]:
+        """Return up to `count` usernames starting with `prefix`, in order.
+        Reads one range of each shard's username index, so the cost grows
+        with the number of results, not the number of users.
+        """
+        # 0xff never occurs in UTF-8, so it sorts after every name with the prefix
+        encoded = prefix.encode()
+
+        def search(shard: Shard) -> Awaitable[List[str]]:
+            return shard.redis.zrange(
+                shard.key(USERNAME_INDEX_KEY),
+                b"[" + encoded,
+                b"[" + encoded + b"\xff",
+                bylex=True,
+                offset=0,
+                num=count,
+            )
+
+        found = await asyncio.gather(
+            *(self._on_replica(shard, search) for shard in self._shards)
+        )
+        return list(islice(heapq.merge(*found), count))
+
+    # tag queries stay on the primary: they store their result key
+    async def _tag_query_key(
+        self, shard: Shard, tags: List[str], match: str, fresh: bool
+    ) -> str:
+        tags = sorted(set(tags))
+        if len(tags) == 1:
+            return shard.key(f"{TAG_KEY_PREFIX}{tags[0]}")
+        digest = hashlib.sha1(orjson.dumps(tags)).hexdigest()
+        key = shard.key(f"{TAG_QUERY_KEY_PREFIX}{match}:{digest}")
+        if fresh or not await shard.redis.exists(key):
+            sources = [shard.key(f"{TAG_KEY_PREFIX}{tag}") for tag in tags]
+            async with shard.redis.pipeline(transaction=True) as pipe:
+                if match == "all":
+                    pipe.zinterstore(key, sources, aggregate="MIN")
+                else:
+                    pipe.zunionstore(key, sources, aggregate="MIN")
+                pipe.expire(key, TAG_QUERY_TTL)
+                await pipe.execute()
+        return key
+
+    async def _list_shard_usernames_by_tags(
+        self,
+        shard: Shard,
+        tags: List[str],
+        match: str,
+        cursor: Optional[str],
+        count: int,
+    ) -> List[str]:
+        key = await self._tag_query_key(shard, tags, match, fresh=cursor is None)
+        start = "-" if cursor is None else f"({cursor}"
+        return await shard.redis.zrange(
+            key, start, "+", bylex=True, offset=0, num=count
+        )
+
+    @guarded("read")
+    async def list_usernames_by_tags(
+        self,
+        tags: List[str],
+        match: str = "all",
+        cursor: Optional[str] = None,
+        count: int = 100,
+    ) -> Tuple[List[str], Optional[str]]:
+        """Return up to `count` usernames, in order, after `cursor`, of the
+        users with all (match="all") or any (match="any") of the tags.
+        Only the tag index is read. The returned cursor is None on the last page.
+        """
+        if match not in TAG_MATCHES:
+            raise ValueError(f"Unknown tag match: {match}")
+        found = await asyncio.gather(
+            *(
+                self._list_shard_usernames_by_tags(shard, tags, match, cursor, count)
+                for shard in self._shards
+            )
+        )
+        usernames = list(islice(heapq.merge(*found), count))
+        return usernames, usernames[-1] if len(usernames) == count else None
+
+    @guarded("read")
+    async def tag_counts(
+        self, tags: Optional[List[str]] = None, cursor: int = 0, count: int = 100
+    ) -> Tuple[Dict[str, int], int]:
+        """Return the number of users per tag, most used first, starting at
+        offset `cursor`; the returned offset is 0 on the last page.
+        With `tags`, only those are counted, in a single page. Raises
+        ValueError for an offset out of range.
+        """
+        if not 0 <= cursor <= MAX_RANK - count:
+            raise ValueError("Invalid cursor")
+        if tags:
+            found = await asyncio.gather(
+                *(
+                    self._on_replica(
+                        shard, lambda s: s.redis.zmscore(s.key(TAG_COUNTS_KEY), tags)
+                    )
+                    for shard in self._shards
+                )
+            )
+            totals = [
+                sum(int(score or 0) for score in scores) for scores in zip(*found)
+            ]
+            return dict(zip(tags, totals)), 0
+        if len(self._shards) == 1:
+            entries = await self._on_replica(
+                self._shards[0],
+                lambda s: s.redis.zrevrange(
+                    s.key(TAG_COUNTS_KEY), cursor, cursor + count - 1, withscores=True
+                ),
+            )
+        else:
+            # every shard counts its own users; the ranking needs all counts
+            totals: Dict[str, float] = {}
+            for shard_entries in await asyncio.gather(
+                *(
+                    self._on_replica(
+                        shard,
+                        lambda s: s.redis.zrange(
+                            s.key(TAG_COUNTS_KEY), 0, -1, withscores=True
+                        ),
+                    )
+                    for shard in self._shards
+                )
+            ):
+                for tag, score in shard_entries:
+                    totals[tag] = totals.get(tag, 0) + score
+            ranked = sorted(totals.items(), key=lambda entry: (-entry[1], entry[0]))
+            entries = ranked[cursor : cursor + count]
+        next_cursor = cursor + count if len(entries) == count else 0
+        return {tag: int(score) for tag, score in entries}, next_cursor
+
+    async def _rebuild_shard_tag_index(self, shard: Shard, batch_size: int) -> int:
+        indexed = 0
         cursor = 0
 
         while True:
-            cursor, keys = await self._redis.scan(
-                cursor=cursor, match="user:*", count=100
-            )
-            for key in keys:
-                value = await self._redis.get(key)
-                if value:
-                    user = json.loads(value)
-                    raw = user.get("last_active")
-
-                    if (
-                        raw is None
-                    ):  # Works with: old ISO strings,new float timestamps,missing values
-                        last_active = 0.0
-                    elif isinstance(raw, (int, float)):
-                        last_active = float(raw)
-                    else:
-                        # ISO string → timestamp
-                        last_active = datetime.fromisoformat(raw).timestamp()
-
-                    if last_active < inactive_since:
-                        await self._redis.delete(key)
-                        deleted_count += 1
+            cursor, keys = await self._scan(shard, cursor, "user:*", batch_size)
+            users = await self._fetch_users(shard, keys)
+            if users:
+                async with shard.redis.pipeline(transaction=False) as pipe:
+                    for username, user in users.items():
+                        await self._set_tags_script(
+                            keys=[shard.key(f"{USER_KEY_PREFIX}{username}")],
+                            args=[username, orjson.dumps(user.get("tags", []))],
+                            client=pipe,
+                        )
+                    indexed += sum(reply[0] for reply in await pipe.execute())
 
             if cursor == 0:  # scan complete
-                break
+                return indexed
 
-        return deleted_count
+    async def rebuild_tag_index(self, batch_size: int = 1000) -> int:
+        """Backfill the tag index from the stored users.
+        Returns the number of users indexed.
+        """
+        return await self._on_every_shard(self._rebuild_shard_tag_index, batch_size)
 
-    async def touch_user(self, username: str) -> None:
-        user = await self.get_user(username)
-        if not user:
-            return
+    async def _rebuild_shard_username_index(self, shard: Shard, batch_size: int) -> int:
+        indexed = 0
+        cursor = 0
+
+        while True:
+            cursor, keys = await self._scan(shard, cursor, "user:*", batch_size)
+            if keys:
+                names = {shard.strip(key, USER_KEY_PREFIX): 0 for key in keys}
+                await shard.redis.zadd(shard.key(USERNAME_INDEX_KEY), names)
+                indexed += len(names)
+
+            if cursor == 0:  # scan complete
+                return indexed
+
+    async def rebuild_username_index(self, batch_size: int = 1000) -> int:
+        """Backfill the username index from the stored user keys.
+        Returns the number of users indexed.
+        """
+        return await self._on_every_shard(
+            self._rebuild_shard_username_index, batch_size
+        )
+
+    async def _rebuild_shard_activity_index(self, shard: Shard, batch_size: int) -> int:
+        indexed = 0
+        cursor = 0
+
+        while True:
+            cursor, keys = await self._scan(shard, cursor, "user:*", batch_size)
+            users = await self._fetch_users(shard, keys)
+            if users:
+                scores = {
+                    username: last_active_score(user)
+                    for username, user in users.items()
+                }
+                await shard.redis.zadd(shard.key(ACTIVITY_INDEX_KEY), scores)
+                indexed += len(scores)
+
+            if cursor == 0:  # scan complete
+                return indexed
+
+    async def rebuild_activity_index(self, batch_size: int = 1000) -> int:
+        """Backfill the activity index from the stored users.
+        Returns the number of users indexed.
+        """
+        return await self._on_every_shard(
+            self._rebuild_shard_activity_index, batch_size
+        )
+
+    async def _migrate_shard_to_hash(self, shard: Shard, batch_size: int) -> int:
+        migrated = 0
+        cursor = 0
+
+        while True:
+            cursor, keys = await self._scan(shard, cursor, "user:*", batch_size)
+            while keys:
+                values = await self._mget_undecoded(shard, keys)
+                pending = [(k, v) for k, v in zip(keys, values) if v is not None]
+                if not pending:
+                    break
+                async with shard.redis.pipeline(transaction=False) as pipe:
+                    for key, value in pending:
+                        await self._migrate_script(
+                            keys=[key],
+                            args=[value, *_hash_fields(decode(value))],
+                            client=pipe,
+                        )
+                    results = await pipe.execute()
+                migrated += sum(results)
+                keys = [key for (key, _), ok in zip(pending, results) if not ok]
+
+            if cursor == 0:  # scan complete
+                return migrated
+
+    async def migrate_to_hash(self, batch_size: int = 1000) -> int:
+        """Convert users stored as JSON strings to the hash layout.
+        Safe to run while the app is serving traffic: a record that changes
+        between the read and the conversion is re-read and retried.
+        Returns the number of users migrated.
+        """
+        return await self._on_every_shard(self._migrate_shard_to_hash, batch_size)
 
-        user["last_active"] = datetime.now(timezone.utc).isoformat()
-        await self._redis.set(self._user_key(username), json.dumps(user))
+    async def _on_every_shard(self, func, *args) -> int:
+        # run a per-shard job on all shards concurrently, summing the counts
+        return sum(
+            await asyncio.gather(*(func(shard, *args) for shard in self._shards))
+        )
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LastActiveBuffer:
+    """
+    In-process write-behind buffer for last_active updates.
+    - keeps only the latest timestamp per username; updates that replace
+      a pending one are counted as coalesced
+    - flushes every `interval` seconds, or as soon as `max_pending` users wait
+    - a failed flush puts its entries back unless a newer one arrived
+    - close() lets a flush in progress finish, then flushes what is left
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Dict[str, datetime]], Awaitable[None]],
+        *,
+        interval: float = 1.0,
+        max_pending: int = 1000,
+    ):
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: Dict[str, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.flushed_total = 0
+        self.flushes_total = 0
+        self.failed_flushes_total = 0
+        self.coalesced_total = 0
+
+    def add(self, username: str, when: datetime) -> None:
+        if username in self._pending:
+            self.coalesced_total += 1
+        self._pending[username] = when
+        if self._task is None and not self._closed:
+            # started lazily so the buffer works under any running event loop
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._closed:
+                return  # close() flushes what is left
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("last_active flush failed, retrying later")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            await self._flush(batch)
+        except BaseException:
+            # cancelled too: the batch must not be lost
+            self.failed_flushes_total += 1
+            for username, when in batch.items():
+                self._pending.setdefault(username, when)
+            raise
+        self.flushes_total += 1
+        self.flushed_total += len(batch)
+        return len(batch)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._task is not None:
+            # not cancelled, so a flush in progress completes
+            self._stopping.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "flushed_total": self.flushed_total,
+            "flushes_total": self.flushes_total,
+            "failed_flushes_total": self.failed_flushes_total,
+            "coalesced_total": self.coalesced_total,
+        }
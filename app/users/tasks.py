@@ -1,13 +1,68 @@
+import logging
 import time
 
+from celery import chord
+
 from app.core.celery_app import celery_app
+from app.core.config import settings
 from app.repositories.celery_user_repo import RedisUserRepositorySync
 
+logger = logging.getLogger(__name__)
+
+CLEANUP_LOCK_KEY = "locks:cleanup_inactive_users"
+
 
 @celery_app.task
 def cleanup_inactive_users():
+    """
+    Fan the cleanup out over disjoint last_active ranges of each shard's
+    activity index, one subtask each; a chord callback sums the deleted
+    counts.
+    - a lock keeps runs from overlapping; it is released by the callback,
+      or expires after CLEANUP_LOCK_TTL if a subtask dies
+    Returns the number of partitions scheduled, or None if a run is active.
+    """
     repo = RedisUserRepositorySync()
-    deleted = repo.delete_inactive_users(
-        inactive_since=time.time() - 1 * 24 * 60 * 60
-    )  # 1 days
+    token = repo.acquire_lock(CLEANUP_LOCK_KEY, settings.CLEANUP_LOCK_TTL)
+    if token is None:
+        logger.info("Inactive user cleanup already running, skipped")
+        return None
+
+    inactive_since = time.time() - settings.CLEANUP_INACTIVE_DAYS * 24 * 60 * 60
+    # the partition budget is shared by the shards
+    per_shard = max(1, settings.CLEANUP_PARTITIONS // len(repo.shards))
+    partitions = [
+        (low, high, shard.name)
+        for shard in repo.shards
+        for low, high in repo.inactive_partitions(inactive_since, per_shard, shard.name)
+    ]
+    if not partitions:
+        repo.release_lock(CLEANUP_LOCK_KEY, token)
+        return 0
+
+    callback = finish_cleanup.s(token).on_error(release_cleanup_lock.si(token))
+    chord(delete_inactive_partition.s(*partition) for partition in partitions)(callback)
+    return len(partitions)
+
+
+@celery_app.task
+def delete_inactive_partition(
+    lowest: str, highest: str, shard: str | None = None
+) -> int:
+    return RedisUserRepositorySync().delete_inactive_range(lowest, highest, shard)
+
+
+@celery_app.task
+def finish_cleanup(deleted_counts: list, token: str) -> int:
+    repo = RedisUserRepositorySync()
+    deleted = sum(deleted_counts)
+    if deleted:
+        repo.invalidate_all()
+    repo.release_lock(CLEANUP_LOCK_KEY, token)
+    logger.info("Deleted %d inactive users", deleted)
     return deleted
+
+
+@celery_app.task
+def release_cleanup_lock(token: str) -> None:
+    RedisUserRepositorySync().release_lock(CLEANUP_LOCK_KEY, token)
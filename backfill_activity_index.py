@@ -0,0 +1,17 @@
+import asyncio
+
+from app.core.config import settings
+from app.core.redis import create_user_shards
+from app.repositories.user_repo import RedisUserRepository
+
+REDIS_URL = settings.REDIS_URL
+
+
+async def backfill():
+    repo = RedisUserRepository(redis_url=REDIS_URL, shards=create_user_shards(settings))
+    indexed = await repo.rebuild_activity_index()
+    print(f"Indexed {indexed} users")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill())
@@ -0,0 +1,109 @@
+"""Compare the user codecs by encode/decode time and stored bytes per user,
+and the cost of serialising a create-user response before and after.
+
+Runs in-process, no Redis needed:
+
+    python -m benchmarks.codecs --users 10000 --tags 3
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from app.model.users import CreateUserResponse
+from app.repositories.codec import CODECS, decode, get_codec
+
+
+def make_users(count: int, tags: int) -> list:
+    now = datetime.now(timezone.utc).isoformat()
+    return [
+        {
+            "username": f"user_{i}",
+            "tags": [f"tag_{t}" for t in range(tags)],
+            "created_at": now,
+            "last_active": now,
+        }
+        for i in range(count)
+    ]
+
+
+def timed(func, items) -> float:
+    started = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - started) / len(items) * 1e6  # microseconds
+
+
+def codec_rows(users: list) -> list:
+    def stdlib_encode(user):
+        return json.dumps(user).encode()
+
+    rows = []
+    encoded = [stdlib_encode(u) for u in users]
+    rows.append(
+        {
+            "codec": "stdlib json (before)",
+            "encode_us": timed(stdlib_encode, users),
+            "decode_us": timed(json.loads, encoded),
+            "bytes": sum(map(len, encoded)) / len(users),
+        }
+    )
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except RuntimeError as e:
+            print(f"skipping {name}: {e}")
+            continue
+        encoded = [codec.encode(u) for u in users]
+        rows.append(
+            {
+                "codec": name,
+                "encode_us": timed(codec.encode, users),
+                "decode_us": timed(decode, encoded),
+                "bytes": sum(map(len, encoded)) / len(users),
+            }
+        )
+    return rows
+
+
+def response_rows(users: list) -> list:
+    responses = [CreateUserResponse(user=user, processing_time=0.001) for user in users]
+    codec = get_codec("json")
+
+    def before(response):
+        # jsonable_encoder, then json.dumps for the idempotency cache
+        return json.dumps({"status": 201, "body": jsonable_encoder(response)})
+
+    def after(response):
+        return codec.encode({"status": 201, "body": response.model_dump(mode="json")})
+
+    return [
+        {"response": "jsonable_encoder + json.dumps", "us": timed(before, responses)},
+        {"response": "model_dump + codec", "us": timed(after, responses)},
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--tags", type=int, default=3)
+    args = parser.parse_args()
+
+    users = make_users(args.users, args.tags)
+    print(f"{'codec':<24}{'encode us':>12}{'decode us':>12}{'bytes':>10}")
+    for row in codec_rows(users):
+        print(
+            f"{row['codec']:<24}{row['encode_us']:>12.2f}"
+            f"{row['decode_us']:>12.2f}{row['bytes']:>10.1f}"
+        )
+    print()
+    print(f"{'idempotency cache entry':<36}{'us':>10}")
+    for row in response_rows(users):
+        print(f"{row['response']:<36}{row['us']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
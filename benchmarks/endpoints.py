@@ -0,0 +1,362 @@
+"""Benchmark the user endpoints in-process and gate on a stored baseline.
+
+The app runs behind an in-process ASGI transport with the same middleware
+stack as app.main. By default it uses an in-memory fakeredis. With
+--redis-url it uses a real server instead, and that database is FLUSHED,
+so only point it at a disposable redis-server.
+
+    python -m benchmarks.endpoints --dataset 10000 --requests 2000 --concurrency 50
+    python -m benchmarks.endpoints --save tests/benchmark_baseline.json
+    python -m benchmarks.endpoints --compare tests/benchmark_baseline.json
+
+Requests authenticate with an admin key of settings.VALID_API_KEYS.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import statistics
+import sys
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import fakeredis
+import httpx
+import redis.asyncio as redis
+from fastapi import FastAPI
+
+from app.core.breaker import CircuitBreaker
+from app.core.config import settings
+from app.main import create_app
+from app.middleware.rate_limit_policies import Limit, RateLimitPolicy
+from app.repositories.api_key_store import RedisApiKeyStore
+from app.repositories.user_repo import RedisUserRepository
+
+# Redis commands per request are deterministic and must not grow at all;
+# latency depends on the machine, so growing by more than this factor plus
+# slack is only reported
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK_MS = 5.0
+
+UNLIMITED = RateLimitPolicy("bench", (Limit(1_000_000_000, 10),))
+
+Request = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int
+    concurrency: int
+    dataset: int
+    throughput: float  # requests per second
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    commands_per_request: float
+
+
+def count_commands(client: redis.Redis) -> Counter:
+    """Count the commands sent on every connection of the client's pool,
+    including the ones packed into pipelines and transactions.
+    """
+    counter: Counter = Counter()
+    pool = client.connection_pool
+    base = pool.connection_class
+
+    class CountingConnection(base):
+        def pack_command(self, *args):
+            counter[str(args[0]).upper()] += 1
+            return super().pack_command(*args)
+
+    pool.connection_class = CountingConnection
+    return counter
+
+
+def build_app(client: redis.Redis) -> FastAPI:
+    # the stack of app.main, with a limit that is never reached; the state
+    # its lifespan would create is set up below
+    app = create_app(lifespan=None, rate_limit_policies=[UNLIMITED])
+    app.state.redis = client
+    app.state.breaker = CircuitBreaker()
+    app.state.user_repo = RedisUserRepository(
+        redis_client=client,
+        breaker=app.state.breaker,
+        storage=settings.USER_STORAGE,
+        codec=settings.USER_CODEC,
+        # write inline so each request pays for its own writes
+        last_active_flush_interval=0,
+        cache_max_entries=settings.USER_CACHE_MAX_ENTRIES,
+        cache_ttl=settings.USER_CACHE_TTL,
+    )
+    app.state.api_keys = RedisApiKeyStore(
+        redis_client=client, breaker=app.state.breaker
+    )
+    return app
+
+
+def _username(i: int) -> str:
+    return f"bench_{i}"
+
+
+async def seed(repo: RedisUserRepository, dataset: int, max_age_days: int) -> None:
+    # last_active ages spread evenly over max_age_days, oldest first
+    now = datetime.now(timezone.utc)
+    for start in range(0, dataset, 1000):
+        users = []
+        for i in range(start, min(start + 1000, dataset)):
+            age = timedelta(days=max_age_days * (1 - i / dataset))
+            users.append(
+                {
+                    "username": _username(i),
+                    "tags": [],
+                    "created_at": (now - age).isoformat(),
+                    "last_active": (now - age).isoformat(),
+                }
+            )
+        await repo.bulk_create_users(users)
+
+
+def admin_key() -> Optional[str]:
+    """Return an admin key of VALID_API_KEYS, or None if there is none."""
+    keys = settings.VALID_API_KEYS.items()
+    return next((key for key, role in keys if role == "admin"), None)
+
+
+def scenarios(dataset: int, requests: int, api_key: str) -> Dict[str, Request]:
+    auth = {"X-API-Key": api_key}
+
+    def create(c: httpx.AsyncClient, i: int):
+        headers = {**auth, "Idempotency-Key": f"bench-{i}"}
+        payload = {"username": f"new_{i}", "tags": ["bench"]}
+        return c.post("/users", json=payload, headers=headers)
+
+    def get(c: httpx.AsyncClient, i: int):
+        return c.get(f"/users/{_username(i % dataset)}", headers=auth)
+
+    def add_tag(c: httpx.AsyncClient, i: int):
+        payload = {"tags": [f"t{i}"]}
+        return c.post(
+            f"/users/{_username(i % dataset)}/tags", json=payload, headers=auth
+        )
+
+    def list_page(c: httpx.AsyncClient, i: int):
+        return c.get("/users", params={"limit": 100}, headers=auth)
+
+    def delete_inactive(c: httpx.AsyncClient, i: int):
+        # each call removes the next slice of the oldest users
+        params = {"inactive_since": requests - i}
+        return c.delete("/admin/users/inactive", params=params, headers=auth)
+
+    return {
+        "create_user": create,
+        "get_user": get,
+        "add_tag": add_tag,
+        "list_users": list_page,
+        "delete_inactive": delete_inactive,
+    }
+
+
+def _percentile(latencies: List[float], q: int) -> float:
+    return statistics.quantiles(latencies, n=100, method="inclusive")[q - 1] * 1000
+
+
+async def run_scenario(
+    client: redis.Redis,
+    counter: Counter,
+    scenario: str,
+    *,
+    api_key: str,
+    dataset: int,
+    requests: int,
+    concurrency: int,
+) -> Result:
+    await client.flushdb()
+    app = build_app(client)
+    try:
+        await seed(app.state.user_repo, dataset, max_age_days=requests + 1)
+        await app.state.api_keys.bootstrap(settings.VALID_API_KEYS)
+        # a worker looks a key up once, measure the cached steady state
+        await app.state.api_keys.get_role(api_key)
+        await asyncio.sleep(0.05)  # and let its invalidation listener subscribe
+        send = scenarios(dataset, requests, api_key)[scenario]
+        counter.clear()
+        latencies: List[float] = []
+        next_request = iter(range(requests))
+
+        async def worker(c: httpx.AsyncClient) -> None:
+            for i in next_request:
+                started = time.perf_counter()
+                response = await send(c, i)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 300:
+                    raise RuntimeError(
+                        f"{scenario}: {response.status_code} {response.text[:200]}"
+                    )
+
+        # leave what was allocated before (e.g. a whole test session) out of
+        # the collections that run during the measurement
+        gc.collect()
+        gc.freeze()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as c:
+                started = time.perf_counter()
+                await asyncio.gather(*(worker(c) for _ in range(concurrency)))
+                elapsed = time.perf_counter() - started
+        finally:
+            gc.unfreeze()
+    finally:
+        await app.state.user_repo.close()
+        await app.state.api_keys.close()
+
+    return Result(
+        scenario=scenario,
+        requests=requests,
+        concurrency=concurrency,
+        dataset=dataset,
+        throughput=requests / elapsed,
+        p50_ms=_percentile(latencies, 50),
+        p95_ms=_percentile(latencies, 95),
+        p99_ms=_percentile(latencies, 99),
+        commands_per_request=sum(counter.values()) / requests,
+    )
+
+
+async def run(
+    *,
+    api_key: str,
+    redis_url: Optional[str] = None,
+    scenario_names: Optional[List[str]] = None,
+    dataset: int = 1000,
+    requests: int = 500,
+    concurrency: int = 10,
+) -> List[Result]:
+    if redis_url:
+        client = redis.Redis.from_url(redis_url, decode_responses=True)
+    else:
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    counter = count_commands(client)
+    names = scenario_names or list(scenarios(dataset, requests, api_key))
+    try:
+        return [
+            await run_scenario(
+                client,
+                counter,
+                name,
+                api_key=api_key,
+                dataset=dataset,
+                requests=requests,
+                concurrency=concurrency,
+            )
+            for name in names
+        ]
+    finally:
+        await client.aclose()
+
+
+def load_baseline(path: str) -> Dict[str, Dict]:
+    with open(path) as f:
+        return {entry["scenario"]: entry for entry in json.load(f)}
+
+
+def save_baseline(path: str, results: List[Result]) -> None:
+    with open(path, "w") as f:
+        json.dump([asdict(r) for r in results], f, indent=2)
+        f.write("\n")
+
+
+def compare(results: List[Result], baseline: Dict[str, Dict]) -> List[str]:
+    """Return one message per scenario whose Redis commands per request
+    grew against the baseline.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result.scenario)
+        if base is not None and (
+            result.commands_per_request > base["commands_per_request"]
+        ):
+            regressions.append(
+                f"{result.scenario} commands_per_request: "
+                f"{result.commands_per_request:.2f} > {base['commands_per_request']:.2f}"
+            )
+    return regressions
+
+
+def compare_latency(results: List[Result], baseline: Dict[str, Dict]) -> List[str]:
+    """Return one message per latency percentile that grew beyond the
+    tolerance against the baseline; advisory, as it depends on the machine.
+    """
+    slowdowns = []
+    for result in results:
+        base = baseline.get(result.scenario)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            limit = base[metric] * LATENCY_TOLERANCE + LATENCY_SLACK_MS
+            value = getattr(result, metric)
+            if value > limit:
+                slowdowns.append(
+                    f"{result.scenario} {metric}: {value:.2f} > {limit:.2f} "
+                    f"(baseline {base[metric]:.2f})"
+                )
+    return slowdowns
+
+
+def print_results(results: List[Result]) -> None:
+    print(
+        f"{'scenario':<16}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}{'cmd/req':>10}"
+    )
+    for r in results:
+        print(
+            f"{r.scenario:<16}{r.throughput:>10.0f}{r.p50_ms:>10.2f}"
+            f"{r.p95_ms:>10.2f}{r.p99_ms:>10.2f}{r.commands_per_request:>10.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", help="Disposable Redis (it is flushed)")
+    parser.add_argument("--scenario", action="append", dest="scenarios")
+    parser.add_argument("--dataset", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--save", metavar="PATH", help="Write results as baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Fail on regressions")
+    args = parser.parse_args()
+    api_key = admin_key()
+    if api_key is None:
+        parser.error("VALID_API_KEYS has no admin key")
+
+    results = asyncio.run(
+        run(
+            api_key=api_key,
+            redis_url=args.redis_url,
+            scenario_names=args.scenarios,
+            dataset=args.dataset,
+            requests=args.requests,
+            concurrency=args.concurrency,
+        )
+    )
+    print_results(results)
+    if args.save:
+        save_baseline(args.save, results)
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        for slowdown in compare_latency(results, baseline):
+            print(f"SLOWER {slowdown}", file=sys.stderr)
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
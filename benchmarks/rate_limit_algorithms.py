@@ -0,0 +1,75 @@
+"""Compare the rate-limit algorithms by Redis work and memory per limited key.
+
+Run against a disposable Redis (INFO commandstats and MEMORY USAGE are used):
+
+    python -m benchmarks.rate_limit_algorithms --calls 20000 --limit 5000
+"""
+
+import argparse
+import time
+
+import redis
+
+from app.core.config import settings
+from app.middleware.rate_limit import ALGORITHMS
+
+
+def command_calls(client: redis.Redis) -> int:
+    stats = client.info("commandstats")
+    # ignore the bookkeeping commands issued by this benchmark
+    return sum(
+        stat["calls"]
+        for name, stat in stats.items()
+        if name not in ("cmdstat_info", "cmdstat_memory", "cmdstat_scan")
+    )
+
+
+def run(client: redis.Redis, algorithm: str, args: argparse.Namespace) -> dict:
+    prefix = f"bench:rl:{algorithm}:"
+    for key in client.scan_iter(match=prefix + "*"):
+        client.delete(key)
+
+    script = client.register_script(ALGORITHMS[algorithm])
+    keys = [f"{prefix}{i}" for i in range(args.keys)]
+    extra = [] if algorithm == "sliding_log" else [1]
+
+    before = command_calls(client)
+    started = time.perf_counter()
+    for i in range(args.calls):
+        script(
+            keys=[keys[i % args.keys]],
+            args=[time.time(), args.window, args.limit, *extra],
+        )
+    elapsed = time.perf_counter() - started
+    commands = command_calls(client) - before
+
+    memory = [client.memory_usage(key) or 0 for key in client.scan_iter(prefix + "*")]
+    return {
+        "algorithm": algorithm,
+        "commands_per_call": commands / args.calls,
+        "bytes_per_key": sum(memory) / max(1, len(memory)),
+        "us_per_call": elapsed / args.calls * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis-url", default=settings.REDIS_URL)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--keys", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=5000)
+    parser.add_argument("--window", type=int, default=60)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    print(f"{'algorithm':<16}{'cmds/call':>12}{'bytes/key':>12}{'us/call':>10}")
+    for algorithm in ALGORITHMS:
+        row = run(client, algorithm, args)
+        print(
+            f"{row['algorithm']:<16}{row['commands_per_call']:>12.2f}"
+            f"{row['bytes_per_key']:>12.0f}{row['us_per_call']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
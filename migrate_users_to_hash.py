@@ -0,0 +1,20 @@
+import asyncio
+
+from app.core.config import settings
+from app.core.redis import create_user_shards
+from app.repositories.user_repo import RedisUserRepository
+
+REDIS_URL = settings.REDIS_URL
+
+
+async def migrate():
+    # run with USER_STORAGE=hash already deployed so new writes use hashes
+    repo = RedisUserRepository(
+        redis_url=REDIS_URL, storage="hash", shards=create_user_shards(settings)
+    )
+    migrated = await repo.migrate_to_hash()
+    print(f"Migrated {migrated} users to the hash layout")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -1,29 +1,236 @@
+"""Seed Redis with generated users for local testing and benchmarks.
+
+Users are written in pipelined batches by several concurrent workers.
+Usernames come from --pattern, so re-running with the same pattern resumes
+from the last checkpoint, and users that already exist are skipped.
+
+    python seed_users.py --count 1000000 --concurrency 8 \\
+        --tags admin=0.01,beta=0.2 --active-age exp:30 --never-active 0.05
+"""
+
+import argparse
 import asyncio
-from app.repositories.user_repo import RedisUserRepository
-from datetime import datetime, timezone
-from app.core.config import settings
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import redis.asyncio as redis
 
+from app.core.config import settings
+from app.core.redis import close_user_shards, create_user_shards
+from app.repositories.user_repo import RedisUserRepository
 
 REDIS_URL = settings.REDIS_URL
+CHECKPOINT_KEY_PREFIX = "seed:checkpoint:"
+
+
+def parse_tags(spec: str) -> Dict[str, float]:
+    """Parse "tag=probability,..."; each tag is given to a user independently."""
+    tags: Dict[str, float] = {}
+    for item in filter(None, spec.split(",")):
+        tag, _, probability = item.partition("=")
+        tags[tag.strip()] = float(probability or 1)
+        if not 0 <= tags[tag.strip()] <= 1:
+            raise argparse.ArgumentTypeError(f"Probability out of range: {item}")
+    return tags
+
+
+def parse_age(spec: str) -> Callable[[random.Random], float]:
+    """Parse a last_active age distribution in days: "uniform:MIN:MAX",
+    "exp:MEAN" or "fixed:DAYS".
+    """
+    kind, *params = spec.split(":")
+    try:
+        values = [float(p) for p in params]
+        if kind == "uniform" and len(values) == 2:
+            low, high = values
+            return lambda rng: rng.uniform(low, high)
+        if kind == "exp" and len(values) == 1:
+            (mean,) = values
+            return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+        if kind == "fixed" and len(values) == 1:
+            (days,) = values
+            return lambda rng: days
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid age distribution: {spec}")
+
+
+class Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.created = 0
+        self.existing = 0
+        self.started = time.monotonic()
 
-async def seed():
-    repo = RedisUserRepository(redis_url= REDIS_URL)
+    @property
+    def done(self) -> int:
+        return self.created + self.existing
 
-    for i in range(1000_000):
-        username = f"user1_{i}"
-        user = {
-            "username": username,
-            "tags": [],
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_active": datetime.now(timezone.utc).isoformat(),
-        }
+    def line(self) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        return (
+            f"{self.done}/{self.total} users ({self.created} created, "
+            f"{self.existing} existing) {rate:,.0f} users/s"
+        )
 
+
+class Seeder:
+    def __init__(
+        self, client: redis.Redis, repo: RedisUserRepository, args: argparse.Namespace
+    ):
+        self.redis = client
+        self.repo = repo
+        self.args = args
+        self.tags = args.tags
+        self.age = args.active_age
+        self.now = datetime.now(timezone.utc)
+        self.checkpoint_key = CHECKPOINT_KEY_PREFIX + args.pattern
+        self.completed: Dict[int, int] = {}  # batch start -> batch stop
+        self.watermark = 0  # every user below this index is written
+
+    def batch_users(self, start: int, stop: int) -> List[Dict]:
+        rng = random.Random(f"{self.args.seed}:{start}")
+        users = []
+        for i in range(start, stop):
+            tags = [tag for tag, p in self.tags.items() if rng.random() < p]
+            user = {"username": self.args.pattern.format(i=i), "tags": tags}
+            if rng.random() < self.args.never_active:
+                created = self.now - timedelta(days=rng.uniform(0, 365))
+            else:
+                last_active = self.now - timedelta(days=self.age(rng))
+                created = last_active - timedelta(days=rng.uniform(0, 365))
+                user["last_active"] = last_active.isoformat()
+            user["created_at"] = created.isoformat()
+            users.append(user)
+        return users
+
+    async def load_checkpoint(self) -> int:
+        if not self.args.resume:
+            return 0
+        value = await self.redis.get(self.checkpoint_key)
+        return int(value) if value else 0
+
+    async def mark_done(self, start: int, stop: int) -> None:
+        # batches finish out of order; only checkpoint a contiguous prefix
+        self.completed[start] = stop
+        advanced = False
+        while self.watermark in self.completed:
+            self.watermark = self.completed.pop(self.watermark)
+            advanced = True
+        if advanced:
+            await self.redis.set(self.checkpoint_key, self.watermark)
+
+    async def worker(self, queue: asyncio.Queue, progress: Progress) -> None:
+        while True:
+            start, stop = await queue.get()
+            try:
+                users = self.batch_users(start, stop)
+                created = await self.repo.bulk_create_users(users)
+                progress.created += sum(created)
+                progress.existing += len(created) - sum(created)
+                await self.mark_done(start, stop)
+            finally:
+                queue.task_done()
+
+    async def run(self) -> Progress:
+        count, batch_size = self.args.count, self.args.batch_size
+        first = self.watermark = min(await self.load_checkpoint(), count)
+        progress = Progress(count - first)
+        if first:
+            print(f"Resuming at user {first}")
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.args.concurrency * 2)
+        workers = [
+            asyncio.create_task(self.worker(queue, progress))
+            for _ in range(self.args.concurrency)
+        ]
+        reporter = asyncio.create_task(report(progress, self.args.report_interval))
+
+        async def enqueue() -> None:
+            for start in range(first, count, batch_size):
+                await queue.put((start, min(start + batch_size, count)))
+            await queue.join()
+
+        feeder = asyncio.create_task(enqueue())
         try:
-            await repo.create_user(user)
-        except KeyError:
-            pass  # user already exists
+            # workers only finish by failing; stop on the first failure, or
+            # once every batch is written
+            done, _ = await asyncio.wait(
+                [feeder, *workers], return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+        finally:
+            for task in (feeder, *workers, reporter):
+                task.cancel()
+            await asyncio.gather(feeder, *workers, reporter, return_exceptions=True)
+        return progress
+
+
+async def report(progress: Progress, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(f"\r{progress.line()}", end="", file=sys.stderr, flush=True)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument(
+        "--pattern", default="user_{i}", help="Username format, {i} is the index"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tags", type=parse_tags, default={}, help="tag=p,...")
+    parser.add_argument(
+        "--active-age",
+        type=parse_age,
+        default=parse_age("uniform:0:90"),
+        help="last_active age in days: uniform:MIN:MAX, exp:MEAN or fixed:DAYS",
+    )
+    parser.add_argument(
+        "--never-active",
+        type=float,
+        default=0.0,
+        help="Fraction of users without last_active",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="Ignore the checkpoint and start from the first user",
+    )
+    parser.add_argument("--report-interval", type=float, default=1.0)
+    args = parser.parse_args(argv)
+    if "{i" not in args.pattern:
+        parser.error("--pattern must contain {i}")
+    return args
+
 
-    print("Inserted 1000 users")
+async def seed(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    client = redis.Redis.from_url(
+        REDIS_URL, decode_responses=True, max_connections=args.concurrency + 1
+    )
+    # users go where the sharded API looks for them; the checkpoint stays
+    # on REDIS_URL
+    shards = create_user_shards(settings)
+    repo = RedisUserRepository(
+        redis_client=client, shards=shards, storage=settings.USER_STORAGE
+    )
+    try:
+        progress = await Seeder(client, repo, args).run()
+    finally:
+        await repo.close()
+        await close_user_shards(shards)
+        await client.aclose()
+    print(f"\r{progress.line()}", file=sys.stderr)
+    print(f"Created {progress.created} users, {progress.existing} already existed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import asyncio
+
+import fakeredis
+import pytest
+from redis.exceptions import ConnectionError
+
+from app.core.breaker import CircuitBreaker, CircuitOpenError, RedisUnavailableError
+from app.repositories.api_key_store import API_KEYS_KEY, RedisApiKeyStore, key_id
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+async def test_bootstrap_seeds_only_an_empty_store(redis):
+    store = RedisApiKeyStore(redis_client=redis)
+
+    assert await store.bootstrap({"a": "admin", "u": "user"}) == 2
+    assert await store.bootstrap({"other": "admin"}) == 0
+    assert await store.list_keys() == {key_id("a"): "admin", key_id("u"): "user"}
+
+
+async def test_lookups_are_cached_including_unknown_keys(redis):
+    store = RedisApiKeyStore(redis_client=redis, cache_ttl=60, negative_cache_ttl=60)
+    await store.bootstrap({"a": "admin"})
+
+    assert await store.get_role("a") == "admin"
+    assert await store.get_role("nope") is None
+    # answered from the cache even once Redis changed behind its back
+    await redis.delete(API_KEYS_KEY)
+    assert await store.get_role("a") == "admin"
+    assert await store.get_role("nope") is None
+    assert store.stats()["hits"] == 2 and store.stats()["misses"] == 2
+
+    await asyncio.sleep(0.05)  # let the invalidation listener subscribe
+    await store.close()
+
+
+async def test_changes_reach_other_workers_through_pubsub(redis):
+    worker_a = RedisApiKeyStore(redis_client=redis, cache_ttl=60)
+    worker_b = RedisApiKeyStore(redis_client=redis, negative_cache_ttl=60)
+
+    await worker_b.get_role("unknown")  # cached as invalid by b
+    api_key, kid = await worker_a.create_key("user")
+    assert await worker_a.get_role(api_key) == "user"
+    await asyncio.sleep(0.05)  # let the invalidation listeners subscribe
+
+    assert await worker_b.revoke(kid)
+    await asyncio.sleep(0.05)
+    assert await worker_a.get_role(api_key) is None
+    assert not await worker_b.revoke(kid)
+
+    await worker_a.close()
+    await worker_b.close()
+
+
+async def test_outage_fails_fast_and_keeps_the_cache(monkeypatch):
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    store = RedisApiKeyStore(redis_client=redis, cache_ttl=60, breaker=breaker)
+    await store.bootstrap({"a": "admin"})
+
+    def unreachable():
+        raise ConnectionError("unreachable")
+
+    monkeypatch.setattr(redis, "pubsub", unreachable)
+    assert await store.get_role("a") == "admin"
+    await asyncio.sleep(0.05)  # the invalidation listener has failed by now
+
+    server.connected = False
+    with pytest.raises(RedisUnavailableError):
+        await store.get_role("b")
+    with pytest.raises(CircuitOpenError):
+        await store.get_role("b")
+    # cached keys still work
+    assert await store.get_role("a") == "admin"
+
+    await store.close()
+
+
+async def test_admin_operations_fail_as_unavailable_during_an_outage():
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60)
+    store = RedisApiKeyStore(redis_client=redis, breaker=breaker)
+
+    server.connected = False
+    with pytest.raises(RedisUnavailableError):
+        await store.create_key("user")
+    with pytest.raises(RedisUnavailableError):
+        await store.revoke("kid")
+    with pytest.raises(RedisUnavailableError):
+        await store.list_keys()
+
+    await store.close()
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from starlette.responses import Response
+
+from app.core.breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RedisUnavailableError,
+)
+from app.core.metrics import CIRCUIT_TRANSITIONS
+from app.middleware.rate_limit import RedisRateLimitMiddleware
+from app.repositories.user_repo import RedisUserRepository
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+async def test_breaker_opens_fails_fast_and_closes_after_a_trial(server):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    repo = RedisUserRepository(
+        redis_client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+        breaker=breaker,
+    )
+    await repo.create_user({"username": "alice", "tags": []})
+    opened = CIRCUIT_TRANSITIONS.value(CLOSED, OPEN)
+
+    server.connected = False
+    for _ in range(2):
+        with pytest.raises(RedisUnavailableError):
+            await repo.get_user("alice")
+    assert breaker.state == OPEN
+    assert CIRCUIT_TRANSITIONS.value(CLOSED, OPEN) == opened + 1
+
+    server.connected = True  # Redis is back, but the circuit is still open
+    with pytest.raises(CircuitOpenError):
+        await repo.get_user("alice")
+
+    await asyncio.sleep(0.06)
+    assert (await repo.get_user("alice"))["username"] == "alice"  # the trial
+    assert breaker.state == CLOSED
+    assert CIRCUIT_TRANSITIONS.value(HALF_OPEN, CLOSED) >= 1
+    assert breaker.stats()["rejected"] == 1
+
+
+async def test_missing_users_do_not_count_as_failures(server):
+    breaker = CircuitBreaker(failure_threshold=1)
+    repo = RedisUserRepository(
+        redis_client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+        breaker=breaker,
+    )
+
+    with pytest.raises(KeyError):
+        await repo.delete_user("ghost")
+    assert breaker.state == CLOSED
+
+
+async def test_slow_calls_time_out():
+    breaker = CircuitBreaker(failure_threshold=1, timeouts={"read": 0.01})
+
+    with pytest.raises(RedisUnavailableError):
+        async with breaker.guard("read"):
+            await asyncio.sleep(1)
+    assert breaker.state == OPEN
+
+
+@pytest.mark.parametrize(
+    "failure_mode, statuses",
+    [
+        ("local", [200, 200, 429]),
+        ("open", [200, 200, 200]),
+        ("closed", [503, 503, 503]),
+    ],
+)
+async def test_rate_limiter_without_redis_follows_the_failure_mode(
+    server, failure_mode, statuses
+):
+    server.connected = False
+    redis = fakeredis.FakeAsyncRedis(server=server)
+    breaker = CircuitBreaker(failure_threshold=1)
+    app = SimpleNamespace(state=SimpleNamespace(redis=redis, breaker=breaker))
+
+    async def ok(scope, receive, send):
+        await Response("OK")(scope, receive, send)
+
+    middleware = RedisRateLimitMiddleware(
+        ok, max_calls=2, window_seconds=60, failure_mode=failure_mode
+    )
+    seen = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            seen.append(message["status"])
+
+    for _ in range(3):
+        scope = {"type": "http", "path": "/users", "headers": [], "app": app}
+        await middleware(scope, None, send)
+
+    assert seen == statuses
+    assert breaker.state == OPEN  # only the first call tried Redis
+    assert breaker.stats()["rejected"] == 2
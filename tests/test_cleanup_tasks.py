@@ -0,0 +1,63 @@
+import time
+
+import fakeredis
+import pytest
+
+from app.core.celery_app import celery_app
+from app.repositories import celery_user_repo
+from app.repositories.celery_user_repo import RedisUserRepositorySync
+from app.repositories.user_repo import ACTIVITY_INDEX_KEY
+from app.users import tasks
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(
+        celery_user_repo.redis.Redis, "from_url", lambda *a, **kw: client
+    )
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    return client
+
+
+def seed(client, now):
+    # 50 never-active users, then one user every hour going back 100 hours
+    for i in range(150):
+        client.set(f"user:u{i}", "{}")
+        score = 0 if i < 50 else now - (i - 50) * 3600
+        client.zadd(ACTIVITY_INDEX_KEY, {f"u{i}": score})
+
+
+def test_partitions_are_disjoint_and_cover_the_cutoff(redis):
+    now = time.time()
+    seed(redis, now)
+    repo = RedisUserRepositorySync()
+
+    partitions = repo.inactive_partitions(now - DAY, 4)
+
+    assert len(partitions) == 3  # the never-active users tie at score 0
+    assert partitions[0][0] == "-inf"
+    assert float(partitions[-1][1]) == now - DAY
+    for (_, high), (low, _) in zip(partitions, partitions[1:]):
+        assert high == low
+    deleted = [repo.delete_inactive_range(low, high) for low, high in partitions]
+    assert sum(deleted) == 50 + 75  # never active, and older than a day
+    assert min(deleted) > 0
+
+
+def test_cleanup_fans_out_and_releases_the_lock(redis):
+    seed(redis, time.time())
+
+    assert tasks.cleanup_inactive_users.delay().get() > 1
+    assert redis.zcard(ACTIVITY_INDEX_KEY) == 24
+    assert redis.get(tasks.CLEANUP_LOCK_KEY) is None
+
+
+def test_cleanup_skips_while_another_run_holds_the_lock(redis):
+    seed(redis, time.time())
+    redis.set(tasks.CLEANUP_LOCK_KEY, "other-run")
+
+    assert tasks.cleanup_inactive_users.delay().get() is None
+    assert redis.zcard(ACTIVITY_INDEX_KEY) == 150
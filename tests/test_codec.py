@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from app.repositories import codec
+
+USER = {"username": "amy", "tags": ["a"], "last_active": "2024-01-01T00:00:00+00:00"}
+
+
+def test_json_codec_reads_stdlib_json():
+    assert codec.decode(json.dumps(USER)) == USER
+    assert codec.decode(json.dumps(USER).encode()) == USER
+    assert codec.get_codec("json").encode(USER).startswith(b"{")
+
+
+def test_msgpack_codec_is_marked_and_detected():
+    pytest.importorskip("msgpack")
+    data = codec.get_codec("msgpack").encode(USER)
+
+    assert data.startswith(codec.MSGPACK_MARKER)
+    assert codec.decode(data) == USER
+    assert len(data) < len(json.dumps(USER))
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        codec.get_codec("pickle")
@@ -0,0 +1,38 @@
+import os
+import warnings
+
+import pytest
+
+from benchmarks import endpoints
+
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+
+
+@pytest.fixture
+def api_key():
+    key = endpoints.admin_key()
+    if key is None:
+        pytest.skip("VALID_API_KEYS has no admin key")
+    return key
+
+
+@pytest.mark.benchmark
+async def test_endpoints_do_not_regress_against_baseline(api_key):
+    # refresh with: python -m benchmarks.endpoints --dataset 200 --requests 100
+    #   --concurrency 5 --save tests/benchmark_baseline.json
+    baseline = endpoints.load_baseline(BASELINE)
+    params = next(iter(baseline.values()))
+
+    results = await endpoints.run(
+        api_key=api_key,
+        scenario_names=list(baseline),
+        dataset=params["dataset"],
+        requests=params["requests"],
+        concurrency=params["concurrency"],
+    )
+
+    endpoints.print_results(results)
+    # latency depends on the machine running the suite: reported, not failed
+    for slowdown in endpoints.compare_latency(results, baseline):
+        warnings.warn(f"slower than the baseline: {slowdown}")
+    assert endpoints.compare(results, baseline) == []
@@ -0,0 +1,80 @@
+import fakeredis
+import httpx
+from fastapi import FastAPI
+
+from app.core.metrics import (
+    HTTP_REQUESTS,
+    RATE_LIMIT_DECISIONS,
+    REDIS_COMMAND_DURATION,
+    Counter,
+    Histogram,
+    Registry,
+)
+from app.core.redis import InstrumentedRedis
+from app.middleware.metrics import MetricsMiddleware
+from app.middleware.rate_limit import RedisRateLimitMiddleware
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    calls = registry.register(Counter("calls_total", "Calls.", ("path",)))
+    latency = registry.register(Histogram("latency_seconds", "Latency.", (), (0.1, 1)))
+    calls.inc('/a"b')
+    latency.observe(0.1)
+    latency.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# HELP calls_total Calls.",
+        "# TYPE calls_total counter",
+        'calls_total{path="/a\\"b"} 1.0',
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_sum 5.1",
+        "latency_seconds_count 2",
+    ]
+
+
+async def test_requests_are_recorded_per_route_template():
+    app = FastAPI()
+    app.state.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    app.add_middleware(RedisRateLimitMiddleware, max_calls=1, algorithm="gcra")
+    app.add_middleware(MetricsMiddleware)
+    before = {
+        status: HTTP_REQUESTS.value("GET", "/items/{item_id}", status)
+        for status in ("200", "429")
+    }
+    denied = RATE_LIMIT_DECISIONS.value("api_key", "denied")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        headers = {"X-API-Key": "metrics-test"}
+        assert (await c.get("/items/1", headers=headers)).status_code == 200
+        assert (await c.get("/items/2", headers=headers)).status_code == 429
+
+    assert HTTP_REQUESTS.value("GET", "/items/{item_id}", "200") == before["200"] + 1
+    assert HTTP_REQUESTS.value("GET", "/items/{item_id}", "429") == before["429"] + 1
+    assert RATE_LIMIT_DECISIONS.value("api_key", "denied") == denied + 1
+
+
+async def test_instrumented_redis_times_commands_and_pipelines():
+    pool = fakeredis.FakeAsyncRedis(decode_responses=True).connection_pool
+    client = InstrumentedRedis(connection_pool=pool)
+    sets = REDIS_COMMAND_DURATION.count("SET")
+    pipelines = REDIS_COMMAND_DURATION.count("PIPELINE")
+
+    await client.set("k", "v")
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.get("k")
+        pipe.get("k")
+        assert await pipe.execute() == ["v", "v"]
+
+    assert REDIS_COMMAND_DURATION.count("SET") == sets + 1
+    assert REDIS_COMMAND_DURATION.count("PIPELINE") == pipelines + 1
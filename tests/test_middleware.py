@@ -1,5 +1,5 @@
 import pytest
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Response
 from unittest.mock import AsyncMock, Mock
 
 from redis import Redis
@@ -12,6 +12,27 @@ from types import SimpleNamespace
 def app():
     return fastapi_app
 
+
+async def call_middleware(middleware, scope):
+    # drive the ASGI middleware and collect the response status
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await middleware(scope, receive, send)
+    return messages[0]["status"]
+
+
+def next_app(status_code):
+    async def asgi_app(scope, receive, send):
+        await Response("OK", status_code=status_code)(scope, receive, send)
+
+    return asgi_app
+
 @pytest.mark.asyncio
 async def test_rate_limit_allows_request(app):
     # checks that the rate-limit middleware lets a request pass through when the user has not exceeded the limit.
@@ -19,26 +40,20 @@ async def test_rate_limit_allows_request(app):
     redis.get.return_value = None
     redis.incr.return_value = 1
 
-    middleware = RedisRateLimitMiddleware(app, redis_client=Mock(spec_set=Redis))
+    middleware = RedisRateLimitMiddleware(next_app(200), redis_client=Mock(spec_set=Redis))
 
-    async def call_next(request: Request):
-        return Response("OK", status_code=200)
-    
     # fake request
-    request = Request(
-        scope={
-            "type": "http",
-            "headers": [],
-            "app": SimpleNamespace(state=SimpleNamespace(redis=redis)),
-            "path": "/users",
-            "method": "POST",
-
-        }
-    )
-    response = await middleware.dispatch(request, call_next)
+    scope = {
+        "type": "http",
+        "headers": [],
+        "app": SimpleNamespace(state=SimpleNamespace(redis=redis)),
+        "path": "/users",
+        "method": "POST",
+    }
+    status_code = await call_middleware(middleware, scope)
 
     assert isinstance(app, FastAPI)
-    assert response.status_code == 200
+    assert status_code == 200
 
 @pytest.mark.asyncio
 async def test_rate_limit_blocks_request():
@@ -47,23 +62,21 @@ async def test_rate_limit_blocks_request():
     redis.get.return_value = 5
     redis.incr.return_value = 6 # over the limit
     redis.expire.return_value = True
+    redis.evalsha.return_value = ["6", "0"]  # over the limit
 
     app = SimpleNamespace(state=SimpleNamespace(redis=redis))
-    middleware = RedisRateLimitMiddleware(app, redis_client=Mock(spec_set=Redis))
-
-    async def call_next(request):
-        return Response("Too many request", status_code=429)
-
-    request = Request(
-        scope={
-            "type": "http",
-            "method": "POST",
-            "path": "/users",
-            "headers": [],
-            "app": app,
-        }
+    middleware = RedisRateLimitMiddleware(
+        next_app(200), redis_client=Mock(spec_set=Redis), max_calls=5
     )
 
-    response = await middleware.dispatch(request, call_next)
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/users",
+        "headers": [],
+        "app": app,
+    }
+
+    status_code = await call_middleware(middleware, scope)
 
-    assert response.status_code == 429
+    assert status_code == 429
@@ -0,0 +1,64 @@
+import time
+
+import fakeredis
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+
+from app.middleware.body_capture import RequestBodyCaptureMiddleware
+from app.middleware.rate_limit import RedisRateLimitMiddleware
+
+REQUESTS = 300
+
+
+def build_app(with_middleware: bool) -> FastAPI:
+    app = FastAPI()
+    app.state.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    @app.post("/users")
+    async def create(request: Request):
+        payload = await request.json()
+        return {"captured": len(request.scope.get("_body", b"")), **payload}
+
+    if with_middleware:
+        app.add_middleware(
+            RedisRateLimitMiddleware,
+            redis_client=app.state.redis,
+            max_calls=1_000_000,
+            algorithm="gcra",
+        )
+        app.add_middleware(RequestBodyCaptureMiddleware, routes=[("POST", "/users")])
+    return app
+
+
+async def requests_per_second(app: FastAPI) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        started = time.perf_counter()
+        for i in range(REQUESTS):
+            response = await c.post("/users", json={"username": f"user_{i}"})
+            assert response.status_code == 200
+        return REQUESTS / (time.perf_counter() - started)
+
+
+@pytest.mark.benchmark
+async def test_middleware_stack_throughput():
+    bare = await requests_per_second(build_app(with_middleware=False))
+    stacked = await requests_per_second(build_app(with_middleware=True))
+
+    print(f"\nbare: {bare:.0f} req/s, with middleware stack: {stacked:.0f} req/s")
+    # the stack costs one limiter round trip per request (in-memory here)
+    assert stacked > bare * 0.2
+
+
+async def test_body_capture_is_capped():
+    app = build_app(with_middleware=True)
+    app.user_middleware.clear()
+    app.add_middleware(
+        RequestBodyCaptureMiddleware, routes=[("POST", "/users")], max_bytes=10
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        response = await c.post("/users", json={"username": "abcdefghijkl"})
+
+    assert response.json()["captured"] == 10
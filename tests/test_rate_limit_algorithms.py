@@ -0,0 +1,216 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import fakeredis
+import pytest
+from starlette.responses import Response
+
+from app.middleware.rate_limit import (
+    GCRA_SCRIPT,
+    MULTI_ALGORITHMS,
+    SLIDING_WINDOW_SCRIPT,
+    LocalRateLimiter,
+    RedisRateLimitMiddleware,
+)
+from app.middleware.rate_limit_policies import (
+    Limit,
+    PolicyMatcher,
+    RateLimitPolicy,
+    load_policies,
+)
+from app.repositories.api_key_store import key_id
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.mark.parametrize("script", [GCRA_SCRIPT, SLIDING_WINDOW_SCRIPT])
+async def test_constant_state_algorithms_enforce_limit(redis, script):
+    now = 1_000_000.0
+
+    async def call(at, requested=1):
+        granted, retry = await redis.eval(script, 1, "rl:k", at, 10, 5, requested)
+        return int(granted), float(retry)
+
+    for _ in range(5):
+        assert (await call(now))[0] == 1
+    granted, retry = await call(now)
+    assert granted == 0 and retry > 0
+
+    # a single small key holds the whole state, rejected calls add nothing
+    assert await redis.keys("*") == ["rl:k"]
+    # capacity comes back after the window has passed
+    assert (await call(now + 20, requested=10))[0] == 5
+
+
+async def test_token_leasing_cuts_round_trips(redis, monkeypatch):
+    evals = 0
+    evalsha = redis.evalsha
+
+    async def counting_evalsha(*args, **kwargs):
+        nonlocal evals
+        evals += 1
+        return await evalsha(*args, **kwargs)
+
+    monkeypatch.setattr(redis, "evalsha", counting_evalsha)
+    app = SimpleNamespace(state=SimpleNamespace(redis=redis))
+
+    async def ok(scope, receive, send):
+        await Response("OK")(scope, receive, send)
+
+    middleware = RedisRateLimitMiddleware(
+        ok, redis_client=redis, max_calls=25, algorithm="gcra", lease_size=10
+    )
+
+    statuses = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    for _ in range(30):
+        scope = {"type": "http", "path": "/users", "headers": [], "app": app}
+        await middleware(scope, None, send)
+
+    assert statuses.count(200) == 25
+    assert statuses[25:] == [429] * 5
+    # three leases (10 + 10 + 5) and one rejection that is then cached locally
+    assert evals == 4
+
+
+def test_policy_matcher_picks_first_match_by_method_and_role():
+    policies = load_policies(
+        [
+            {
+                "name": "bulk",
+                "path": "/admin/users/bulk",
+                "methods": ["post"],
+                "roles": ["admin"],
+                "limits": [{"max_calls": 1, "window_seconds": 10}],
+            },
+            {
+                "name": "tags",
+                "path": "/users/{username}/tags",
+                "limits": [{"max_calls": 1, "window_seconds": 10}],
+            },
+            {"name": "default", "limits": [{"max_calls": 5, "window_seconds": 10}]},
+        ]
+    )
+    matcher = PolicyMatcher(policies)
+
+    def name(method, path, role=None):
+        return matcher.match(method, path, role).name
+
+    assert name("POST", "/admin/users/bulk", "admin") == "bulk"
+    assert name("POST", "/admin/users/bulk", "user") == "default"
+    assert name("GET", "/admin/users/bulk", "admin") == "default"
+    assert name("PATCH", "/users/alice/tags") == "tags"
+    assert name("POST", "/users/alice/tags/extra") == "default"
+
+    with pytest.raises(ValueError):
+        load_policies([{"name": "a", "limits": []}])
+    with pytest.raises(ValueError):
+        load_policies(
+            [{"name": "a", "limits": [{"max_calls": 1, "window_seconds": 1}]}] * 2
+        )
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_log", "gcra", "sliding_window"])
+async def test_multi_limit_policy_enforces_burst_and_sustained_limits(redis, algorithm):
+    now = 1_000_000.0
+    keys = ["rl:p:k:0", "rl:p:k:1"]
+    script = MULTI_ALGORITHMS[algorithm]
+
+    async def call(at):
+        # 2 calls per 10s burst, 3 calls per hour
+        granted, _ = await redis.eval(script, 2, *keys, at, 1, 10, 2, 3600, 3)
+        return int(granted)
+
+    assert [await call(now) for _ in range(3)] == [1, 1, 0]
+    # the burst window has passed, the sustained limit still has one call
+    assert [await call(now + 30) for _ in range(2)] == [1, 0]
+    assert await call(now + 60) == 0
+
+
+async def test_admin_bulk_has_its_own_budget(redis):
+    api_keys = SimpleNamespace(get_role=AsyncMock(side_effect=lambda key: key))
+    app = SimpleNamespace(state=SimpleNamespace(redis=redis, api_keys=api_keys))
+
+    async def ok(scope, receive, send):
+        await Response("OK")(scope, receive, send)
+
+    policies = [
+        RateLimitPolicy(
+            "admin-bulk",
+            (Limit(1, 10), Limit(5, 3600)),
+            path="/admin/users/bulk",
+            methods=frozenset({"POST"}),
+            roles=frozenset({"admin"}),
+        ),
+        RateLimitPolicy("default", (Limit(2, 10),)),
+    ]
+    middleware = RedisRateLimitMiddleware(
+        ok, redis_client=redis, policies=policies, algorithm="gcra"
+    )
+
+    async def status(method, path, key):
+        statuses = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message["status"])
+
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "headers": [(b"x-api-key", key.encode())],
+            "app": app,
+        }
+        await middleware(scope, None, send)
+        return statuses[0]
+
+    assert await status("POST", "/admin/users/bulk", "admin") == 200
+    assert await status("POST", "/admin/users/bulk", "admin") == 429
+    # the admin's other calls are not charged to the bulk budget
+    assert await status("GET", "/users/alice", "admin") == 200
+    assert await status("GET", "/users/alice", "admin") == 200
+    assert await status("GET", "/users/alice", "admin") == 429
+    # other roles fall through to the default policy
+    assert await status("POST", "/admin/users/bulk", "user") == 200
+
+
+async def test_counters_do_not_reveal_api_keys(redis):
+    app = SimpleNamespace(state=SimpleNamespace(redis=redis))
+
+    async def ok(scope, receive, send):
+        await Response("OK")(scope, receive, send)
+
+    async def send(message):
+        pass
+
+    middleware = RedisRateLimitMiddleware(ok, redis_client=redis, algorithm="gcra")
+    scope = {
+        "type": "http",
+        "path": "/users",
+        "headers": [(b"x-api-key", b"s3cret")],
+        "app": app,
+    }
+    await middleware(scope, None, send)
+
+    assert await redis.keys("*") == [f"rl:default:{key_id('s3cret')}"]
+
+
+def test_local_fallback_keeps_live_counters_of_longer_windows():
+    local = LocalRateLimiter(max_keys=2)
+    hourly = (Limit(1, 3600),)
+    now = 1_000_000.0
+
+    assert local.hit(["rl:hourly:a"], hourly, now) is None
+    # short windows come and go, and make the limiter prune
+    for i in range(5):
+        assert local.hit([f"rl:burst:{i}"], (Limit(1, 1),), now + 10 + i) is None
+
+    assert local.hit(["rl:hourly:a"], hourly, now + 20) > 0
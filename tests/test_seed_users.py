@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from seed_users import Seeder, parse_args
+
+
+class FailingRepo:
+    def __init__(self, fail_from: int):
+        self.fail_from = fail_from
+        self.written = []
+
+    async def bulk_create_users(self, users):
+        await asyncio.sleep(0)
+        if any(int(u["username"].split("_")[1]) >= self.fail_from for u in users):
+            raise RuntimeError("write failed")
+        self.written.extend(u["username"] for u in users)
+        return [True] * len(users)
+
+
+class Checkpoints(dict):
+    # stands in for the checkpoint client; fakeredis can swallow the
+    # cancellation of a worker that is mid-checkpoint
+    async def get(self, key):
+        return dict.get(self, key)
+
+    async def set(self, key, value):
+        self[key] = value
+
+
+def seeder(repo, *argv):
+    return Seeder(Checkpoints(), repo, parse_args(["--report-interval", "60", *argv]))
+
+
+async def test_a_failing_final_batch_fails_the_run():
+    repo = FailingRepo(fail_from=20)
+    run = seeder(repo, "--count", "25", "--batch-size", "10").run()
+
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(run, 5)
+    assert sorted(repo.written) == sorted(f"user_{i}" for i in range(20))
+
+
+async def test_the_run_fails_rather_than_hangs_when_every_worker_fails():
+    repo = FailingRepo(fail_from=0)
+    argv = ["--count", "1000", "--batch-size", "10", "--concurrency", "2"]
+
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(seeder(repo, *argv).run(), 5)
@@ -0,0 +1,36 @@
+from app.api.streaming import iter_json_array, iter_ndjson
+
+
+async def _chunks(body: bytes, size: int):
+    for i in range(0, len(body), size):
+        yield body[i : i + size]
+
+
+async def _parse(parse, body: bytes, size: int = 3):
+    return [item async for item in parse(_chunks(body, size))]
+
+
+async def test_json_array_elements_split_across_chunks():
+    body = '[{"username": "añá"}, 12, {"tags": ["a", "b"]} ]'.encode()
+
+    assert await _parse(iter_json_array, body) == [
+        ({"username": "añá"}, None),
+        (12, None),
+        ({"tags": ["a", "b"]}, None),
+    ]
+
+
+async def test_json_array_syntax_error_ends_stream():
+    parsed = await _parse(iter_json_array, b'[{"a": 1}, {"b": ]')
+
+    assert parsed[0] == ({"a": 1}, None)
+    assert parsed[1][0] is None and parsed[1][1].startswith("Invalid JSON")
+    assert len(parsed) == 2
+
+
+async def test_ndjson_reports_bad_lines_and_continues():
+    parsed = await _parse(iter_ndjson, b'{"a": 1}\nnope\n\n{"b": 2}')
+
+    assert parsed[0] == ({"a": 1}, None)
+    assert parsed[1][0] is None
+    assert parsed[2] == ({"b": 2}, None)
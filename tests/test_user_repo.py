@@ -0,0 +1,614 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from app.repositories import user_repo
+from app.repositories.replicas import same_replicas, session
+from app.repositories.sharding import Shard, cluster_shards, node_shards
+from app.repositories.user_repo import (
+    ACTIVITY_INDEX_KEY,
+    TAG_KEY_PREFIX,
+    TOUCH_USER_JSON_SCRIPT,
+    USER_VERSIONS_KEY,
+    RedisUserRepository,
+)
+from app.repositories.write_behind import LastActiveBuffer
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(user_repo.redis, "from_url", lambda *a, **kw: client)
+    return client
+
+
+@pytest.fixture
+def repo(redis):
+    return RedisUserRepository(redis_url="redis://fake")
+
+
+async def test_delete_inactive_users_uses_activity_index(repo, redis):
+    now = time.time()
+    await repo.create_user({"username": "old", "tags": [], "last_active": now - 900})
+    await repo.create_user({"username": "new", "tags": [], "last_active": now})
+    await repo.create_user({"username": "never", "tags": []})
+
+    deleted = await repo.delete_inactive_users(now - 60)
+
+    assert deleted == 2
+    assert await repo.get_user("new") is not None
+    assert await repo.get_user("old") is None
+    assert await redis.zrange(ACTIVITY_INDEX_KEY, 0, -1) == ["new"]
+
+
+async def test_touch_and_delete_keep_index_in_sync(repo, redis):
+    await repo.create_user({"username": "alice", "tags": []})
+    await repo.touch_user("alice")
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "alice") > 0
+
+    await repo.delete_user("alice")
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "alice") is None
+    with pytest.raises(KeyError):
+        await repo.delete_user("alice")
+
+
+def _between_read_and_write(repo, monkeypatch, interleave):
+    # runs interleave() once, after a last_active flush has read the user
+    mget_undecoded = repo._mget_undecoded
+    pending = [interleave]
+
+    async def reading(shard, keys):
+        values = await mget_undecoded(shard, keys)
+        while pending:
+            await pending.pop()()
+        return values
+
+    monkeypatch.setattr(repo, "_mget_undecoded", reading)
+
+
+async def test_touch_does_not_lose_a_concurrent_add_tag(repo, monkeypatch):
+    await repo.create_user({"username": "alice", "tags": []})
+    _between_read_and_write(repo, monkeypatch, lambda: repo.add_tag("alice", ["new"]))
+
+    await repo.touch_user("alice")
+
+    user = await repo.get_user("alice", primary=True)
+    assert user["tags"] == ["new"]
+    assert user["last_active"] is not None
+
+
+async def test_touch_does_not_resurrect_a_deleted_user(repo, redis, monkeypatch):
+    await repo.create_user({"username": "alice", "tags": []})
+    _between_read_and_write(repo, monkeypatch, lambda: repo.delete_user("alice"))
+
+    await repo.touch_user("alice")
+
+    assert await repo.get_user("alice", primary=True) is None
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "alice") is None
+
+
+async def test_rebuild_activity_index(repo, redis):
+    await redis.set("user:bob", '{"username": "bob", "tags": [], "last_active": 42}')
+
+    assert await repo.rebuild_activity_index() == 1
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "bob") == 42
+
+
+async def test_list_users_page_resumes_from_cursor(repo):
+    for i in range(25):
+        await repo.create_user({"username": f"user_{i}", "tags": []})
+
+    seen = {}
+    users, cursor = await repo.list_users_page(0, 10)
+    seen.update(users)
+    while cursor:
+        users, cursor = await repo.list_users_page(cursor, 10)
+        seen.update(users)
+
+    assert set(seen) == {f"user_{i}" for i in range(25)}
+    assert len([user async for user in repo.iter_users(7)]) == 25
+
+
+async def test_out_of_range_cursors_are_rejected(repo):
+    for cursor in (-1, 2**64):
+        with pytest.raises(ValueError):
+            await repo.list_users_page(cursor)
+        with pytest.raises(ValueError):
+            await repo.tag_counts(cursor=cursor)
+
+
+async def test_hash_storage_updates_fields_in_place(redis):
+    repo = RedisUserRepository(redis_url="redis://fake", storage="hash")
+    await repo.create_user({"username": "carol", "tags": ["a"], "created_at": "x"})
+
+    updated = await repo.add_tag("carol", ["a", "b"])
+    # the field, the tag index and the version changed in one step
+    assert updated == {"username": "carol", "tags": ["a", "b"], "created_at": "x"}
+    assert await redis.zrange(f"{TAG_KEY_PREFIX}b", 0, -1) == ["carol"]
+    assert await redis.hget(USER_VERSIONS_KEY, "carol") == "2"
+    await repo.touch_user("carol")
+
+    assert await redis.type("user:carol") == "hash"
+    user = await repo.get_user("carol")
+    assert user["tags"] == ["a", "b"]
+    assert user["last_active"] is not None
+
+
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_add_tag_with_a_stale_version_changes_nothing(redis, storage):
+    repo = RedisUserRepository(redis_url="redis://fake", storage=storage)
+    await repo.create_user({"username": "cleo", "tags": []})
+    version, user = await repo.get_user_versioned("cleo", primary=True)
+
+    # another writer got there first
+    await repo.add_tag("cleo", ["theirs"])
+    assert await repo.add_tag("cleo", ["mine"], if_version=version) is None
+    assert (await repo.get_user("cleo", primary=True))["tags"] == ["theirs"]
+    assert await redis.zrange(f"{TAG_KEY_PREFIX}mine", 0, -1) == []
+
+    version, _ = await repo.get_user_versioned("cleo", primary=True)
+    updated = await repo.add_tag("cleo", ["theirs", "mine"], if_version=version)
+    assert updated["tags"] == ["theirs", "mine"]
+
+
+async def test_migrate_to_hash_keeps_both_layouts_readable(repo, redis):
+    await repo.create_user({"username": "dave", "tags": ["x"]})
+    hash_repo = RedisUserRepository(redis_url="redis://fake", storage="hash")
+    await hash_repo.create_user({"username": "erin", "tags": []})
+
+    # mixed layouts are readable from either repository
+    assert set(await repo.list_users()) == {"dave", "erin"}
+    assert (await hash_repo.get_user("dave"))["tags"] == ["x"]
+
+    await hash_repo.add_tag("dave", ["x", "y"])  # falls back to the JSON path
+    assert await hash_repo.migrate_to_hash() == 1
+    assert await redis.type("user:dave") == "hash"
+    assert (await repo.get_user("dave"))["tags"] == ["x", "y"]
+
+
+async def test_touch_user_is_written_behind(redis):
+    repo = RedisUserRepository(
+        redis_url="redis://fake", last_active_flush_interval=60, storage="hash"
+    )
+    await repo.create_user({"username": "frank", "tags": []})
+    await repo.touch_user("frank")
+    await repo.touch_user("frank")
+    await repo.touch_user("ghost")
+
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "frank") == 0
+    assert repo.stats()["write_behind"]["pending"] == 2
+
+    await repo.close()
+
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "frank") > 0
+    assert await redis.zscore(ACTIVITY_INDEX_KEY, "ghost") is None
+    assert repo.stats()["write_behind"] == {
+        "pending": 0,
+        "flushed_total": 2,
+        "flushes_total": 1,
+        "failed_flushes_total": 0,
+        "coalesced_total": 1,
+    }
+
+
+async def test_close_waits_for_a_flush_in_progress():
+    written = {}
+
+    async def slow_flush(batch):
+        await asyncio.sleep(0.05)
+        written.update(batch)
+
+    buffer = LastActiveBuffer(slow_flush, interval=0.01)
+    buffer.add("ivy", datetime.now(timezone.utc))
+    await asyncio.sleep(0.02)  # the flush has started
+
+    await buffer.close()
+
+    assert list(written) == ["ivy"]
+    assert buffer.stats()["flushed_total"] == 1
+
+
+async def test_cached_get_user_is_invalidated_across_workers(redis):
+    worker_a = RedisUserRepository(redis_url="redis://fake", cache_max_entries=2)
+    worker_b = RedisUserRepository(redis_url="redis://fake", cache_max_entries=2)
+    await worker_a.create_user({"username": "hank", "tags": []})
+
+    assert await worker_b.get_user("hank") == {"username": "hank", "tags": []}
+    await asyncio.sleep(0.05)  # let the invalidation listener subscribe
+    assert (await worker_b.get_user("hank"))["tags"] == []
+    assert worker_b.stats()["cache"]["hits"] == 1
+
+    await worker_a.add_tag("hank", ["t"])
+    await asyncio.sleep(0.05)
+    assert (await worker_b.get_user("hank"))["tags"] == ["t"]
+
+    await worker_a.close()
+    await worker_b.close()
+
+
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_create_user_idempotent_replays_first_response(redis, storage):
+    repo = RedisUserRepository(redis_url="redis://fake", storage=storage)
+    user = {"username": "ivy", "tags": []}
+
+    first, second = await asyncio.gather(
+        repo.create_user_idempotent(user, "idemp:k", {"status": 201}, 300),
+        repo.create_user_idempotent(user, "idemp:k", {"status": 202}, 300),
+    )
+
+    assert (first, second) == (None, {"status": 201})
+    assert await redis.ttl("idemp:k") > 0
+    assert (await repo.get_user("ivy"))["username"] == "ivy"
+    with pytest.raises(ValueError):
+        await repo.create_user_idempotent(user, "idemp:other", {}, 300)
+
+
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_bulk_create_users_reports_conflicts(repo, redis, storage):
+    await repo.create_user({"username": "jay", "tags": []})
+    repo = RedisUserRepository(redis_url="redis://fake", storage=storage)
+    users = [{"username": name, "tags": ["t"]} for name in ("kim", "jay", "lou")]
+
+    assert await repo.bulk_create_users(users) == [True, False, True]
+    assert await redis.zcard(ACTIVITY_INDEX_KEY) == 3
+    assert (await repo.get_user("lou"))["tags"] == ["t"]
+
+
+@pytest.mark.parametrize("codec", ["json", "msgpack"])
+async def test_records_stay_readable_across_codecs(redis, codec):
+    pytest.importorskip(codec)
+    old = {"username": "amy", "tags": ["a"], "created_at": "2024-01-01T00:00:00"}
+    await redis.set("user:amy", json.dumps(old))  # written before codecs existed
+    repo = RedisUserRepository(redis_url="redis://fake", codec=codec)
+    json_repo = RedisUserRepository(redis_url="redis://fake", codec="json")
+
+    assert await repo.get_user("amy") == old
+    await repo.add_tag("amy", ["b"])
+    assert (await json_repo.get_user("amy"))["tags"] == ["b"]
+
+    user = {"username": "bob", "tags": []}
+    replay = {"status": 201, "body": {"user": user}}
+    assert await repo.create_user_idempotent(user, "idemp:k", replay, 60) is None
+    assert await json_repo.create_user_idempotent(user, "idemp:k", {}, 60) == replay
+    assert (await json_repo.list_users()).keys() == {"amy", "bob"}
+
+
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_tag_index_follows_creates_updates_and_deletes(redis, storage):
+    repo = RedisUserRepository(redis_url="redis://fake", storage=storage)
+    await repo.create_user({"username": "ann", "tags": ["a", "b"]})
+    await repo.bulk_create_users(
+        [
+            {"username": "ben", "tags": ["b"], "last_active": time.time()},
+            {"username": "cat", "tags": ["a", "c"]},
+        ]
+    )
+    await repo.add_tag("ben", ["b", "c"])
+
+    assert await repo.list_usernames_by_tags(["a"]) == (["ann", "cat"], None)
+    assert await repo.list_usernames_by_tags(["a", "c"]) == (["cat"], None)
+    assert await repo.list_usernames_by_tags(["a", "c"], "any") == (
+        ["ann", "ben", "cat"],
+        None,
+    )
+    assert await repo.tag_counts() == ({"a": 2, "b": 2, "c": 2}, 0)
+
+    await repo.delete_user("cat")
+    await repo.delete_inactive_users(time.time() - 60)
+
+    assert await repo.tag_counts(["a", "b", "c"]) == ({"a": 0, "b": 1, "c": 1}, 0)
+    assert await repo.list_usernames_by_tags(["b"]) == (["ben"], None)
+
+
+async def test_tag_queries_page_in_username_order(repo):
+    for i in range(5):
+        await repo.create_user({"username": f"u{i}", "tags": ["x", "y"]})
+
+    first, cursor = await repo.list_usernames_by_tags(["x", "y"], count=2)
+    second, cursor = await repo.list_usernames_by_tags(
+        ["x", "y"], cursor=cursor, count=2
+    )
+    third, cursor = await repo.list_usernames_by_tags(
+        ["x", "y"], cursor=cursor, count=2
+    )
+
+    assert first + second + third == [f"u{i}" for i in range(5)]
+    assert cursor is None
+    assert (await repo.tag_counts(count=1))[1] == 1
+
+
+async def test_rebuild_tag_index_indexes_existing_users(repo, redis):
+    await repo.create_user({"username": "ann", "tags": ["a"]})
+    await repo.create_user({"username": "ben", "tags": ["a", "b"]})
+    await redis.delete("users:tag:a", "users:tag:b", "users:tag_counts", "users:tags")
+
+    assert await repo.rebuild_tag_index(batch_size=1) == 2
+    assert await repo.list_usernames_by_tags(["a"]) == (["ann", "ben"], None)
+    assert await repo.tag_counts() == ({"a": 2, "b": 1}, 0)
+
+
+async def test_username_index_answers_prefix_searches(repo, redis):
+    for name in ("user1_12", "user1_120", "user1_13", "user2_12", "user1_1"):
+        await repo.create_user({"username": name, "tags": []})
+    await repo.delete_user("user1_13")
+
+    assert await repo.search_usernames("user1_1") == [
+        "user1_1",
+        "user1_12",
+        "user1_120",
+    ]
+    assert await repo.search_usernames("user1_12", count=1) == ["user1_12"]
+    assert await repo.search_usernames("nobody") == []
+
+    await repo.delete_inactive_users(time.time())
+    assert await redis.zcard(user_repo.USERNAME_INDEX_KEY) == 0
+
+
+async def test_get_users_keeps_order_and_skips_missing(repo):
+    await repo.create_user({"username": "ann", "tags": []})
+    await repo.create_user({"username": "ben", "tags": ["b"]})
+
+    users = await repo.get_users(["ben", "gone", "ann"])
+
+    assert list(users) == ["ben", "ann"]
+    assert users["ben"]["tags"] == ["b"]
+
+
+async def test_rebuild_username_index_indexes_existing_users(repo, redis):
+    await repo.create_user({"username": "ann", "tags": []})
+    await repo.create_user({"username": "ben", "tags": []})
+    await redis.delete(user_repo.USERNAME_INDEX_KEY)
+
+    assert await repo.rebuild_username_index(batch_size=1) == 2
+    assert await repo.search_usernames("") == ["ann", "ben"]
+
+
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_versions_move_on_mutations_but_not_on_touch(redis, storage):
+    repo = RedisUserRepository(redis_url="redis://fake", storage=storage)
+    await repo.create_user({"username": "ann", "tags": []})
+    version, user = await repo.get_user_versioned("ann")
+    listing = await repo.collection_version()
+
+    await repo.touch_user("ann")
+    assert await repo.get_user_versioned("ann", version) == (version, None)
+    assert await repo.collection_version() == listing
+
+    await repo.add_tag("ann", ["a"])
+    newer, user = await repo.get_user_versioned("ann", version)
+    assert newer > version and user["tags"] == ["a"]
+    assert await repo.collection_version() > listing
+
+    await repo.delete_user("ann")
+    await repo.create_user({"username": "ann", "tags": []})
+    recreated, _ = await repo.get_user_versioned("ann")
+    assert recreated > newer
+
+    await repo.delete_all()
+    assert await repo.get_user_versioned("ann", recreated) == (None, None)
+    assert await repo.collection_version() > recreated
+
+
+async def test_cached_reads_keep_the_version(redis):
+    repo = RedisUserRepository(redis_url="redis://fake", cache_max_entries=10)
+    await repo.create_user({"username": "ann", "tags": []})
+    version, _ = await repo.get_user_versioned("ann")
+
+    assert await repo.get_user_versioned("ann", version) == (version, None)
+    assert repo.stats()["cache"]["hits"] == 1
+    await asyncio.sleep(0.05)  # let the invalidation listener subscribe
+    await repo.close()
+
+
+async def test_users_spread_over_node_shards():
+    nodes = {
+        f"node{i}": fakeredis.FakeAsyncRedis(
+            server=fakeredis.FakeServer(), decode_responses=True
+        )
+        for i in range(3)
+    }
+    repo = RedisUserRepository(shards=node_shards(nodes))
+    now = time.time()
+    for i in range(30):
+        tags = ["even"] if i % 2 == 0 else ["odd"]
+        await repo.create_user(
+            {"username": f"user_{i:02}", "tags": tags, "last_active": now - i * 60}
+        )
+
+    assert all([await node.dbsize() for node in nodes.values()])
+    assert (await repo.get_user("user_07"))["tags"] == ["odd"]
+    assert len(await repo.list_users()) == 30
+    seen, cursor = {}, 0
+    while True:
+        page, cursor = await repo.list_users_page(cursor, count=4)
+        seen.update(page)
+        if cursor == 0:
+            break
+    assert len(seen) == 30
+    assert await repo.search_usernames("user_1", count=3) == [
+        "user_10",
+        "user_11",
+        "user_12",
+    ]
+    usernames, cursor = await repo.list_usernames_by_tags(["even"], count=10)
+    assert usernames == [f"user_{i:02}" for i in range(0, 20, 2)]
+    usernames, cursor = await repo.list_usernames_by_tags(["even"], cursor=cursor)
+    assert usernames == [f"user_{i:02}" for i in range(20, 30, 2)]
+    assert cursor is None
+    assert await repo.tag_counts() == ({"even": 15, "odd": 15}, 0)
+
+    assert await repo.delete_inactive_users(now - 10 * 60 + 1) == 20
+    assert sorted(await repo.list_users()) == [f"user_{i:02}" for i in range(10)]
+    await repo.delete_all()
+    assert await repo.list_users() == {}
+
+
+async def test_cluster_shards_keep_each_user_in_one_hash_slot(redis):
+    repo = RedisUserRepository(redis_client=redis, shards=cluster_shards(redis, 4))
+    for name in ("alice", "bob", "carol"):
+        await repo.create_user({"username": name, "tags": ["admin"]})
+    await repo.add_tag("bob", ["ops"])
+    await repo.delete_user("carol")
+
+    keys = await redis.keys("*")
+    assert "user:alice" not in keys
+    tags = {key[: key.index("}") + 1] for key in keys if key.startswith("{")}
+    assert len(tags) > 1  # users landed in several namespaces
+    for name, tag in (("alice", "admin"), ("bob", "ops")):
+        namespace = repo._shard(name).namespace
+        assert f"{namespace}user:{name}" in keys
+        assert f"{namespace}{TAG_KEY_PREFIX}{tag}" in keys
+        assert await redis.hget(f"{namespace}{USER_VERSIONS_KEY}", name)
+    assert not [key for key in keys if "carol" in key]
+    assert (await repo.get_user("bob"))["tags"] == ["ops"]
+
+
+class ClusterClient:
+    # replies like redis.asyncio.RedisCluster: scan() returns a cursor per node
+    def __init__(self, client):
+        self._client = client
+        self.node = SimpleNamespace(name="127.0.0.1:7000")
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_node_from_key(self, key):
+        return self.node
+
+    async def scan(self, cursor=0, match=None, count=None, target_nodes=None):
+        cursor, keys = await self._client.scan(cursor, match=match, count=count)
+        return {target_nodes.name: cursor}, keys
+
+
+async def test_cluster_shards_scan_with_the_cursor_of_their_node(redis):
+    client = ClusterClient(redis)
+    repo = RedisUserRepository(redis_client=client, shards=cluster_shards(client, 2))
+    for i in range(25):
+        await repo.create_user({"username": f"user_{i}", "tags": []})
+
+    seen = {}
+    users, cursor = await repo.list_users_page(0, 10)
+    seen.update(users)
+    while cursor:
+        users, cursor = await repo.list_users_page(cursor, 10)
+        seen.update(users)
+
+    assert sorted(seen) == sorted(f"user_{i}" for i in range(25))
+
+
+async def test_reads_go_to_healthy_replicas_and_writes_to_the_primary():
+    primary = fakeredis.FakeAsyncRedis(decode_responses=True)
+    replica = fakeredis.FakeAsyncRedis(
+        server=fakeredis.FakeServer(), decode_responses=True
+    )
+    unreachable = fakeredis.FakeServer()
+    unreachable.connected = False
+    down = fakeredis.FakeAsyncRedis(server=unreachable, decode_responses=True)
+    repo = RedisUserRepository(
+        shards=[Shard("default", primary, replicas=(replica, down))],
+        read_your_writes_window=5,
+    )
+    # the replica lags: it only has the users as they were first created
+    lagging = RedisUserRepository(redis_client=replica)
+    for i in range(5):
+        user = {"username": f"user_{i}", "tags": []}
+        await repo.create_user(dict(user))
+        await lagging.create_user(dict(user))
+    await repo.add_tag("user_0", ["fresh"])
+
+    assert (await repo.get_user("user_0"))["tags"] == []  # from the replica
+    # down fails, is ejected and the primary answers; then the replica again
+    assert (await repo.get_user("user_0"))["tags"] == ["fresh"]
+    assert (await repo.get_user("user_0"))["tags"] == []
+    assert (await repo.get_user("user_0", primary=True))["tags"] == ["fresh"]
+    assert repo.stats()["replicas"] == {
+        "replicas": 2,
+        "healthy": 1,
+        "reads": 3,
+        "ejections": 1,
+    }
+    seen, cursor = {}, 0
+    while True:
+        page, cursor = await repo.list_users_page(cursor, count=2)
+        seen.update(page)
+        if cursor == 0:
+            break
+    assert seen["user_0"]["tags"] == []
+    assert len(seen) == 5
+    assert await primary.dbsize() > await replica.dbsize()  # no writes to replicas
+
+    with session("writer"):
+        await repo.add_tag("user_1", ["mine"])
+        assert (await repo.get_user("user_1"))["tags"] == ["mine"]
+    with session("reader"):
+        assert (await repo.get_user("user_1"))["tags"] == []
+
+
+async def test_reads_within_same_replicas_see_one_replica():
+    primary = fakeredis.FakeAsyncRedis(decode_responses=True)
+    behind, ahead = (
+        fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        for _ in range(2)
+    )
+    repo = RedisUserRepository(
+        shards=[Shard("default", primary, replicas=(behind, ahead))]
+    )
+    versions = {}
+    for client in (primary, behind, ahead):
+        view = RedisUserRepository(redis_client=client)
+        await view.create_user({"username": "alice", "tags": []})
+        if client is not behind:
+            await view.add_tag("alice", ["fresh"])
+        versions[client] = await view.collection_version()
+    assert versions[behind] < versions[ahead]
+
+    for _ in range(4):  # the replicas take turns
+        with same_replicas():
+            version = await repo.collection_version()
+            users, _ = await repo.list_users_page(0, 10)
+        read_from = ahead if users["alice"]["tags"] else behind
+        assert version == versions[read_from]
+
+
+async def test_concurrent_reads_and_touches_of_a_user_share_one_round_trip(redis):
+    repo = RedisUserRepository(redis_url="redis://fake")
+    await repo.create_user({"username": "popular", "tags": ["a"]})
+    await repo.get_user("popular", primary=True)  # loads the read script
+    await redis.script_load(TOUCH_USER_JSON_SCRIPT)
+    commands = []
+    execute_command = redis.execute_command
+
+    async def counting(*args, **options):
+        commands.append(args[0])
+        return await execute_command(*args, **options)
+
+    redis.execute_command = counting
+
+    users = await asyncio.gather(*(repo.get_user("popular") for _ in range(10)))
+    await asyncio.gather(*(repo.touch_user("popular") for _ in range(10)))
+
+    assert all(user["tags"] == ["a"] for user in users)
+    assert len({id(user) for user in users}) == 10  # each caller has a copy
+    assert commands == ["EVALSHA", "MGET"]  # one read, one touch
+    assert repo.stats()["single_flight"] == {
+        "get_user": {"calls": 1, "shared": 9, "in_flight": 0},
+        "touch_user": {"calls": 1, "shared": 9, "in_flight": 0},
+    }
+
+
+async def test_reads_after_a_write_do_not_join_an_older_read(repo):
+    await repo.create_user({"username": "alice", "tags": []})
+
+    before = asyncio.ensure_future(repo.get_user("alice"))
+    await asyncio.sleep(0)  # the read is in flight
+    await repo.add_tag("alice", ["new"])
+    after = await repo.get_user("alice")
+
+    await before
+    assert after["tags"] == ["new"]
+    assert repo.stats()["single_flight"]["get_user"]["shared"] == 0